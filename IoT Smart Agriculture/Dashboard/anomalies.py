@@ -0,0 +1,489 @@
+"""
+Streaming anomaly detection on the sensor readings.
+
+Every node of every field keeps a small detector per sensor, updated in O(1)
+per reading:
+
+* an exponentially weighted mean and variance of the readings so far: a
+  reading more than ``Z_LIMIT`` standard deviations away from the mean is a
+  *spike*,
+* the previous reading: a change faster than ``RATE_LIMITS`` per minute is
+  a *jump*,
+* the length of the current run of identical values: ``RUN_LIMITS`` equal
+  readings in a row are *stuck* (``US`` sits at 25.0 for hours when the
+  sensor hangs).
+
+Missing readings are skipped. Batches are processed per node and sensor with
+vectorised forms of the same recurrences, so the results do not depend on how
+the readings were batched.
+
+The flagged readings are stored next to the readings, one Parquet file per
+field and month (``timestamp``, ``node_id``, ``sensor``, ``flags``,
+``value``)::
+
+    store/anomalies/prizren/2023-05.parquet
+
+and the detector states of a field in ``store/anomalies/<field>/state.json``.
+They are built from the store the first time they are needed and then
+updated by the ingestion service as readings arrive, so the pages only read
+the flags of the range they show.
+"""
+import json
+import math
+import os
+import shutil
+
+import altair as alt
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from sensor_store import LAYOUT_VERSION, SENSORS, ensure_store, get_default_field, get_partitions, get_store_dir, partition_keys, read_partition, write_table
+from timing import cache_miss, cache_request
+
+# Flag bits
+SPIKE = 1
+JUMP = 2
+STUCK = 4
+FLAG_NAMES = {SPIKE: "spike", JUMP: "jump", STUCK: "stuck"}
+
+# Weight of a new reading in the moving mean and variance (about the last
+# 20 readings, 1.5 hours at the 5 minute interval)
+ALPHA = 0.05
+
+# Spikes are only reported once the detector has seen this many readings
+WARMUP = 50
+
+# Distance from the moving mean, in standard deviations, of a spike
+Z_LIMIT = 6.0
+
+# Fastest plausible change per minute of every sensor
+RATE_LIMITS = {"TC": 1.5, "HUM": 5.0, "PRES": 50.0, "US": 20.0, "SOIL1": 200.0}
+
+# Changes across gaps longer than this (in minutes) are not rated
+MAX_GAP_MINUTES = 60
+
+# Equal readings in a row of a stuck sensor
+RUN_LIMITS = {"TC": 12, "HUM": 36, "PRES": 12, "US": 36, "SOIL1": 36}
+
+# Values a working sensor can legitimately hold for hours (saturated air)
+STUCK_EXEMPT = {"HUM": 100.0}
+
+# Most anomaly markers drawn on one chart
+MAX_MARKERS = 2000
+
+FLAG_SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("ns")),
+    ("node_id", pa.string()),
+    ("sensor", pa.string()),
+    ("flags", pa.int8()),
+    ("value", pa.float64()),
+])
+
+
+class SensorDetector:
+    """
+    Detector state of one sensor of one node.
+
+    Args:
+        sensor (str): One of ``SENSORS``.
+    """
+
+    __slots__ = ("sensor", "count", "mean", "var", "last_value", "last_time", "run_length")
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.last_value = math.nan
+        self.last_time = None
+        self.run_length = 0
+
+    def update(self, timestamp, value):
+        """
+        Checks one reading and adds it to the state.
+
+        Args:
+            timestamp (int): Time of the reading in epoch nanoseconds.
+            value (float): The reading.
+
+        Returns:
+            int: The flags of the reading (0 if it looks normal).
+        """
+        flags = 0
+        if self.count >= WARMUP and abs(value - self.mean) > Z_LIMIT * math.sqrt(self.var):
+            flags |= SPIKE
+        if self.last_time is not None:
+            minutes = (timestamp - self.last_time) / 60e9
+            if 0 < minutes <= MAX_GAP_MINUTES and abs(value - self.last_value) / minutes > RATE_LIMITS[self.sensor]:
+                flags |= JUMP
+        self.run_length = self.run_length + 1 if value == self.last_value else 1
+        if self.run_length >= RUN_LIMITS[self.sensor] and value != STUCK_EXEMPT.get(self.sensor):
+            flags |= STUCK
+
+        delta = value - self.mean if self.count else 0.0
+        self.mean = self.mean + ALPHA * delta if self.count else value
+        self.var = (1 - ALPHA) * (self.var + ALPHA * delta * delta)
+        self.count += 1
+        self.last_value = value
+        self.last_time = timestamp
+        return flags
+
+    def update_series(self, timestamps, values):
+        """
+        Checks a batch of readings in order and adds them to the state.
+
+        Gives the same flags as calling ``update`` for every reading.
+
+        Args:
+            timestamps (numpy.ndarray): Times in epoch nanoseconds.
+            values (numpy.ndarray): The readings, without missing values.
+
+        Returns:
+            numpy.ndarray: The flags of every reading.
+        """
+        n = len(values)
+        flags = np.zeros(n, dtype="int8")
+        if not n:
+            return flags
+
+        # Mean and variance before every reading: m[t] = (1 - a) m[t-1] + a x[t]
+        # and v[t] = (1 - a) v[t-1] + a (1 - a) (x[t] - m[t-1])^2
+        first_mean = self.mean if self.count else values[0]
+        means = _ewma(first_mean, values)
+        delta = values - means[:-1]
+        variances = _ewma(self.var, (1 - ALPHA) * delta * delta)
+        seen = self.count + np.arange(n)
+        spikes = (seen >= WARMUP) & (np.abs(delta) > Z_LIMIT * np.sqrt(variances[:-1]))
+        flags[spikes] |= SPIKE
+
+        previous_values = np.concatenate(([self.last_value], values[:-1]))
+        if self.last_time is None:
+            previous_times = np.concatenate(([timestamps[0]], timestamps[:-1]))
+        else:
+            previous_times = np.concatenate(([self.last_time], timestamps[:-1]))
+        minutes = (timestamps - previous_times) / 60e9
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.abs(values - previous_values) / minutes
+        flags[(minutes > 0) & (minutes <= MAX_GAP_MINUTES) & (rate > RATE_LIMITS[self.sensor])] |= JUMP
+
+        # Length of the run of equal values ending at every reading
+        positions = np.arange(n)
+        run_starts = np.maximum.accumulate(np.where(values != previous_values, positions, -1))
+        runs = np.where(run_starts < 0, positions + 1 + self.run_length, positions - run_starts + 1)
+        stuck = runs >= RUN_LIMITS[self.sensor]
+        if self.sensor in STUCK_EXEMPT:
+            stuck &= values != STUCK_EXEMPT[self.sensor]
+        flags[stuck] |= STUCK
+
+        self.mean = float(means[-1])
+        self.var = float(variances[-1])
+        self.count += n
+        self.last_value = float(values[-1])
+        self.last_time = int(timestamps[-1])
+        self.run_length = int(runs[-1])
+        return flags
+
+    def to_list(self):
+        return [self.count, self.mean, self.var, self.last_value, self.last_time, self.run_length]
+
+    @classmethod
+    def from_list(cls, sensor, values):
+        detector = cls(sensor)
+        detector.count, detector.mean, detector.var, detector.last_value, detector.last_time, detector.run_length = values
+        return detector
+
+
+def _ewma(first, values):
+    # Exponentially weighted mean of ``first`` followed by ``values``, with the
+    # same recurrence as ``SensorDetector.update``
+    series = pd.Series(np.concatenate(([first], values)))
+    return series.ewm(alpha=ALPHA, adjust=False).mean().to_numpy()
+
+
+class FieldDetector:
+    """
+    Detector states of every node and sensor of one field.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    def _detectors(self, node):
+        detectors = self.nodes.get(node)
+        if detectors is None:
+            detectors = self.nodes[node] = {sensor: SensorDetector(sensor) for sensor in SENSORS}
+        return detectors
+
+    def update_frame(self, data):
+        """
+        Checks a batch of readings of the field and adds them to the states.
+
+        Args:
+            data (pandas.DataFrame): Readings with ``timestamp``, ``node_id``
+                and sensor columns.
+
+        Returns:
+            pandas.DataFrame: The flagged readings (``FLAG_SCHEMA``), sorted
+            by timestamp.
+        """
+        frames = []
+        for node, node_data in data.groupby(data["node_id"].astype(str), sort=True):
+            node_data = node_data.sort_values("timestamp", kind="stable")
+            timestamps = node_data["timestamp"].to_numpy("datetime64[ns]").view("int64")
+            for sensor, detector in self._detectors(node).items():
+                if sensor not in node_data.columns:
+                    continue
+                values = node_data[sensor].to_numpy("float64")
+                present = ~np.isnan(values)
+                flags = detector.update_series(timestamps[present], values[present])
+                hits = flags != 0
+                if hits.any():
+                    frames.append(pd.DataFrame({
+                        "timestamp": timestamps[present][hits].view("datetime64[ns]"),
+                        "node_id": node,
+                        "sensor": sensor,
+                        "flags": flags[hits],
+                        "value": values[present][hits],
+                    }))
+        if not frames:
+            return _empty_flags()
+        return pd.concat(frames, ignore_index=True).sort_values(["timestamp", "node_id", "sensor"], ignore_index=True)
+
+    def to_dict(self):
+        return {node: {sensor: d.to_list() for sensor, d in detectors.items()} for node, detectors in self.nodes.items()}
+
+    @classmethod
+    def from_dict(cls, state):
+        detector = cls()
+        detector.nodes = {
+            node: {sensor: SensorDetector.from_list(sensor, values) for sensor, values in detectors.items()}
+            for node, detectors in state.items()
+        }
+        return detector
+
+
+def _empty_flags():
+    return FLAG_SCHEMA.empty_table().to_pandas()
+
+
+def get_anomaly_dir(field=None):
+    """
+    Returns the directory holding the anomaly flags of a field.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to ``anomalies/<field>``.
+    """
+    return os.path.join(get_store_dir(), "anomalies", field or get_default_field())
+
+
+def get_detector_path(field=None):
+    """
+    Returns the path of the saved detector states of a field.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to ``anomalies/<field>/state.json``.
+    """
+    return os.path.join(get_anomaly_dir(field), "state.json")
+
+
+def _flag_path(key, field=None):
+    return os.path.join(get_anomaly_dir(field), f"{key}.parquet")
+
+
+def save_flags(flags, field=None):
+    """
+    Adds flagged readings to the monthly flag files of a field.
+
+    Only the months of the new flags are read and rewritten.
+
+    Args:
+        flags (pandas.DataFrame): Flagged readings from ``update_frame``.
+        field (str): The field id (``get_default_field()`` if not given).
+    """
+    if flags.empty:
+        return
+    for key, new in flags.groupby(partition_keys(flags["timestamp"]), sort=True):
+        path = _flag_path(key, field)
+        if os.path.exists(path):
+            new = pd.concat([pq.read_table(path).to_pandas(), new], ignore_index=True)
+            new = new.drop_duplicates(["timestamp", "node_id", "sensor"], keep="last")
+            new = new.sort_values(["timestamp", "node_id", "sensor"], ignore_index=True)
+        write_table(pa.Table.from_pandas(new, schema=FLAG_SCHEMA, preserve_index=False), path)
+
+
+def save_detector(detector, source_mtime, field=None):
+    """
+    Saves the detector states of a field atomically.
+
+    Args:
+        detector (FieldDetector): The states.
+        source_mtime (float): The store generation they belong to.
+        field (str): The field id (``get_default_field()`` if not given).
+    """
+    path = get_detector_path(field)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"source_mtime": source_mtime, "layout": LAYOUT_VERSION, "detectors": detector.to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+def build_anomalies(field=None):
+    """
+    Checks the whole history of a field, one partition at a time, and stores
+    its flags and detector states.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        FieldDetector: The detector states.
+    """
+    manifest = ensure_store()
+    shutil.rmtree(get_anomaly_dir(field), ignore_errors=True)
+    detector = FieldDetector()
+    for key in sorted(get_partitions(manifest, field)):
+        save_flags(detector.update_frame(read_partition(key, manifest, field=field)), field)
+    save_detector(detector, manifest.get("source_mtime"), field)
+    return detector
+
+
+def _read_state(field):
+    try:
+        with open(get_detector_path(field)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _is_current(state, manifest):
+    return state is not None and state["source_mtime"] == manifest.get("source_mtime") and state.get("layout") == LAYOUT_VERSION
+
+
+def read_detector(field=None):
+    """
+    Reads the saved detector states of a field, rebuilding the flags and
+    states if they are missing or belong to an older store.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        FieldDetector: The detector states.
+    """
+    state = _read_state(field)
+    if not _is_current(state, ensure_store()):
+        return build_anomalies(field)
+    return FieldDetector.from_dict(state["detectors"])
+
+
+def ensure_anomalies(field=None):
+    """
+    Makes sure the flags of a field exist and belong to the current store.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+    """
+    if not _is_current(_read_state(field), ensure_store()):
+        build_anomalies(field)
+
+
+@st.cache_data(show_spinner=False)
+def _load_flag_file(path, mtime):
+    # The modification time is only part of the cache key
+    cache_miss("anomalies")
+    return pq.read_table(path).to_pandas()
+
+
+def load_anomalies(sensor, start=None, end=None, field=None, node=None):
+    """
+    Returns the flagged readings of a sensor inside a time range.
+
+    Args:
+        sensor (str): One of ``SENSORS``.
+        start: Start of the range, or None for an open start.
+        end: End of the range, or None for an open end.
+        field (str): The field id (``get_default_field()`` if not given).
+        node (str): Only return flags of this node (all nodes if not given).
+
+    Returns:
+        pandas.DataFrame: The flagged readings, sorted by timestamp, with a
+        ``kind`` column naming the flags.
+    """
+    ensure_anomalies(field)
+    anomaly_dir = get_anomaly_dir(field)
+    keys = sorted(name[:-len(".parquet")] for name in os.listdir(anomaly_dir) if name.endswith(".parquet"))
+    if start is not None:
+        keys = [key for key in keys if key >= pd.Timestamp(start).strftime("%Y-%m")]
+    if end is not None:
+        keys = [key for key in keys if key <= pd.Timestamp(end).strftime("%Y-%m")]
+
+    frames = []
+    for key in keys:
+        path = _flag_path(key, field)
+        cache_request("anomalies")
+        flags = _load_flag_file(path, os.path.getmtime(path))
+        mask = flags["sensor"] == sensor
+        if start is not None:
+            mask &= flags["timestamp"] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= flags["timestamp"] <= pd.Timestamp(end)
+        if node is not None:
+            mask &= flags["node_id"] == node
+        frames.append(flags[mask])
+    flags = pd.concat(frames, ignore_index=True) if frames else _empty_flags()
+    flags["kind"] = [", ".join(name for bit, name in FLAG_NAMES.items() if value & bit) for value in flags["flags"]]
+    return flags
+
+
+def describe_anomalies(flags):
+    """
+    Summarises flagged readings for a caption.
+
+    Args:
+        flags (pandas.DataFrame): Flagged readings from ``load_anomalies``.
+
+    Returns:
+        str: E.g. "12 readings flagged: 3 spike, 9 stuck".
+    """
+    counts = {name: int((flags["flags"] & bit).astype(bool).sum()) for bit, name in FLAG_NAMES.items()}
+    details = ", ".join(f"{count} {name}" for name, count in counts.items() if count)
+    return f"{len(flags)} readings flagged" + (f": {details}" if details else "")
+
+
+def anomaly_chart(series, flags, color="#77b5fe"):
+    """
+    Draws a sensor series as a line with the flagged readings on top.
+
+    Args:
+        series (pandas.Series): The values, indexed by timestamp (e.g. from
+            ``chart_series``).
+        flags (pandas.DataFrame): Flagged readings from ``load_anomalies``.
+        color (str): Line color.
+
+    Returns:
+        altair.LayerChart: The chart.
+    """
+    if len(flags) > MAX_MARKERS:
+        flags = flags.iloc[np.linspace(0, len(flags) - 1, MAX_MARKERS).astype(int)]
+    line_data = pd.DataFrame({"timestamp": series.index, "value": series.to_numpy()})
+    line = alt.Chart(line_data).mark_line(color=color).encode(
+        x=alt.X("timestamp:T", title=None),
+        y=alt.Y("value:Q", title=series.name, scale=alt.Scale(zero=False)),
+    )
+    markers = alt.Chart(flags[["timestamp", "node_id", "kind", "value"]]).mark_point(color="#d62728", filled=True, size=40).encode(
+        x="timestamp:T",
+        y="value:Q",
+        tooltip=["timestamp:T", "node_id:N", "kind:N", "value:Q"],
+    )
+    return (line + markers).interactive()
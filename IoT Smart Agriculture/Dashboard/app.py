@@ -4,10 +4,21 @@ import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 import os
 import pytz
+from sensor_store import DayIndex
+from running_stats import WINDOWS
+from query_client import field_means, forecast_status, forecast_window, select_field, window_summary
+from figure_cache import show_figure
+from memory_report import show_memory_report
+from timing import phase, track_page
+from forecast_scheduler import format_age
+from forecasting import get_engine
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
+# Label this page's timings (see timing)
+track_page("app")
+
 
 
 
@@ -16,42 +27,32 @@ css_file_path = os.path.join(os.path.dirname(__file__), "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Get the absolute path to the current directory
-current_dir = os.path.dirname(os.path.abspath(__file__))
-
-# Function to construct the file path
-def get_file_path(filename):
-    return os.path.join(current_dir, filename)
-
-# Cache the data loading function
-@st.cache_data
-def load_data(file_path):
-    data = pd.read_csv(file_path)
-    data['timestamp'] = pd.to_datetime(data['timestamp'])
-    return data
-
-
-# Cache the function to calculate average values
-@st.cache_data
-def calculate_averages(data):
-    avg_values = {
-        "TC": data["TC"].mean(),
-        "HUM": data["HUM"].mean(),
-        "PRES": data["PRES"].mean(),
-        "US": data["US"].mean(),
-        "SOIL1": data["SOIL1"].mean()
-    }
-    return avg_values
-
-
+# Function to get the average values of a field from its running statistics (no raw data is read)
+def calculate_averages(window, field):
+    summary = window_summary(window, field)
+    return {sensor: stats["mean"] for sensor, stats in summary.items()}
 
-# Load the data
-data = load_data(get_file_path('cleaned_data.csv'))
-avg_values = calculate_averages(data)
 
 # Page title
 st.title("Welcome to the Smart Agriculture")
 
+# Field shown on the cards (sidebar)
+field = select_field()
+
+# Time window for the averages
+window_label = st.radio("Averages over", list(WINDOWS.keys()), horizontal=True)
+with phase("aggregate"):
+    avg_values = calculate_averages(WINDOWS[window_label], field)
+
+# Averages of every field side by side
+with st.expander("All fields"):
+    with phase("aggregate"):
+        means = field_means(WINDOWS[window_label])
+    st.dataframe(means)
+
+# Memory held by the caches and sessions (sidebar, on demand)
+show_memory_report()
+
 
 
 # Main content with average values
@@ -104,28 +105,16 @@ css_file_path = os.path.join(os.path.dirname(__file__), "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Function to construct the file path
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "predicted_data_2024.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, filename)
-
-# Define the filename
-data_file = "predicted_data_2024.csv"
-
-# Load dataset
-df = pd.read_csv(get_file_path(data_file))
-
-# Convert the timestamp column to datetime
-df['timestamp'] = pd.to_datetime(df['timestamp'])
+# Prophet models are trained in the background (by this server, or by the
+# query service); the days shown are predicted from them
+status = forecast_status()
+engine = get_engine()
+if engine == "prophet":
+    forecast_age_seconds = status["age"]
+    if forecast_age_seconds is None:
+        st.info("The forecast models are being trained in the background. Please check back in a few minutes.")
+        st.stop()
+    st.caption(f"Forecast models trained {format_age(forecast_age_seconds)} ago.")
 
 # Set timezone to GMT+1
 tz = pytz.timezone('Europe/Belgrade')  # Prizren is in the same timezone as Belgrade
@@ -134,9 +123,23 @@ tz = pytz.timezone('Europe/Belgrade')  # Prizren is in the same timezone as Belg
 def get_current_time_gmt_plus_1():
     return datetime.now(tz)
 
-# Filter data for the current date
+# Get current datetime in GMT+1
+current_datetime = get_current_time_gmt_plus_1()
+
+# Predict today and the next 3 days only (local time, cached per week and shared by all sessions)
+with phase("load"):
+    window_start = pd.Timestamp(current_datetime.date())
+    df = forecast_window(window_start, window_start + pd.Timedelta(days=4) - pd.Timedelta(hours=1), field=field, engine=engine)
+if df is None:
+    st.info(f"There is no forecast for the field {field} yet.")
+    st.stop()
+day_index = DayIndex(df['timestamp'])
+# Identifies the predictions shown (they change when the models are retrained)
+forecast_version = int(pd.util.hash_pandas_object(df, index=False).sum())
+
+# Filter data for the current date (precomputed day offsets)
 def get_today_data(df, current_datetime):
-    return df[df['timestamp'].dt.date == current_datetime.date()]
+    return df.iloc[day_index.day(current_datetime.date())]
 
 # Function to calculate forecast for the actual day
 def calculate_actual_day_forecast(df_today):
@@ -163,7 +166,7 @@ def calculate_3_day_forecast(df, current_datetime):
     }
     for i in range(3):
         next_date = current_datetime + timedelta(days=i+1)
-        df_next_day = df[df['timestamp'].dt.date == next_date.date()]
+        df_next_day = df.iloc[day_index.day(next_date.date())]
         if not df_next_day.empty:
             forecast_data['TC_predicted'].append(df_next_day.iloc[-1]['TC_predicted'])
             forecast_data['HUM_predicted'].append(df_next_day.iloc[-1]['HUM_predicted'])
@@ -179,11 +182,9 @@ def calculate_3_day_forecast(df, current_datetime):
     return forecast_data
 
 def main():
-    # Get current datetime in GMT+1
-    current_datetime = get_current_time_gmt_plus_1()
-
     # Filter data for the current date
-    df_today = get_today_data(df, current_datetime)
+    with phase("filter"):
+        df_today = get_today_data(df, current_datetime)
 
     # Extract the latest data point for current conditions
     if not df_today.empty:
@@ -208,7 +209,8 @@ def main():
 
 
     # Today's Forecast
-    forecast_data_actual_day = calculate_actual_day_forecast(df_today)
+    with phase("aggregate"):
+        forecast_data_actual_day = calculate_actual_day_forecast(df_today)
 
     if forecast_data_actual_day:
         st.markdown(
@@ -245,7 +247,8 @@ def main():
         st.error("No data available for the forecast.")
 
     # Calculate the 3-day forecast
-    forecast_data_3_days = calculate_3_day_forecast(df, current_datetime)
+    with phase("aggregate"):
+        forecast_data_3_days = calculate_3_day_forecast(df, current_datetime)
 
     # Display forecast for the next 3 days
     st.subheader('3 Days Forecast')
@@ -291,42 +294,45 @@ def main():
     # Temperature and Humidity Analytics for Today
     st.subheader('Analytics for Today')
 
-    # Resample the data for visualization
-    df_today_resampled = df_today.set_index('timestamp').resample('3H').mean()
+    # Show the plots for temperature, humidity, pressure, US, and Soil vertically (rendered once per day and forecast)
+    def draw_analytics():
+        # Resample the data for visualization
+        df_today_resampled = df_today.set_index('timestamp').resample('3h').mean()
 
-    # Show the plots for temperature, humidity, pressure, US, and Soil vertically
-    fig, ax = plt.subplots(5, 1, figsize=(10, 15))
+        fig, ax = plt.subplots(5, 1, figsize=(10, 15))
 
-    # Plot temperature
-    ax[0].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['TC_predicted'], marker='o')
-    ax[0].set_ylabel('Temperature (°F)')
-    ax[0].set_title('Temperature')
+        # Plot temperature
+        ax[0].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['TC_predicted'], marker='o')
+        ax[0].set_ylabel('Temperature (°F)')
+        ax[0].set_title('Temperature')
 
-    # Plot humidity
-    ax[1].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['HUM_predicted'], marker='o')
-    ax[1].set_ylabel('Humidity (%)')
-    ax[1].set_title('Humidity')
+        # Plot humidity
+        ax[1].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['HUM_predicted'], marker='o')
+        ax[1].set_ylabel('Humidity (%)')
+        ax[1].set_title('Humidity')
 
-    # Plot pressure
-    ax[2].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['PRES_predicted'], marker='o')
-    ax[2].set_ylabel('Pressure')
-    ax[2].set_title('Pressure')
+        # Plot pressure
+        ax[2].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['PRES_predicted'], marker='o')
+        ax[2].set_ylabel('Pressure')
+        ax[2].set_title('Pressure')
 
-    # Plot US
-    ax[3].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['US_predicted'], marker='o')
-    ax[3].set_ylabel('US')
-    ax[3].set_title('US')
+        # Plot US
+        ax[3].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['US_predicted'], marker='o')
+        ax[3].set_ylabel('US')
+        ax[3].set_title('US')
 
-    # Plot Soil
-    ax[4].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['SOIL1_predicted'], marker='o')
-    ax[4].set_ylabel('Soil')
-    ax[4].set_title('Soil')
+        # Plot Soil
+        ax[4].plot(df_today_resampled.index.strftime('%I %p'), df_today_resampled['SOIL1_predicted'], marker='o')
+        ax[4].set_ylabel('Soil')
+        ax[4].set_title('Soil')
 
-    # Adjust layout
-    plt.tight_layout()
+        # Adjust layout
+        plt.tight_layout()
+        return fig
 
     # Show the plots vertically
-    st.pyplot(fig)
+    with phase("render"):
+        show_figure(('analytics', current_datetime.date(), engine, field, forecast_version), draw_analytics)
 
 
 
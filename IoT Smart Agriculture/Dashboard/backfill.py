@@ -0,0 +1,173 @@
+"""
+Bulk backfill of historical logger exports into the sensor store.
+
+Run it with the exports to load (CSV files, or directories of them)::
+
+    python backfill.py exports/2021.csv exports/2022/
+
+Every file is streamed in blocks of ``--block-mb`` megabytes and parsed by
+pyarrow on multiple threads, with the explicit store schema and
+``--timestamp-format`` (see ``sensor_store.read_csv_batches``), so no file is
+ever held in memory whole. Each block is appended to the partitioned store
+(deduplicated on node and timestamp, as in ``append_readings``) and folded
+into the rollups in the same pass. Memory is bounded by the block size,
+whatever the size of the exports.
+
+Once every file is in, the partitions written to are compacted into one file
+each, and the running statistics, correlation partials and anomaly flags of
+the touched fields are rebuilt from the store one partition at a time (their
+streaming updates need readings in time order, which a backfill of older
+history does not give).
+
+The store takes one writer at a time, so stop the ingest service while
+backfilling. Throughput is reported per file and in total, in rows per
+second.
+"""
+import argparse
+import glob
+import os
+import resource
+import time
+
+from anomalies import build_anomalies
+from correlation_engine import build_engine
+from rollups import ensure_rollups, update_rollups
+from running_stats import build_stats
+from sensor_store import (
+    CSV_BLOCK_SIZE,
+    TIMESTAMP_FORMAT,
+    append_readings,
+    compact_partition,
+    partition_keys,
+    read_csv_batches,
+    store_lock,
+)
+
+
+def expand_paths(paths):
+    """
+    Lists the CSV files to load.
+
+    Args:
+        paths (list): Files and directories; directories contribute every
+            ``*.csv`` file below them.
+
+    Returns:
+        list: The files, each directory's sorted by path.
+
+    Raises:
+        FileNotFoundError: If a path does not exist.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "**", "*.csv"), recursive=True))
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError(path)
+    return files
+
+
+def backfill(paths, block_size=CSV_BLOCK_SIZE, timestamp_format=TIMESTAMP_FORMAT):
+    """
+    Loads CSV exports into the store and brings everything derived from it up
+    to date.
+
+    Args:
+        paths (list): CSV files and directories.
+        block_size (int): Bytes of CSV parsed per batch.
+        timestamp_format (str): ``strptime`` format of the timestamps.
+
+    Returns:
+        dict: Rows read and appended, and seconds spent per stage ("parse",
+        "store", "rollups", "compact" and "derived").
+
+    Raises:
+        ValueError: If a file cannot be parsed; the batches before the bad
+            one stay in the store.
+    """
+    files = expand_paths(paths)
+    # Bring the rollups in line with the store first, so blocks are folded into current files
+    ensure_rollups()
+    totals = {"rows": 0, "appended": 0}
+    timings = dict.fromkeys(("parse", "store", "rollups", "compact", "derived"), 0.0)
+    # Months written per field
+    touched = {}
+    started = time.perf_counter()
+
+    for path in files:
+        file_started = time.perf_counter()
+        rows = appended_rows = 0
+        batches = read_csv_batches(path, block_size, timestamp_format)
+        while True:
+            stage = time.perf_counter()
+            try:
+                batch = next(batches, None)
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}") from e
+            timings["parse"] += time.perf_counter() - stage
+            if batch is None:
+                break
+
+            # The store lock keeps rollup rebuilds in other processes out
+            with store_lock():
+                stage = time.perf_counter()
+                appended = append_readings(batch)
+                timings["store"] += time.perf_counter() - stage
+                stage = time.perf_counter()
+                update_rollups(appended)
+                timings["rollups"] += time.perf_counter() - stage
+
+            months = partition_keys(appended["timestamp"])
+            for field, keys in months.groupby(appended["field_id"]):
+                touched.setdefault(field, set()).update(keys.unique())
+            rows += len(batch)
+            appended_rows += len(appended)
+
+        elapsed = time.perf_counter() - file_started
+        totals["rows"] += rows
+        totals["appended"] += appended_rows
+        print(f"{path}: {rows:,} rows ({appended_rows:,} new) in {elapsed:.1f}s, {rows / max(elapsed, 1e-9):,.0f} rows/s")
+
+    stage = time.perf_counter()
+    for field, keys in sorted(touched.items()):
+        for key in sorted(keys):
+            compact_partition(key, field)
+    timings["compact"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    # Under the store lock, so the ingestion service never saves its states
+    # in between (it reloads them on its next batch)
+    with store_lock():
+        for field in sorted(touched):
+            build_stats(field)
+            build_engine(field)
+            build_anomalies(field)
+    timings["derived"] = time.perf_counter() - stage
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Backfilled {totals['rows']:,} rows ({totals['appended']:,} new) from {len(files)} files in {elapsed:.1f}s, "
+        f"{totals['rows'] / max(elapsed, 1e-9):,.0f} rows/s"
+    )
+    print("Stages: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in timings.items()))
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    return dict(totals, **timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load historical logger CSV exports into the sensor store.")
+    parser.add_argument("paths", nargs="+", help="CSV files or directories of CSV files")
+    parser.add_argument("--block-mb", type=float, default=CSV_BLOCK_SIZE / 2**20, help="megabytes of CSV parsed per batch")
+    parser.add_argument("--timestamp-format", default=TIMESTAMP_FORMAT, help="strptime format of the timestamps")
+    args = parser.parse_args()
+    try:
+        backfill(args.paths, int(args.block_mb * 2**20), args.timestamp_format)
+    except (FileNotFoundError, ValueError) as e:
+        parser.exit(1, f"Backfill failed: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
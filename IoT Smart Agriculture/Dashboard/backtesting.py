@@ -0,0 +1,480 @@
+"""
+Rolling-origin backtests of the forecast engines.
+
+Every fold cuts the hourly history of a field at an origin, fits a model on
+the hours before it (as ``forecasting`` does) and predicts the ``horizon``
+hours after it. The origins are ``period`` apart, the first one at least
+``initial`` after the start of the history and the last one a full horizon
+before its end; only the latest ``--folds`` origins are used. The errors are
+grouped by lead time (day 1, day 2, ... after the origin) and reported as MAE
+and MAPE per sensor, engine and hyperparameter set, together with the mean
+fit and predict time per fold.
+
+Each fold (engine, hyperparameters, sensor, origin) is an independent job,
+run in a process pool like the training in ``forecasting``. Fold results
+are cached in ``store/backtest/<field>.json`` under the field's data version,
+so rerunning with more hyperparameters only fits the new folds, and every
+cached fold is discarded once the field's data changes.
+
+Hyperparameters are searched with ``--grid``, e.g.::
+
+    python backtesting.py --engines prophet --grid changepoint_prior_scale=0.01,0.05,0.5
+    python backtesting.py --engines harmonic --grid yearly_harmonics=1,2,3 --grid ridge=0.01,0.1,1
+
+Every combination of the listed values is backtested against the defaults
+(``forecasting.PROPHET_PARAMS`` and the ``harmonic_forecast`` constants).
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import harmonic_forecast
+from forecasting import ENGINES, PROPHET_PARAMS, get_worker_count, prepare_hourly, training_frame
+from sensor_store import SENSORS, get_data_version, get_default_field, get_store_dir, load_readings
+from timing import cache_miss, cache_request, observe, phase
+
+# Default hyperparameters per engine
+DEFAULT_PARAMS = {
+    "prophet": PROPHET_PARAMS,
+    "harmonic": {
+        "daily_harmonics": harmonic_forecast.DAILY_HARMONICS,
+        "yearly_harmonics": harmonic_forecast.YEARLY_HARMONICS,
+        "ridge": harmonic_forecast.RIDGE,
+    },
+}
+
+# Fold layout in days
+HORIZON_DAYS = 7
+INITIAL_DAYS = 60
+PERIOD_DAYS = 7
+FOLDS = 8
+
+# Actual values closer to zero than this are left out of the MAPE
+MAPE_FLOOR = 1e-6
+
+
+def get_cache_path(field):
+    """
+    Returns the file caching the fold results of a field.
+
+    Args:
+        field (str): The field.
+
+    Returns:
+        str: The absolute path to ``store/backtest/<field>.json``.
+    """
+    return os.path.join(get_store_dir(), "backtest", f"{field}.json")
+
+
+def read_cache(field, version):
+    """
+    Reads the cached fold results of a field.
+
+    Args:
+        field (str): The field.
+        version: The field's current data version.
+
+    Returns:
+        dict: Fold result per fold key (empty if the cache is missing or was
+        made from other data).
+    """
+    try:
+        with open(get_cache_path(field)) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return cache["folds"] if cache.get("version") == version else {}
+
+
+def write_cache(field, version, folds):
+    """
+    Stores the fold results of a field, replacing the file atomically.
+
+    Args:
+        field (str): The field.
+        version: The data version the folds were computed on.
+        folds (dict): Fold result per fold key.
+    """
+    path = get_cache_path(field)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "folds": folds}, f)
+    os.replace(tmp_path, path)
+
+
+def fold_key(engine, params, sensor, origin, horizon):
+    """
+    Identifies a fold in the cache.
+
+    Args:
+        engine (str): The forecast engine.
+        params (dict): Its hyperparameters.
+        sensor (str): The sensor.
+        origin (pandas.Timestamp): The forecast origin.
+        horizon (int): Number of predicted hours.
+
+    Returns:
+        str: Hex digest of the fold's definition.
+    """
+    definition = json.dumps([engine, params, sensor, origin.isoformat(), horizon], sort_keys=True)
+    return hashlib.sha256(definition.encode()).hexdigest()
+
+
+def fold_origins(timestamps, horizon, initial, period, folds):
+    """
+    Places the forecast origins of the folds.
+
+    Args:
+        timestamps (pandas.Series): Sorted hourly timestamps of the history.
+        horizon (pandas.Timedelta): Predicted time after each origin.
+        initial (pandas.Timedelta): Shortest training history.
+        period (pandas.Timedelta): Time between origins.
+        folds (int): Maximum number of origins; the latest are kept.
+
+    Returns:
+        list: The origins, oldest first.
+    """
+    if timestamps.empty:
+        return []
+    first = timestamps.iloc[0] + initial
+    last = timestamps.iloc[-1] - horizon
+    if last < first:
+        return []
+    # Counted back from the last origin, so the newest data is always tested
+    origins = pd.date_range(end=last.floor("h"), periods=folds, freq=period)
+    return [origin for origin in origins if origin >= first]
+
+
+def lead_errors(actual, predicted, horizon_days):
+    """
+    Sums the errors of one fold per lead day.
+
+    Args:
+        actual (numpy.ndarray): Actual hourly values after the origin, NaN
+            where missing.
+        predicted (numpy.ndarray): Predicted values for the same hours.
+        horizon_days (int): Number of lead days.
+
+    Returns:
+        dict: ``abs_error`` and ``count`` (for the MAE) and ``pct_error`` and
+        ``pct_count`` (for the MAPE), one sum per lead day.
+    """
+    error = np.abs(actual - predicted)
+    scaled = error / np.abs(actual)
+    present = ~np.isnan(error)
+    scalable = present & (np.abs(actual) > MAPE_FLOOR)
+    sums = {"abs_error": [], "count": [], "pct_error": [], "pct_count": []}
+    for day in range(horizon_days):
+        rows = slice(day * 24, (day + 1) * 24)
+        sums["abs_error"].append(float(error[rows][present[rows]].sum()))
+        sums["count"].append(int(present[rows].sum()))
+        sums["pct_error"].append(float(100 * scaled[rows][scalable[rows]].sum()))
+        sums["pct_count"].append(int(scalable[rows].sum()))
+    return sums
+
+
+def run_fold(engine, params, sensor, hourly_data, origin, horizon_days):
+    """
+    Fits one model on the hours before an origin and scores its forecast.
+
+    This runs inside a worker process, so it only takes and returns plain,
+    picklable values.
+
+    Args:
+        engine (str): The forecast engine.
+        params (dict): Its hyperparameters.
+        sensor (str): The sensor.
+        hourly_data (pandas.DataFrame): Hourly averages with a ``timestamp``
+            column, from the start of the history to the end of the fold.
+        origin (pandas.Timestamp): The forecast origin.
+        horizon_days (int): Number of predicted days.
+
+    Returns:
+        dict: The error sums per lead day (see ``lead_errors``) and the fit
+        and predict time in seconds.
+    """
+    horizon = horizon_days * 24
+    train = hourly_data[hourly_data["timestamp"] < origin]
+    future = pd.date_range(origin, periods=horizon, freq="h")
+    actual = hourly_data.set_index("timestamp")[sensor].reindex(future).to_numpy("float64")
+
+    started = time.perf_counter()
+    if engine == "harmonic":
+        epochs = train["timestamp"].to_numpy("datetime64[ns]").view("int64")
+        values = train[[sensor]].to_numpy("float64")
+        coefficients = harmonic_forecast.fit(epochs, values, epochs[0], **params)
+        fitted = time.perf_counter()
+        harmonics = {name: params[name] for name in ("daily_harmonics", "yearly_harmonics")}
+        predicted = harmonic_forecast.predict(coefficients, future.asi8, epochs[0], **harmonics)[:, 0]
+    else:
+        import logging
+
+        from prophet import Prophet
+
+        # cmdstanpy logs every fit
+        logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+        model = Prophet(uncertainty_samples=0, **params)
+        model.fit(training_frame(train, sensor))
+        fitted = time.perf_counter()
+        predicted = model.predict(pd.DataFrame({"ds": future}))["yhat"].to_numpy()
+    predicted_at = time.perf_counter()
+
+    result = lead_errors(actual, predicted, horizon_days)
+    result.update({"fit": fitted - started, "predict": predicted_at - fitted})
+    return result
+
+
+def param_grid(engine, grid):
+    """
+    Lists the hyperparameter sets of an engine.
+
+    Args:
+        engine (str): The forecast engine.
+        grid (dict): Candidate values per hyperparameter name; names the
+            engine does not have are ignored.
+
+    Returns:
+        list: Every combination of the engine's candidate values, applied to
+        its defaults.
+    """
+    defaults = DEFAULT_PARAMS[engine]
+    names = [name for name in grid if name in defaults]
+    return [dict(defaults, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def parse_grid(options):
+    """
+    Parses ``--grid`` options.
+
+    Args:
+        options (list): Strings like "ridge=0.01,0.1"; values are read as JSON
+            where possible (numbers, true/false), otherwise as strings.
+
+    Returns:
+        dict: Candidate values per hyperparameter name.
+
+    Raises:
+        ValueError: If an option has no "=" or names no known hyperparameter.
+    """
+    known = set().union(*DEFAULT_PARAMS.values())
+    grid = {}
+    for option in options:
+        name, sep, values = option.partition("=")
+        if not sep or name not in known:
+            raise ValueError(f"invalid grid option {option!r}, expected <hyperparameter>=<value>,<value>...")
+        grid[name] = []
+        for value in values.split(","):
+            try:
+                grid[name].append(json.loads(value))
+            except json.JSONDecodeError:
+                grid[name].append(value)
+    return grid
+
+
+def run_folds(jobs, workers=None):
+    """
+    Runs fold jobs concurrently in a process pool.
+
+    Args:
+        jobs (dict): ``run_fold`` arguments per fold key.
+        workers (int): Number of worker processes (``get_worker_count()`` if
+            not given). With one worker the jobs run in this process.
+
+    Returns:
+        dict: The fold result per fold key.
+    """
+    workers = min(workers or get_worker_count(), len(jobs)) or 1
+    if workers == 1:
+        return {key: run_fold(*arguments) for key, arguments in jobs.items()}
+
+    # "spawn" keeps the workers independent of the Streamlit server's threads
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(run_fold, *arguments): key for key, arguments in jobs.items()}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def summarize(folds):
+    """
+    Combines the results of the folds of one model.
+
+    Args:
+        folds (list): Fold results.
+
+    Returns:
+        dict: Number of folds, MAE and MAPE per lead day and over the whole
+        horizon (None where nothing could be scored), and the mean fit and
+        predict time.
+    """
+    totals = {name: np.sum([fold[name] for fold in folds], axis=0) for name in ("abs_error", "count", "pct_error", "pct_count")}
+
+    def ratio(total, count):
+        return [float(t / c) if c else None for t, c in zip(total, count)]
+
+    def overall(total, count):
+        return float(total.sum() / count.sum()) if count.sum() else None
+
+    return {
+        "folds": len(folds),
+        "mae": ratio(totals["abs_error"], totals["count"]),
+        "mape": ratio(totals["pct_error"], totals["pct_count"]),
+        "mae_all": overall(totals["abs_error"], totals["count"]),
+        "mape_all": overall(totals["pct_error"], totals["pct_count"]),
+        "fit_s": float(np.mean([fold["fit"] for fold in folds])),
+        "predict_s": float(np.mean([fold["predict"] for fold in folds])),
+    }
+
+
+def backtest(engines=ENGINES, sensors=SENSORS, grid=None, field=None, horizon_days=HORIZON_DAYS,
+             initial_days=INITIAL_DAYS, period_days=PERIOD_DAYS, folds=FOLDS, workers=None, use_cache=True):
+    """
+    Backtests every engine, hyperparameter set and sensor of a field.
+
+    Args:
+        engines (list): The forecast engines.
+        sensors (list): The sensors.
+        grid (dict): Candidate values per hyperparameter (see ``param_grid``).
+        field (str): The field (the default field if not given).
+        horizon_days (int): Days predicted after each origin.
+        initial_days (int): Shortest training history in days.
+        period_days (int): Days between origins.
+        folds (int): Maximum number of origins.
+        workers (int): Number of worker processes.
+        use_cache (bool): Reuse and store fold results.
+
+    Returns:
+        list: One dict per engine, hyperparameter set and sensor, with the
+        ``summarize`` results.
+    """
+    field = field or get_default_field()
+    version = get_data_version(field)
+    with phase("load"):
+        readings = load_readings(columns=SENSORS, compact=False, field=field)
+    with phase("resample"):
+        hourly_data = prepare_hourly(readings)
+    horizon = pd.Timedelta(days=horizon_days)
+    origins = fold_origins(hourly_data["timestamp"], horizon, pd.Timedelta(days=initial_days), pd.Timedelta(days=period_days), folds)
+
+    cached = read_cache(field, version) if use_cache else {}
+    models = []
+    jobs = {}
+    for engine in engines:
+        for params in param_grid(engine, grid or {}):
+            for sensor in sensors:
+                keys = [fold_key(engine, params, sensor, origin, horizon_days * 24) for origin in origins]
+                models.append({"engine": engine, "params": params, "sensor": sensor, "keys": keys})
+                for key, origin in zip(keys, origins):
+                    cache_request("backtest")
+                    if key not in cached:
+                        cache_miss("backtest")
+                        # Workers only get the hours they may need
+                        window = hourly_data[hourly_data["timestamp"] < origin + horizon][["timestamp", sensor]]
+                        jobs[key] = (engine, params, sensor, window, origin, horizon_days)
+
+    started = time.perf_counter()
+    results = run_folds(jobs, workers) if jobs else {}
+    requested = sum(len(model["keys"]) for model in models)
+    print(f"Ran {len(jobs)} folds in {time.perf_counter() - started:.1f}s ({requested - len(jobs)} cached)")
+    # The folds run in worker processes, which report their own timings
+    for result in results.values():
+        observe("fit", result["fit"])
+        observe("predict", result["predict"])
+    cached.update(results)
+    if use_cache and results:
+        write_cache(field, version, cached)
+
+    return [
+        dict(engine=model["engine"], params=model["params"], sensor=model["sensor"], **summarize([cached[key] for key in model["keys"]]))
+        for model in models
+        if model["keys"]
+    ]
+
+
+def _format(value, digits=2):
+    return "-" if value is None or math.isnan(value) else f"{value:.{digits}f}"
+
+
+def report(rows, horizon_days):
+    """
+    Prints the backtest results and the best hyperparameters per sensor.
+
+    Args:
+        rows (list): Results from ``backtest``.
+        horizon_days (int): Number of lead days.
+    """
+    for row in rows:
+        defaults = DEFAULT_PARAMS[row["engine"]]
+        changed = {name: value for name, value in row["params"].items() if defaults.get(name) != value}
+        label = f"{row['engine']} {json.dumps(changed, sort_keys=True) if changed else 'defaults'}"
+        print(f"{row['sensor']:<6} {label:<48} {row['folds']} folds, fit {row['fit_s']:.2f}s, predict {row['predict_s']:.3f}s")
+        print(f"       MAE  all {_format(row['mae_all']):>9}  " + " ".join(f"d{day + 1} {_format(value):>9}" for day, value in enumerate(row["mae"][:horizon_days])))
+        print(f"       MAPE all {_format(row['mape_all']):>8}%  " + " ".join(f"d{day + 1} {_format(value):>8}%" for day, value in enumerate(row["mape"][:horizon_days])))
+
+    print("Lowest MAE over the horizon per sensor:")
+    for sensor in dict.fromkeys(row["sensor"] for row in rows):
+        scored = [row for row in rows if row["sensor"] == sensor and row["mae_all"] is not None]
+        if scored:
+            best = min(scored, key=lambda row: row["mae_all"])
+            print(f"  {sensor:<6} {best['engine']} {json.dumps(best['params'], sort_keys=True)} MAE {best['mae_all']:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the forecast engines with rolling-origin cross-validation.")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="comma separated forecast engines")
+    parser.add_argument("--sensors", default=",".join(SENSORS), help="comma separated sensors")
+    parser.add_argument("--grid", action="append", default=[], help="hyperparameter candidates, e.g. ridge=0.01,0.1 (repeatable)")
+    parser.add_argument("--field", default=None, help="field to backtest (default: the default field)")
+    parser.add_argument("--horizon-days", type=int, default=HORIZON_DAYS, help="days predicted after each origin")
+    parser.add_argument("--initial-days", type=int, default=INITIAL_DAYS, help="shortest training history in days")
+    parser.add_argument("--period-days", type=int, default=PERIOD_DAYS, help="days between origins")
+    parser.add_argument("--folds", type=int, default=FOLDS, help="maximum number of origins (the latest are used)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="neither reuse nor store fold results")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    engines = [engine for engine in args.engines.split(",") if engine]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        parser.error(f"unknown engines: {', '.join(unknown)}")
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as e:
+        parser.error(str(e))
+
+    rows = backtest(
+        engines,
+        [sensor for sensor in args.sensors.split(",") if sensor],
+        grid,
+        args.field,
+        args.horizon_days,
+        args.initial_days,
+        args.period_days,
+        args.folds,
+        args.workers,
+        not args.no_cache,
+    )
+    if not rows:
+        print("The history is too short for a single fold.")
+        return
+    report(rows, args.horizon_days)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Incremental correlation engine for the Correlation page.
+
+Instead of running ``DataFrame.corr()`` over the whole history on every rerun,
+the engine keeps mergeable partial sums per calendar day: for every pair of
+sensors the number of readings where both are present and the sums of x, x²
+and x·y over them. Partial sums simply add up, so
+
+* the all-time matrix is updated in O(1) per ingested reading, and
+* a rolling window (last day, week or month) is answered by adding up the
+  partials of the days it covers, without rescanning any rows.
+
+Missing readings are handled pairwise, exactly like ``DataFrame.corr()``. The
+sums are taken around a fixed per-sensor shift to keep them numerically
+stable (air pressure is around 97,000 Pa).
+
+The partials are kept per field, over all of the field's nodes, and saved to
+``store/correlation/<field>.npz``. They are built from the store once and then
+updated by the ingestion service.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from sensor_store import SENSORS, ensure_store, get_default_field, get_partitions, get_store_dir, read_partition
+from timing import cache_miss, cache_request, phase
+
+DAY = 86400 * 10**9
+
+# Rolling windows offered on the Correlation page, in days
+WINDOWS = {
+    "All data": None,
+    "Last day": 1,
+    "Last week": 7,
+    "Last month": 30,
+}
+
+
+class PartialSums:
+    """
+    Pairwise partial sums from which a correlation matrix can be computed.
+
+    ``n[i, j]`` counts the readings where sensors i and j are both present;
+    ``sx[i, j]`` and ``sxx[i, j]`` sum sensor i (and its square) over those
+    readings; ``sxy[i, j]`` sums the products of i and j.
+    """
+
+    def __init__(self, size=len(SENSORS)):
+        self.n = np.zeros((size, size))
+        self.sx = np.zeros((size, size))
+        self.sxx = np.zeros((size, size))
+        self.sxy = np.zeros((size, size))
+
+    @classmethod
+    def from_values(cls, values, shift):
+        """
+        Computes the partial sums of a block of readings with matrix products.
+
+        Args:
+            values (numpy.ndarray): Readings, one column per sensor; NaN marks
+                a missing reading.
+            shift (numpy.ndarray): Value subtracted from each sensor.
+
+        Returns:
+            PartialSums: The partial sums.
+        """
+        present = ~np.isnan(values)
+        x = np.where(present, values - shift, 0.0)
+        mask = present.astype("float64")
+        sums = cls(values.shape[1])
+        sums.n = mask.T @ mask
+        sums.sx = x.T @ mask
+        sums.sxx = (x * x).T @ mask
+        sums.sxy = x.T @ x
+        return sums
+
+    def merge(self, other):
+        """
+        Adds another set of partial sums to this one.
+
+        Args:
+            other (PartialSums): The partial sums to add.
+
+        Returns:
+            PartialSums: This object.
+        """
+        self.n += other.n
+        self.sx += other.sx
+        self.sxx += other.sxx
+        self.sxy += other.sxy
+        return self
+
+    def corr(self):
+        """
+        Computes the Pearson correlation matrix.
+
+        Returns:
+            numpy.ndarray: The matrix; NaN where a pair has fewer than two
+            readings or no variance.
+        """
+        n = self.n
+        sy = self.sx.T
+        syy = self.sxx.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = n * self.sxy - self.sx * sy
+            var_x = n * self.sxx - self.sx ** 2
+            var_y = n * syy - sy ** 2
+            corr = cov / np.sqrt(var_x * var_y)
+        corr[(n < 2) | (var_x <= 0) | (var_y <= 0)] = np.nan
+        return np.clip(corr, -1.0, 1.0)
+
+
+class CorrelationEngine:
+    """
+    Day-by-day partial sums plus their running total.
+
+    Args:
+        shift (numpy.ndarray): Value subtracted from each sensor before summing.
+    """
+
+    def __init__(self, shift):
+        self.shift = np.asarray(shift, dtype="float64")
+        self.total = PartialSums()
+        self.days = {}
+
+    def update(self, data):
+        """
+        Folds a batch of readings into the daily partials and the total.
+
+        Args:
+            data (pandas.DataFrame): Readings with a ``timestamp`` column.
+        """
+        if data.empty:
+            return
+        days = data["timestamp"].to_numpy().view("int64") // DAY * DAY
+        values = data[SENSORS].to_numpy(dtype="float64")
+        order = np.argsort(days, kind="stable")
+        days, values = days[order], values[order]
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        for begin, end in zip(starts, np.r_[starts[1:], len(days)]):
+            sums = PartialSums.from_values(values[begin:end], self.shift)
+            day = int(days[begin])
+            self.days.setdefault(day, PartialSums()).merge(sums)
+            self.total.merge(sums)
+
+    def matrix(self, days=None):
+        """
+        Returns the correlation matrix over all data or a rolling window.
+
+        Args:
+            days (int): Window length in days, ending on the latest day with
+                readings, or None for all data.
+
+        Returns:
+            pandas.DataFrame: The correlation matrix, indexed by sensor.
+        """
+        if days is None or not self.days:
+            sums = self.total
+        else:
+            first_day = max(self.days) - (days - 1) * DAY
+            sums = PartialSums()
+            for day, partial in self.days.items():
+                if day >= first_day:
+                    sums.merge(partial)
+        return pd.DataFrame(sums.corr(), index=SENSORS, columns=SENSORS)
+
+    def save(self, path, source_mtime):
+        """
+        Saves the partial sums atomically.
+
+        Args:
+            path (str): Destination ``.npz`` file.
+            source_mtime (float): The store generation they belong to.
+        """
+        days = sorted(self.days)
+        stacked = {
+            name: np.array([getattr(self.days[day], name) for day in days]).reshape(-1, len(SENSORS), len(SENSORS))
+            for name in ("n", "sx", "sxx", "sxy")
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            source_mtime=np.float64(np.nan if source_mtime is None else source_mtime),
+            shift=self.shift,
+            days=np.array(days, dtype="int64"),
+            **stacked,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads saved partial sums.
+
+        Args:
+            path (str): The ``.npz`` file.
+
+        Returns:
+            tuple: The engine and the store generation it belongs to.
+        """
+        with np.load(path) as saved:
+            engine = cls(saved["shift"])
+            for i, day in enumerate(saved["days"]):
+                sums = PartialSums()
+                sums.n, sums.sx, sums.sxx, sums.sxy = (saved[name][i] for name in ("n", "sx", "sxx", "sxy"))
+                engine.days[int(day)] = sums
+                engine.total.merge(sums)
+            source_mtime = float(saved["source_mtime"])
+        return engine, (None if np.isnan(source_mtime) else source_mtime)
+
+
+def get_engine_path(field=None):
+    """
+    Returns the path of the saved partial sums of a field.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to ``correlation/<field>.npz``.
+    """
+    return os.path.join(get_store_dir(), "correlation", f"{field or get_default_field()}.npz")
+
+
+def build_engine(field=None):
+    """
+    Builds the partial sums of a field from the readings store, one partition
+    at a time.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        CorrelationEngine: The engine.
+    """
+    manifest = ensure_store()
+    keys = sorted(get_partitions(manifest, field))
+    # Shift every sensor by its mean in the first partition
+    if keys:
+        shift = read_partition(keys[0], manifest, field=field)[SENSORS].mean().fillna(0).to_numpy()
+    else:
+        shift = np.zeros(len(SENSORS))
+    engine = CorrelationEngine(shift)
+    for key in keys:
+        engine.update(read_partition(key, manifest, field=field))
+    engine.save(get_engine_path(field), manifest.get("source_mtime"))
+    return engine
+
+
+def read_engine(field=None):
+    """
+    Reads the saved partial sums of a field, rebuilding them if they are
+    missing or belong to an older store.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        CorrelationEngine: The engine.
+    """
+    manifest = ensure_store()
+    path = get_engine_path(field)
+    if not os.path.exists(path):
+        return build_engine(field)
+    engine, source_mtime = CorrelationEngine.load(path)
+    if source_mtime != manifest.get("source_mtime"):
+        return build_engine(field)
+    return engine
+
+
+@st.cache_data(show_spinner=False)
+def _correlation_matrix(days, field, path, mtime):
+    # The file path and modification time are only part of the cache key
+    cache_miss("correlation")
+    engine = read_engine(field)
+    with phase("corr"):
+        return engine.matrix(days)
+
+
+def correlation_matrix(days=None, field=None):
+    """
+    Returns the correlation matrix of the sensors of a field.
+
+    Args:
+        days (int): Rolling window in days, or None for all data.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        pandas.DataFrame: The correlation matrix, indexed by sensor.
+    """
+    field = field or get_default_field()
+    path = get_engine_path(field)
+    if not os.path.exists(path):
+        build_engine(field)
+    cache_request("correlation")
+    return _correlation_matrix(days, field, path, os.path.getmtime(path))
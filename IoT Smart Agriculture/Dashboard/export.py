@@ -0,0 +1,535 @@
+"""
+Streaming exports of sensor readings and forecasts as CSV or Parquet.
+
+An export is produced chunk by chunk and written out as it goes, so memory
+is bounded by one chunk whatever the size of the export:
+
+* readings are read from the store one monthly partition at a time, field
+  by field (``sensor_store.read_partition``), and cut into chunks of
+  ``CHUNK_ROWS`` rows,
+* downsampled readings (``resolution``) come from the rollup files of the
+  resolution, one month at a time, with count, min, max, mean and last of
+  every bucket; the readings of selected nodes are rolled up on the fly,
+* forecasts are predicted ``FORECAST_CHUNK_WEEKS`` weeks at a time (see
+  ``forecast_service``), hourly or averaged per day or week.
+
+The CSV header goes out before anything is read, and every chunk is written
+as soon as it is ready, so the first bytes arrive long before the scan ends.
+Parquet files get one row group per chunk.
+
+The query service streams exports over HTTP (``/export``, see
+``query_api``); the pages link to it when it is configured and otherwise
+offer smaller exports as an in-page download. From the command line::
+
+    python export.py --start 2023-01-01 --end 2023-12-31 --sensors TC,HUM \\
+        --fields all --resolution 1h --format parquet --output readings.parquet
+"""
+import argparse
+import os
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+import query_client
+from forecast_service import PREDICTED_COLUMNS, ForecastService, get_forecast_service, week_start
+from rollups import (
+    RESOLUTIONS,
+    STATS,
+    aggregate,
+    bucket_starts,
+    ensure_rollups,
+    estimate_rows,
+    merge_rollups,
+    read_rollup_month,
+)
+from sensor_store import (
+    SENSORS,
+    TimeIndex,
+    ensure_store,
+    get_default_field,
+    get_partitions,
+    get_time_bounds,
+    list_fields,
+    read_partition,
+    to_epoch,
+)
+from timing import phase
+
+# Content type per export format
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Where the rows come from
+SOURCES = ("readings", "forecast")
+
+# Resolutions of forecast exports (the forecasts are hourly)
+FORECAST_RESOLUTIONS = ("1h", "1d", "1w")
+
+# Rows per chunk of readings (and per Parquet row group)
+CHUNK_ROWS = 100_000
+
+# Weeks of forecast predicted per chunk
+FORECAST_CHUNK_WEEKS = 4
+
+# Largest export offered as an in-page download when there is no query
+# service to stream it (the page holds the whole file)
+INLINE_ROWS = 1_000_000
+
+# Labels of the resolutions in the pages
+RESOLUTION_LABELS = {None: "Raw readings", "1min": "1 minute", "1h": "1 hour", "1d": "1 day", "1w": "1 week"}
+
+
+class _Sink:
+    """
+    Write-only file collecting the bytes written since it was last drained.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _check(values, choices, name):
+    unknown = [value for value in values if value not in choices]
+    if unknown:
+        raise ValueError(f"unknown {name}: {', '.join(map(str, unknown))}")
+
+
+def _schema(columns):
+    types = []
+    for column in columns:
+        if column == "timestamp":
+            types.append(pa.field(column, pa.timestamp("ns")))
+        elif column in ("field_id", "node_id"):
+            types.append(pa.field(column, pa.string()))
+        elif column.endswith("_count"):
+            types.append(pa.field(column, pa.int64()))
+        else:
+            types.append(pa.field(column, pa.float64()))
+    return pa.schema(types)
+
+
+def export_columns(source, sensors, resolution=None):
+    """
+    Returns the columns of an export.
+
+    Args:
+        source (str): One of ``SOURCES``.
+        sensors (list): The exported sensors.
+        resolution (str): The resolution, or None for raw readings.
+
+    Returns:
+        list: The column names, in order.
+    """
+    if source == "forecast":
+        return ["timestamp", "field_id"] + [f"{sensor}_predicted" for sensor in sensors]
+    if resolution is None:
+        return ["timestamp", "field_id", "node_id"] + list(sensors)
+    return ["timestamp", "field_id"] + [f"{sensor}_{stat}" for sensor in sensors for stat in STATS]
+
+
+def _partition_frames(manifest, field, start, end, columns, nodes):
+    # The field's partitions overlapping the range, in time order, one at a time
+    start_epoch = -np.inf if start is None else to_epoch(start)
+    end_epoch = np.inf if end is None else to_epoch(end)
+    for key, entry in sorted(get_partitions(manifest, field).items()):
+        if entry["end"] < start_epoch or entry["start"] > end_epoch:
+            continue
+        with phase("load"):
+            data = read_partition(key, manifest, columns=columns, field=field)
+        with phase("filter"):
+            data = data.iloc[TimeIndex(data["timestamp"]).slice(start, end)]
+            if nodes is not None:
+                data = data[data["node_id"].isin(nodes)]
+        if not data.empty:
+            yield data
+
+
+def _reading_chunks(manifest, fields, start, end, sensors, nodes, chunk_rows):
+    for field in fields:
+        for data in _partition_frames(manifest, field, start, end, ["node_id"] + sensors, nodes):
+            data = data.assign(field_id=field)
+            for offset in range(0, len(data), chunk_rows):
+                yield data.iloc[offset:offset + chunk_rows]
+
+
+def _rollup_chunks(fields, start, end, resolution):
+    for field in fields:
+        first, last = get_time_bounds(field)
+        if first is None:
+            continue
+        # A bucket starting before ``start`` may still overlap it (as in ``load_rollup``)
+        bucket_start = pd.Timestamp(int(bucket_starts(pd.Series([pd.Timestamp(first if start is None else start)]), resolution)[0]))
+        bucket_end = pd.Timestamp(last if end is None else end)
+        for month in pd.period_range(bucket_start, bucket_end, freq="M"):
+            with phase("load"):
+                rollup = read_rollup_month(resolution, month.strftime("%Y-%m"), field)
+            if rollup is None:
+                continue
+            rollup = rollup.iloc[TimeIndex(rollup["timestamp"]).slice(bucket_start, bucket_end)]
+            if not rollup.empty:
+                yield rollup.assign(field_id=field)
+
+
+def _node_rollup_chunks(manifest, fields, start, end, resolution, nodes):
+    for field in fields:
+        # Buckets are completed across partitions: the last one of every
+        # partition waits for the readings of the next
+        pending = None
+        for data in _partition_frames(manifest, field, start, end, ["node_id"] + SENSORS, nodes):
+            with phase("aggregate"):
+                rollup = aggregate(data, resolution)
+                if pending is not None:
+                    rollup = merge_rollups(pending, rollup)
+            pending = rollup.iloc[-1:]
+            if len(rollup) > 1:
+                yield rollup.iloc[:-1].assign(field_id=field)
+        if pending is not None:
+            yield pending.assign(field_id=field)
+
+
+def _forecast_chunks(service, fields, start, end, resolution, engine, chunk_weeks):
+    for field in fields:
+        block = week_start(start)
+        while block <= end:
+            block_end = block + pd.Timedelta(weeks=chunk_weeks)
+            data = service.window(max(block, start), min(block_end - pd.Timedelta(1, "ns"), end), field=field, engine=engine)
+            block = block_end
+            if data is None or data.empty:
+                continue
+            if resolution != "1h":
+                with phase("resample"):
+                    buckets = bucket_starts(data["timestamp"], resolution)
+                    data = data[PREDICTED_COLUMNS].groupby(buckets, sort=True).mean()
+                    data.insert(0, "timestamp", pd.to_datetime(data.index.to_numpy(), unit="ns"))
+            yield data.assign(field_id=field)
+
+
+def export_chunks(source="readings", start=None, end=None, sensors=None, fields=None, nodes=None, resolution=None,
+                  engine=None, service=None, chunk_rows=CHUNK_ROWS):
+    """
+    Checks an export and returns its rows, chunk by chunk.
+
+    The arguments are checked right away; the rows are only read as the
+    chunks are consumed.
+
+    Args:
+        source (str): One of ``SOURCES``.
+        start: Start of the range (required for forecasts), or None for the
+            first reading.
+        end: End of the range, included (required for forecasts), or None
+            for the last reading.
+        sensors (list): The sensors to export (all if not given).
+        fields (list): The fields to export (the default field if not
+            given).
+        nodes (list): Only export readings of these nodes (all if not given).
+        resolution (str): One of ``rollups.RESOLUTIONS`` to export bucket
+            statistics, or None for raw readings (forecasts: one of
+            ``FORECAST_RESOLUTIONS``, hourly if not given).
+        engine (str): The forecast engine (``forecasting.get_engine()`` if not
+            given).
+        service (ForecastService): The forecast service
+            (``get_forecast_service()`` if not given).
+        chunk_rows (int): Rows per chunk of raw readings.
+
+    Returns:
+        tuple: The export columns and an iterator of DataFrames holding them.
+
+    Raises:
+        ValueError: If an argument is invalid, or the forecast engine has no
+            models of a field.
+    """
+    _check([source], SOURCES, "source")
+    sensors = list(sensors or SENSORS)
+    _check(sensors, SENSORS, "sensor")
+    fields = list(fields or [get_default_field()])
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    if start is not None and end is not None and end < start:
+        raise ValueError("the end is before the start")
+
+    if source == "forecast":
+        resolution = resolution or "1h"
+        _check([resolution], FORECAST_RESOLUTIONS, "resolution")
+        if start is None or end is None:
+            raise ValueError("a forecast export needs a start and an end")
+        service = service or get_forecast_service()
+        models = service.models(engine)
+        if models is None:
+            raise ValueError("the forecast models are not trained yet")
+        _check(fields, models.fields, "field")
+        columns = export_columns(source, sensors, resolution)
+        chunks = _forecast_chunks(service, fields, start, end, resolution, engine, FORECAST_CHUNK_WEEKS)
+        return columns, (chunk[columns] for chunk in chunks)
+
+    if resolution is not None:
+        _check([resolution], RESOLUTIONS, "resolution")
+    _check(fields, list_fields(), "field")
+    manifest = ensure_store()
+    if resolution is None:
+        chunks = _reading_chunks(manifest, fields, start, end, sensors, nodes, chunk_rows)
+    elif nodes is None:
+        # Missing or stale rollups are rebuilt first, as in ``load_rollup``
+        ensure_rollups()
+        chunks = _rollup_chunks(fields, start, end, resolution)
+    else:
+        chunks = _node_rollup_chunks(manifest, fields, start, end, resolution, nodes)
+    columns = export_columns(source, sensors, resolution)
+    return columns, (chunk[columns] for chunk in chunks)
+
+
+def write_csv(columns, chunks):
+    """
+    Encodes chunks as one CSV file.
+
+    Args:
+        columns (list): The columns, written as the header.
+        chunks: DataFrames with these columns.
+
+    Yields:
+        bytes: The header, then the rows of every chunk.
+    """
+    yield (",".join(columns) + "\n").encode()
+    for chunk in chunks:
+        with phase("encode"):
+            data = chunk.to_csv(header=False, index=False).encode()
+        yield data
+
+
+def write_parquet(columns, chunks):
+    """
+    Encodes chunks as one Parquet file, one row group per chunk.
+
+    Args:
+        columns (list): The columns.
+        chunks: DataFrames with these columns.
+
+    Yields:
+        bytes: The file, as it is written.
+    """
+    schema = _schema(columns)
+    sink = _Sink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for chunk in chunks:
+            with phase("encode"):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        # Writes the footer
+        writer.close()
+    yield sink.drain()
+
+
+def stream_export(fmt="csv", **query):
+    """
+    Checks an export and returns its file, chunk by chunk.
+
+    Args:
+        fmt (str): One of ``EXPORT_FORMATS``.
+        **query: The export, see ``export_chunks``.
+
+    Returns:
+        iterator: The bytes of the file.
+
+    Raises:
+        ValueError: If an argument is invalid (see ``export_chunks``).
+    """
+    _check([fmt], EXPORT_FORMATS, "format")
+    columns, chunks = export_chunks(**query)
+    return write_csv(columns, chunks) if fmt == "csv" else write_parquet(columns, chunks)
+
+
+def export_filename(fmt, source="readings", start=None, end=None, fields=None):
+    """
+    Returns the file name of an export.
+
+    Args:
+        fmt (str): One of ``EXPORT_FORMATS``.
+        source (str): One of ``SOURCES``.
+        start: Start of the range, if any.
+        end: End of the range, if any.
+        fields (list): The exported fields.
+
+    Returns:
+        str: e.g. "readings_prizren_2023-05-01_2023-05-31.csv".
+    """
+    fields = list(fields or [get_default_field()])
+    parts = [source, fields[0] if len(fields) == 1 else "all-fields"]
+    parts += [pd.Timestamp(value).strftime("%Y-%m-%d") for value in (start, end) if value is not None]
+    return "_".join(parts) + "." + fmt
+
+
+def estimate_export_rows(source="readings", start=None, end=None, fields=None, resolution=None):
+    """
+    Estimates the rows of an export without reading any data.
+
+    Args:
+        source (str): One of ``SOURCES``.
+        start: Start of the range, or None for the first reading.
+        end: End of the range, or None for the last reading.
+        fields (list): The exported fields (the default field if not given).
+        resolution (str): The resolution, or None for raw readings.
+
+    Returns:
+        int: The estimated number of rows.
+    """
+    fields = list(fields or [get_default_field()])
+    if source == "forecast":
+        # One prediction per hour
+        span = to_epoch(end) - to_epoch(start) + RESOLUTIONS["1h"]
+        return int(np.ceil(span / RESOLUTIONS[resolution or "1h"])) * len(fields)
+    rows = 0
+    for field in fields:
+        field_rows = estimate_rows(start, end, field)
+        if resolution is not None:
+            first, last = get_time_bounds(field)
+            if first is None:
+                continue
+            span = to_epoch(last if end is None else end) - to_epoch(first if start is None else start)
+            field_rows = min(field_rows, span // RESOLUTIONS[resolution] + 1)
+        rows += field_rows
+    return rows
+
+
+def get_export_url(fmt="csv", **query):
+    """
+    Returns the query service URL streaming an export, for the browser.
+
+    Args:
+        fmt (str): One of ``EXPORT_FORMATS``.
+        **query: The export, see ``export_chunks``.
+
+    Returns:
+        str: The URL, or None if no query service is configured
+        (``QUERY_API_PUBLIC_URL``, the service's address as seen from the
+        browser, or else ``QUERY_API_URL``).
+    """
+    base = os.environ.get("QUERY_API_PUBLIC_URL") or os.environ.get("QUERY_API_URL")
+    if not base:
+        return None
+    params = {"format": fmt}
+    for name, value in query.items():
+        if value is None:
+            continue
+        params[name] = ",".join(map(str, value)) if isinstance(value, (list, tuple)) else str(value)
+    return f"{base.rstrip('/')}/export?{urllib.parse.urlencode(sorted(params.items()))}"
+
+
+def show_export(source, start, end, sensors, field, nodes=None, engine=None):
+    """
+    Shows the export of the selected range in an expander.
+
+    Args:
+        source (str): One of ``SOURCES``.
+        start: Start of the selected range.
+        end: End of the selected range.
+        sensors (list): The selected sensors.
+        field (str): The selected field, or None if the page has no field
+            choice (the default field; "All fields" is not offered).
+        nodes (list): The selected nodes (all if not given).
+        engine (str): The selected forecast engine.
+    """
+    with st.expander("Export"):
+        fmt = st.radio("Format", list(EXPORT_FORMATS), format_func=str.upper, horizontal=True, key=f"export_format_{source}")
+        resolutions = FORECAST_RESOLUTIONS if source == "forecast" else list(RESOLUTION_LABELS)
+        resolution = st.selectbox("Resolution", resolutions, format_func=RESOLUTION_LABELS.get, key=f"export_resolution_{source}")
+        if field is None:
+            fields = [get_default_field()]
+        elif st.checkbox("All fields", key=f"export_all_fields_{source}"):
+            fields = query_client.list_fields()
+        else:
+            fields = [field]
+
+        query = dict(source=source, start=start, end=end, sensors=sensors, fields=fields, nodes=nodes, resolution=resolution)
+        if source == "forecast":
+            query["engine"] = engine
+        filename = export_filename(fmt, source, start, end, fields)
+        url = get_export_url(fmt, **query)
+        if url is not None:
+            # Streamed by the query service, straight from the store
+            st.link_button(f"Download {filename}", url)
+        elif estimate_export_rows(source, start, end, fields, resolution) > INLINE_ROWS:
+            st.info(
+                "This export is too large to prepare in the page. Choose a coarser resolution or a "
+                "shorter range, or start the query service (query_api.py) to stream it."
+            )
+        elif st.button("Prepare download", key=f"export_prepare_{source}"):
+            try:
+                data = b"".join(stream_export(fmt, **query))
+            except ValueError as e:
+                st.error(f"Export failed: {e}")
+                return
+            st.download_button(f"Download {filename}", data, file_name=filename, mime=EXPORT_FORMATS[fmt])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export sensor readings or forecasts as CSV or Parquet.")
+    parser.add_argument("--source", choices=SOURCES, default="readings", help="what to export")
+    parser.add_argument("--start", default=None, help="start of the range (the first reading if not given)")
+    parser.add_argument("--end", default=None, help="end of the range, included (the last reading if not given)")
+    parser.add_argument("--sensors", default=",".join(SENSORS), help="comma-separated sensors")
+    parser.add_argument("--fields", default=None, help='comma-separated fields, or "all" (the default field if not given)')
+    parser.add_argument("--nodes", default=None, help="comma-separated nodes (all if not given)")
+    parser.add_argument("--resolution", default=None, help="bucket statistics per 1min, 1h, 1d or 1w instead of raw readings")
+    parser.add_argument("--engine", default=None, help="forecast engine (FORECAST_ENGINE if not given)")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv", help="file format")
+    parser.add_argument("--output", default=None, help="file to write (named after the export if not given)")
+    args = parser.parse_args()
+
+    if args.fields == "all":
+        fields = list_fields()
+    else:
+        fields = args.fields.split(",") if args.fields else None
+    query = dict(
+        source=args.source,
+        start=args.start,
+        end=args.end,
+        sensors=args.sensors.split(","),
+        fields=fields,
+        nodes=args.nodes.split(",") if args.nodes else None,
+        resolution=args.resolution,
+    )
+    if args.source == "forecast":
+        query["engine"] = args.engine
+        query["service"] = ForecastService()
+    output = args.output or export_filename(args.format, args.source, args.start, args.end, fields)
+
+    started = time.perf_counter()
+    try:
+        chunks = stream_export(args.format, **query)
+    except ValueError as e:
+        parser.exit(1, f"Export failed: {e}\n")
+    size = 0
+    with open(output, "wb") as f:
+        for data in chunks:
+            f.write(data)
+            size += len(data)
+    elapsed = time.perf_counter() - started
+    print(f"Exported {size / 2**20:,.1f} MB to {output} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
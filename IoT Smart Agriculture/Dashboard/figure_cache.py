@@ -0,0 +1,238 @@
+"""
+Shared cache of rendered matplotlib figures.
+
+Pie charts, scatter plots and heatmaps are drawn with matplotlib, which is slow
+and keeps every figure alive until it is closed. Instead of drawing a figure on
+every rerun of every session, pages ask for the rendered image bytes under a
+key describing the chart (chart type, sensor, range, data version). The first
+request draws and renders the figure, closes it, and keeps the bytes; everyone
+else gets the bytes.
+
+The cache is shared by all sessions of the server process, evicts the least
+recently used images and holds at most ``FIGURE_CACHE_MB`` megabytes (64 by
+default). Rendering is serialized because pyplot is not thread-safe, which also
+means concurrent requests for the same chart render it only once.
+
+Large scatter plots are drawn as a density image (see ``scatter_figure``), so
+their render time depends on the image size rather than the number of points.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+import seaborn as sns
+import streamlit as st
+from matplotlib.colors import LogNorm
+
+from timing import cache_miss, cache_request
+
+# Same output as st.pyplot
+RENDER_OPTIONS = {"dpi": 200, "bbox_inches": "tight"}
+
+# Above this many points a scatter plot is drawn as a density image
+SCATTER_POINT_LIMIT = 20000
+
+# Time × value bins of the density image
+DENSITY_BINS = (480, 180)
+
+
+class FigureCache:
+    """
+    Thread-safe LRU cache of image bytes with a memory budget.
+
+    Args:
+        budget (int): Maximum total size of the cached images in bytes.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key):
+        """
+        Returns the image cached under a key and marks it as recently used.
+
+        Args:
+            key (tuple): The chart key.
+
+        Returns:
+            bytes: The image, or None if it is not cached.
+        """
+        with self._lock:
+            data = self._images.get(key)
+            if data is not None:
+                self._images.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """
+        Caches an image, evicting the least recently used ones over budget.
+
+        Images larger than the whole budget are not cached.
+
+        Args:
+            key (tuple): The chart key.
+            data (bytes): The image.
+        """
+        if len(data) > self.budget:
+            return
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._images[key] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= len(evicted)
+
+    def render(self, key, draw, fmt="png"):
+        """
+        Returns the image of a chart, drawing it only on a cache miss.
+
+        Args:
+            key (tuple): The chart key.
+            draw (callable): Builds and returns the matplotlib figure.
+            fmt (str): "png" or "svg".
+
+        Returns:
+            bytes: The rendered image.
+        """
+        key = (fmt,) + tuple(key)
+        cache_request("figure")
+        data = self.get(key)
+        if data is None:
+            with self._render_lock:
+                # Another session may have rendered it while we waited
+                data = self.get(key)
+                if data is None:
+                    self.misses += 1
+                    cache_miss("figure")
+                    data = render_figure(draw_figure(draw), fmt)
+                    self.put(key, data)
+                    return data
+        self.hits += 1
+        return data
+
+
+def draw_figure(draw):
+    """
+    Builds a figure, closing whatever it left open if building it fails.
+
+    Args:
+        draw (callable): Builds and returns the matplotlib figure.
+
+    Returns:
+        matplotlib.figure.Figure: The figure.
+    """
+    open_before = set(plt.get_fignums())
+    try:
+        return draw()
+    except Exception:
+        for number in set(plt.get_fignums()) - open_before:
+            plt.close(number)
+        raise
+
+
+def render_figure(fig, fmt="png"):
+    """
+    Renders a figure to image bytes and closes it.
+
+    Args:
+        fig (matplotlib.figure.Figure): The figure.
+        fmt (str): "png" or "svg".
+
+    Returns:
+        bytes: The rendered image.
+    """
+    try:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=fmt, **RENDER_OPTIONS)
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def scatter_figure(data, column, max_points=SCATTER_POINT_LIMIT):
+    """
+    Draws a value-over-time scatter plot.
+
+    Up to ``max_points`` readings are drawn as markers. Beyond that the
+    readings are binned into a time × value grid with ``numpy.histogram2d``
+    and the counts are drawn as an image (log color scale, empty bins left
+    blank), which looks like a dense scatter plot but costs the same to render
+    for any number of readings.
+
+    Args:
+        data (pandas.DataFrame): Readings with a ``timestamp`` column.
+        column (str): The value column.
+        max_points (int): Largest number of readings drawn as markers.
+
+    Returns:
+        matplotlib.figure.Figure: The figure.
+    """
+    fig, ax = plt.subplots()
+    values = data[column].to_numpy(dtype="float64")
+    present = ~np.isnan(values)
+    # Compact frames keep int64 epochs; both views work for datetime64 columns
+    timestamps = data["timestamp"].to_numpy(dtype="datetime64[ns]")
+    if present.sum() <= max_points:
+        sns.scatterplot(x=timestamps, y=values, ax=ax)
+        ax.set_xlabel("timestamp")
+        ax.set_ylabel(column)
+        return fig
+
+    epochs = timestamps.view("int64")[present]
+    counts, time_edges, value_edges = np.histogram2d(epochs, values[present], bins=DENSITY_BINS)
+    start, end = mdates.date2num(time_edges[[0, -1]].astype("int64").astype("datetime64[ns]"))
+    image = ax.imshow(
+        np.ma.masked_equal(counts.T, 0),
+        origin="lower",
+        aspect="auto",
+        interpolation="nearest",
+        extent=(start, end, value_edges[0], value_edges[-1]),
+        norm=LogNorm(),
+    )
+    ax.xaxis_date()
+    fig.autofmt_xdate()
+    ax.set_xlabel("timestamp")
+    ax.set_ylabel(column)
+    fig.colorbar(image, ax=ax, label="readings")
+    return fig
+
+
+@st.cache_resource
+def get_figure_cache():
+    """
+    Returns the figure cache shared by all sessions of this server process.
+
+    Returns:
+        FigureCache: The cache.
+    """
+    return FigureCache(int(float(os.environ.get("FIGURE_CACHE_MB", 64)) * 2**20))
+
+
+def show_figure(key, draw, fmt="png"):
+    """
+    Displays a chart from the figure cache.
+
+    Args:
+        key (tuple): Describes the chart: chart type, sensor, range and data
+            version, so the key changes whenever the image would.
+        draw (callable): Builds and returns the matplotlib figure on a miss.
+        fmt (str): "png" or "svg".
+    """
+    data = get_figure_cache().render(key, draw, fmt)
+    st.image(data.decode() if fmt == "svg" else data, use_column_width=True)
@@ -0,0 +1,225 @@
+"""
+Background forecast scheduler.
+
+Fitting the Prophet models takes minutes, so it never runs inside a page
+script. The scheduler runs ``train_models`` in a background thread (the
+fitting itself happens in the worker processes of ``forecasting``):
+
+* when the models have not been trained yet,
+* when the sensor store changed since the last training, and
+* when the models are older than ``FORECAST_INTERVAL`` seconds (6 hours by
+  default).
+
+These are checked every ``poll`` seconds. New readings are written by other
+processes (``ingest.py``, ``backfill.py``), so they are noticed through the
+store manifest at the next check rather than signalled. A failed training
+is logged and kept in ``last_error`` for the forecast page.
+
+The models are replaced atomically in the model registry; pages predict the
+window they show from them (see ``forecast_service``) and show how old they
+are.
+
+Inside the dashboard the scheduler is started once per server process by
+``get_scheduler()``. It can also run as a separate worker process::
+
+    python forecast_scheduler.py
+
+in which case set ``FORECAST_SCHEDULER=off`` for the dashboard. Dashboards
+using the query service (``QUERY_API_URL``) leave the training to it.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import streamlit as st
+
+import model_registry
+from forecasting import PROPHET_PARAMS, train_models
+from sensor_store import SENSORS, get_manifest_path, get_store_dir
+
+logger = logging.getLogger(__name__)
+
+
+def store_signature():
+    """
+    Returns a value that changes whenever the sensor store changes.
+
+    Returns:
+        str: Hash of the store manifest ("" if there is no store yet).
+    """
+    try:
+        with open(get_manifest_path(), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return ""
+
+
+def get_state_path():
+    """
+    Returns the path of the scheduler state file.
+
+    Returns:
+        str: The absolute path to ``store/forecast.json``.
+    """
+    return os.path.join(get_store_dir(), "forecast.json")
+
+
+def read_state():
+    """
+    Reads the state of the last successful training.
+
+    Returns:
+        dict: The store signature the models were trained on and when the
+        training ended (``trained_at``), or None if nothing was recorded yet.
+    """
+    try:
+        with open(get_state_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_state(signature, trained_at):
+    """
+    Records a successful training, replacing the state file atomically.
+
+    Args:
+        signature (str): The store signature the models were trained on.
+        trained_at (float): When the training ended (seconds since the epoch).
+    """
+    path = get_state_path()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"store_signature": signature, "trained_at": trained_at}, f)
+    os.replace(tmp_path, path)
+
+
+def forecast_age():
+    """
+    Returns how long ago the Prophet models were last trained.
+
+    A training that finds the data unchanged reuses the stored models (see
+    ``model_registry.fit_model``) but still counts as a training, so the age
+    comes from the state file rather than from the model files. Models
+    trained before the state file existed are aged by their oldest file.
+
+    Returns:
+        float: Age in seconds, or None if a sensor has no model yet.
+    """
+    trained = [model_registry.trained_at(sensor, PROPHET_PARAMS) for sensor in SENSORS]
+    if any(mtime is None for mtime in trained):
+        return None
+    state = read_state()
+    if state is not None and "trained_at" in state:
+        last_trained = state["trained_at"]
+    else:
+        last_trained = min(trained)
+    return max(time.time() - last_trained, 0.0)
+
+
+def format_age(seconds):
+    """
+    Formats an age for display.
+
+    Args:
+        seconds (float): The age in seconds.
+
+    Returns:
+        str: E.g. "5 minutes", "3 hours" or "2 days".
+    """
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+    return "less than a minute"
+
+
+class ForecastScheduler:
+    """
+    Retrains the forecast models in a background thread.
+
+    Args:
+        interval (float): Maximum model age in seconds.
+        poll (float): How often to check whether a new training is due.
+    """
+
+    def __init__(self, interval=None, poll=60.0):
+        self.interval = float(interval or os.environ.get("FORECAST_INTERVAL", 6 * 3600))
+        self.poll = poll
+        self.running = False
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="forecast-scheduler", daemon=True)
+
+    def start(self):
+        """
+        Starts the background thread.
+        """
+        self._thread.start()
+
+    def is_due(self):
+        """
+        Tells whether the models should be retrained.
+
+        Returns:
+            bool: True if the models are missing, stale or based on older data.
+        """
+        age = forecast_age()
+        if age is None or age > self.interval:
+            return True
+        state = read_state()
+        if state is None:
+            # Models trained before the scheduler existed: adopt them
+            write_state(store_signature(), time.time() - age)
+            return False
+        return state["store_signature"] != store_signature()
+
+    def run_once(self):
+        """
+        Trains the models and stores them in the model registry.
+        """
+        with self._lock:
+            self.running = True
+            try:
+                signature = store_signature()
+                train_models(engine="prophet")
+                write_state(signature, time.time())
+                self.last_error = None
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.exception("Forecast training failed")
+            finally:
+                self.running = False
+
+    def _loop(self):
+        while True:
+            if self.is_due():
+                self.run_once()
+            time.sleep(self.poll)
+
+
+@st.cache_resource
+def get_scheduler():
+    """
+    Returns the scheduler of this server process, starting it on first use.
+
+    Returns:
+        ForecastScheduler: The scheduler, or None if ``FORECAST_SCHEDULER`` is
+        "off" (a separate worker process trains the models) or the dashboard
+        uses the query service (``QUERY_API_URL``), which trains them.
+    """
+    if os.environ.get("FORECAST_SCHEDULER", "on") == "off" or os.environ.get("QUERY_API_URL"):
+        return None
+    scheduler = ForecastScheduler()
+    scheduler.start()
+    return scheduler
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    worker = ForecastScheduler()
+    print(f"Training forecast models into {model_registry.get_registry_dir()}")
+    worker._loop()
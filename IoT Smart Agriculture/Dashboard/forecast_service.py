@@ -0,0 +1,269 @@
+"""
+Forecasts for any time window, predicted on demand from the fitted models.
+
+Pages ask for the window they show::
+
+    predictions = get_forecast_service().window(start, end, field=field)
+
+The window is split into calendar weeks (Monday 00:00 to the next Monday).
+Each week is predicted hourly the first time it is asked for and kept in a
+bounded LRU cache shared by all sessions, so moving the window only predicts
+the weeks that are new to it, and no hour is predicted before someone looks
+at it. The weeks missing from a window are predicted in one call per model.
+
+The models come from the forecast engine (see ``forecasting``):
+
+* "prophet": the Prophet model of every sensor of the default field, as
+  trained into the model registry by ``forecast_scheduler``,
+* "harmonic": the harmonic regression of every sensor of every field, fitted
+  from the store in one pass whenever its data version changes.
+
+Cached weeks are keyed by the engine, field, model version and week, so
+retrained models never serve predictions of their predecessors.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import harmonic_forecast
+import model_registry
+from forecasting import PROPHET_PARAMS, get_engine, harmonic_models
+from sensor_store import SENSORS, TimeIndex, get_data_version, get_default_field
+from timing import cache_miss, cache_request, phase
+
+# Weeks of predictions kept in memory (a week is 168 rows, about 8 KB)
+MAX_WEEKS = 1024
+
+HOURS_PER_WEEK = 7 * 24
+
+# Columns of the predictions, after the timestamp
+PREDICTED_COLUMNS = [sensor + "_predicted" for sensor in SENSORS]
+
+
+def week_start(timestamp):
+    """
+    Returns the start of the calendar week of a timestamp.
+
+    Args:
+        timestamp: The timestamp (anything ``pandas.Timestamp`` accepts).
+
+    Returns:
+        pandas.Timestamp: Monday 00:00 of its week.
+    """
+    day = pd.Timestamp(timestamp).normalize()
+    return day - pd.Timedelta(days=day.weekday())
+
+
+class ProphetModels:
+    """
+    The registry's Prophet models of the default field.
+
+    Args:
+        models (dict): The fitted model per sensor.
+        version (tuple): Fingerprints of the models' training windows.
+    """
+
+    def __init__(self, models, version):
+        self.models = models
+        self.version = version
+        self.fields = {get_default_field()}
+        for model in models.values():
+            # Only ``yhat`` is used; skip simulating the uncertainty intervals
+            model.uncertainty_samples = 0
+
+    def predict(self, field, timestamps):
+        """
+        Predicts every sensor of a field.
+
+        Args:
+            field (str): The field.
+            timestamps (pandas.DatetimeIndex): The hours to predict.
+
+        Returns:
+            numpy.ndarray: One column per sensor.
+        """
+        future = pd.DataFrame({"ds": timestamps})
+        return np.column_stack([self.models[sensor].predict(future)["yhat"].to_numpy() for sensor in SENSORS])
+
+
+class HarmonicModels:
+    """
+    The harmonic regressions of every field.
+
+    Args:
+        origin (int): The trend origin of the coefficients.
+        coefficients (dict): The coefficients per field.
+        version (int): The store's data version they were fitted on.
+    """
+
+    def __init__(self, origin, coefficients, version):
+        self.origin = origin
+        self.coefficients = coefficients
+        self.version = version
+        self.fields = set(coefficients)
+
+    def predict(self, field, timestamps):
+        """
+        Predicts every sensor of a field.
+
+        Args:
+            field (str): The field.
+            timestamps (pandas.DatetimeIndex): The hours to predict.
+
+        Returns:
+            numpy.ndarray: One column per sensor.
+        """
+        return harmonic_forecast.predict(self.coefficients[field], timestamps.asi8, self.origin)
+
+
+def load_prophet_models():
+    """
+    Loads the Prophet models of the default field from the model registry.
+
+    Returns:
+        ProphetModels: The models, or None if a sensor has no model yet.
+    """
+    entries = [model_registry.read_entry(sensor, PROPHET_PARAMS) for sensor in SENSORS]
+    if any(entry is None for entry in entries):
+        return None
+    models = {sensor: model_registry.load_model(sensor, PROPHET_PARAMS) for sensor in SENSORS}
+    return ProphetModels(models, tuple(entry["fingerprint"] for entry in entries))
+
+
+class ForecastService:
+    """
+    Thread-safe, week-chunked cache of predictions.
+
+    Args:
+        max_weeks (int): Maximum number of cached weeks.
+    """
+
+    def __init__(self, max_weeks=MAX_WEEKS):
+        self.max_weeks = max_weeks
+        self._weeks = OrderedDict()
+        self._models = {}
+        self._lock = threading.Lock()
+        self._models_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._weeks)
+
+    def models(self, engine=None):
+        """
+        Returns the current models of an engine, reloading or refitting them
+        when they changed.
+
+        Args:
+            engine (str): One of ``forecasting.ENGINES`` (``get_engine()`` if
+                not given).
+
+        Returns:
+            ProphetModels or HarmonicModels: The models, or None if they were
+            not trained yet.
+        """
+        engine = engine or get_engine()
+        with self._models_lock:
+            current = self._models.get(engine)
+            if engine == "harmonic":
+                version = get_data_version()
+                if current is None or current.version != version:
+                    cache_miss("forecast_model")
+                    origin, coefficients = harmonic_models()
+                    current = self._models[engine] = HarmonicModels(origin, coefficients, version)
+                return current
+
+            entries = [model_registry.read_entry(sensor, PROPHET_PARAMS) for sensor in SENSORS]
+            if any(entry is None for entry in entries):
+                return None
+            if current is None or current.version != tuple(entry["fingerprint"] for entry in entries):
+                cache_miss("forecast_model")
+                with phase("load"):
+                    current = self._models[engine] = load_prophet_models()
+            return current
+
+    def _get(self, key):
+        with self._lock:
+            chunk = self._weeks.get(key)
+            if chunk is not None:
+                self._weeks.move_to_end(key)
+            return chunk
+
+    def _put(self, key, chunk):
+        with self._lock:
+            self._weeks[key] = chunk
+            self._weeks.move_to_end(key)
+            while len(self._weeks) > self.max_weeks:
+                self._weeks.popitem(last=False)
+
+    def _predict_weeks(self, models, field, weeks):
+        # Every missing week in one call per model
+        timestamps = pd.DatetimeIndex(np.concatenate([
+            pd.date_range(week, periods=HOURS_PER_WEEK, freq="h").asi8 for week in weeks
+        ]))
+        with phase("predict"):
+            values = models.predict(field, timestamps)
+        chunks = []
+        for i in range(len(weeks)):
+            rows = slice(i * HOURS_PER_WEEK, (i + 1) * HOURS_PER_WEEK)
+            chunk = pd.DataFrame(values[rows], columns=PREDICTED_COLUMNS)
+            chunk.insert(0, "timestamp", timestamps[rows])
+            chunks.append(chunk)
+        return chunks
+
+    def window(self, start, end, field=None, engine=None):
+        """
+        Returns hourly predictions for a time window.
+
+        Args:
+            start: Start of the window (anything ``pandas.Timestamp``
+                accepts, naive local time).
+            end: End of the window, included.
+            field (str): The field (the default field if not given).
+            engine (str): One of ``forecasting.ENGINES`` (``get_engine()`` if
+                not given).
+
+        Returns:
+            pandas.DataFrame: ``timestamp`` and a ``<sensor>_predicted``
+            column per sensor, or None if the engine has no models of the
+            field yet.
+        """
+        engine = engine or get_engine()
+        field = field or get_default_field()
+        models = self.models(engine)
+        if models is None or field not in models.fields:
+            return None
+
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        weeks = list(pd.date_range(week_start(start), week_start(end), freq="7D"))
+        chunks = {}
+        for week in weeks:
+            cache_request("forecast_week")
+            chunk = self._get((engine, field, models.version, week))
+            if chunk is not None:
+                chunks[week] = chunk
+        missing = [week for week in weeks if week not in chunks]
+        if missing:
+            for week, chunk in zip(missing, self._predict_weeks(models, field, missing)):
+                cache_miss("forecast_week")
+                self._put((engine, field, models.version, week), chunk)
+                chunks[week] = chunk
+
+        with phase("filter"):
+            data = pd.concat([chunks[week] for week in weeks], ignore_index=True)
+            rows = TimeIndex(data["timestamp"]).slice(start, end)
+            return data.iloc[rows].reset_index(drop=True)
+
+
+@st.cache_resource
+def get_forecast_service():
+    """
+    Returns the forecast service shared by all sessions of this server
+    process.
+
+    Returns:
+        ForecastService: The service.
+    """
+    return ForecastService()
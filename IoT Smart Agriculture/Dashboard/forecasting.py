@@ -0,0 +1,289 @@
+"""
+Training of the sensor forecast models.
+
+Two engines are available, chosen with the ``FORECAST_ENGINE`` environment
+variable or ``--engine``:
+
+* "prophet" (the default): a Prophet model per sensor, as described below,
+* "harmonic": a harmonic regression of every sensor in one NumPy pass (see
+  ``harmonic_forecast``); it fits in milliseconds instead of minutes, without
+  cmdstan, so it is fitted on demand for every field.
+
+Only the models are trained here. Predictions are made from them for the
+window a page asks for (see ``forecast_service``); ``--output`` exports a
+window of predictions to a CSV file.
+
+Each sensor gets its own Prophet model. Fitting one model is single-threaded
+Stan, so the models are fitted concurrently in a process pool, one job per
+series. Jobs are keyed by an arbitrary key (a sensor name today), so the same
+pool scales out to many fields × sensors. Fitted models are kept in the model
+registry (see ``model_registry``), so unchanged series are not refitted.
+
+The number of worker processes defaults to the number of CPU cores and can be
+set with the ``FORECAST_WORKERS`` environment variable.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import harmonic_forecast
+import model_registry
+from sensor_store import SENSORS, list_fields, load_readings
+from timing import cache_miss, cache_request, observe, phase
+
+logger = logging.getLogger(__name__)
+
+# Hyperparameters of every sensor model
+PROPHET_PARAMS = {
+    "changepoint_prior_scale": 0.05,
+    "seasonality_prior_scale": 10,
+    "yearly_seasonality": True,
+    "daily_seasonality": True,
+}
+
+# Forecast engines
+ENGINES = ("prophet", "harmonic")
+
+
+def get_worker_count():
+    """
+    Returns the number of worker processes used for fitting.
+
+    Returns:
+        int: The ``FORECAST_WORKERS`` environment variable, or the CPU count.
+    """
+    return int(os.environ.get("FORECAST_WORKERS", os.cpu_count() or 1))
+
+
+def get_engine():
+    """
+    Returns the forecast engine used when none is chosen explicitly.
+
+    Returns:
+        str: The ``FORECAST_ENGINE`` environment variable, "prophet" by
+        default.
+
+    Raises:
+        ValueError: If the variable names an unknown engine.
+    """
+    engine = os.environ.get("FORECAST_ENGINE", "prophet")
+    if engine not in ENGINES:
+        raise ValueError(f"unknown forecast engine {engine!r}, expected one of {', '.join(ENGINES)}")
+    return engine
+
+
+def prepare_hourly(data):
+    """
+    Forward fills missing readings and resamples them to hourly averages.
+
+    Args:
+        data (pandas.DataFrame): Readings with a ``timestamp`` column.
+
+    Returns:
+        pandas.DataFrame: Hourly averages with a ``timestamp`` column.
+    """
+    data = data.ffill()
+    return data.set_index("timestamp").resample("h").mean().reset_index()
+
+
+def training_frame(hourly_data, sensor):
+    """
+    Builds the Prophet training frame of one sensor, without IQR outliers.
+
+    Args:
+        hourly_data (pandas.DataFrame): Hourly averages.
+        sensor (str): The sensor column.
+
+    Returns:
+        pandas.DataFrame: A frame with ``ds`` and ``y`` columns.
+    """
+    sensor_data = pd.DataFrame({"ds": hourly_data["timestamp"], "y": hourly_data[sensor]})
+
+    # Remove outliers using IQR
+    q1 = sensor_data["y"].quantile(0.25)
+    q3 = sensor_data["y"].quantile(0.75)
+    iqr = q3 - q1
+    return sensor_data[(sensor_data["y"] >= (q1 - 1.5 * iqr)) & (sensor_data["y"] <= (q3 + 1.5 * iqr))]
+
+
+def train_model(key, sensor_data, params=PROPHET_PARAMS):
+    """
+    Fits one Prophet model and stores it in the model registry.
+
+    The stored model is reused when the training window did not change, and
+    warm-started when it did. This runs inside a worker process, so it only
+    takes and returns plain, picklable values.
+
+    Args:
+        key: Identifies the series (e.g. the sensor name).
+        sensor_data (pandas.DataFrame): Training frame with ``ds`` and ``y``.
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        tuple: The key and a dict with the fit time in seconds and how the
+        model was obtained.
+    """
+    started = time.perf_counter()
+    _, status = model_registry.fit_model(key, sensor_data, params)
+    return key, {"fit": time.perf_counter() - started, "status": status}
+
+
+def fit_all(jobs, workers=None):
+    """
+    Fits every job concurrently in a process pool.
+
+    Args:
+        jobs (dict): Training frame per key.
+        workers (int): Number of worker processes (``get_worker_count()`` if
+            not given). With one worker the jobs run in this process.
+
+    Returns:
+        dict: The timings per key.
+    """
+    workers = min(workers or get_worker_count(), len(jobs)) or 1
+    timings = {}
+    if workers == 1:
+        for key, sensor_data in jobs.items():
+            _, timings[key] = train_model(key, sensor_data)
+        return timings
+
+    # "spawn" keeps the workers independent of the Streamlit server's threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(train_model, key, sensor_data) for key, sensor_data in jobs.items()]
+        for future in as_completed(futures):
+            key, timing = future.result()
+            timings[key] = timing
+    return timings
+
+
+def report_timings(timings, wall_time):
+    """
+    Logs the fit time of every model.
+
+    Args:
+        timings (dict): Timing dict per key.
+        wall_time (float): Total wall time of the training run in seconds.
+    """
+    for key, timing in sorted(timings.items()):
+        logger.info("%s: %s fit %.1fs", key, timing["status"], timing["fit"])
+    busy = sum(timing["fit"] for timing in timings.values())
+    logger.info("Trained %d models in %.1fs wall time (%.1fs of model time)", len(timings), wall_time, busy)
+
+
+def harmonic_models(fields=None):
+    """
+    Fits every sensor of the given fields with the harmonic engine, in one
+    pass.
+
+    Args:
+        fields (list): The field ids (every field of the store if not given).
+
+    Returns:
+        tuple: The trend origin and the coefficients per field (see
+        ``harmonic_forecast.fit_fields``).
+    """
+    fields = list_fields() if fields is None else fields
+    with phase("load"):
+        readings = {field: load_readings(columns=SENSORS, compact=False, field=field) for field in fields}
+    with phase("resample"):
+        hourly = {field: prepare_hourly(data) for field, data in readings.items()}
+    with phase("fit"):
+        return harmonic_forecast.fit_fields(hourly, SENSORS)
+
+
+def train_models(workers=None, engine=None):
+    """
+    Fits the Prophet model of every sensor of the default field (all of its
+    nodes, averaged per hour) and stores them in the model registry.
+
+    Harmonic models fit in milliseconds and are fitted on demand, so there
+    is nothing to train ahead for that engine.
+
+    Args:
+        workers (int): Number of worker processes.
+        engine (str): One of ``ENGINES`` (``get_engine()`` if not given).
+
+    Returns:
+        dict: The timings per sensor (empty for the harmonic engine).
+    """
+    engine = engine or get_engine()
+    if engine == "harmonic":
+        return {}
+    with phase("load"):
+        readings = load_readings(columns=SENSORS, compact=False)
+    with phase("resample"):
+        hourly_data = prepare_hourly(readings)
+
+    started = time.perf_counter()
+    jobs = {sensor: training_frame(hourly_data, sensor) for sensor in SENSORS}
+    timings = fit_all(jobs, workers)
+    report_timings(timings, time.perf_counter() - started)
+    # The models are fitted in worker processes, which report their own timings
+    for timing in timings.values():
+        cache_request("forecast_model")
+        if timing["status"] in ("warm", "cold"):
+            cache_miss("forecast_model")
+        observe("fit", timing["fit"])
+    return timings
+
+
+def export_predictions(output_path, start, end, engine=None, field=None):
+    """
+    Writes hourly predictions of a time window to a CSV file.
+
+    The CSV is replaced atomically.
+
+    Args:
+        output_path (str): Where to write the predictions CSV.
+        start: Start of the window (anything ``pandas.Timestamp`` accepts).
+        end: End of the window, included.
+        engine (str): One of ``ENGINES`` (``get_engine()`` if not given).
+        field (str): The field (the default field if not given).
+
+    Returns:
+        pandas.DataFrame: The predictions.
+
+    Raises:
+        RuntimeError: If the engine's models were not trained yet.
+    """
+    from forecast_service import ForecastService
+
+    prediction_data = ForecastService().window(start, end, field=field, engine=engine)
+    if prediction_data is None:
+        raise RuntimeError("the forecast models are not trained yet")
+
+    # Write next to the destination and move into place, so readers never see a partial file
+    tmp_path = output_path + ".tmp"
+    prediction_data.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    print(f"Predictions complete. The result is saved in {output_path}")
+    return prediction_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the sensor forecast models.")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--engine", choices=ENGINES, default=None, help="forecast engine (default: FORECAST_ENGINE or prophet)")
+    parser.add_argument("--output", help="also write hourly predictions to this CSV file")
+    parser.add_argument("--start", default=None, help="first day of the exported predictions (default: today)")
+    parser.add_argument("--end", default=None, help="last day of the exported predictions (default: a year after --start)")
+    parser.add_argument("--field", default=None, help="field of the exported predictions (default: the default field)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    train_models(args.workers, args.engine)
+    if args.output:
+        start = pd.Timestamp(args.start) if args.start else pd.Timestamp.now().normalize()
+        # The last day is included up to its last hour
+        last_day = pd.Timestamp(args.end) if args.end else start + pd.Timedelta(days=364)
+        end = last_day + pd.Timedelta(hours=23)
+        export_predictions(args.output, start, end, args.engine, args.field)
+
+
+if __name__ == "__main__":
+    main()
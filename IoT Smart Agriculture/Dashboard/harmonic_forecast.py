@@ -0,0 +1,158 @@
+"""
+Harmonic regression forecasts, a fast alternative to Prophet.
+
+Every series is modelled as a level and a linear trend plus daily and yearly
+Fourier terms (Prophet's additive model without changepoints)::
+
+    y(t) = a + b·t + Σk [c_k sin(2πk·t/day) + d_k cos(2πk·t/day)]
+                   + Σk [e_k sin(2πk·t/year) + f_k cos(2πk·t/year)]
+
+All series share one hourly design matrix, so every sensor of every field is
+fitted in one pass: a masked, batched least squares solve of the normal
+equations (missing hours and IQR outliers are masked out per series). A ridge
+term keeps the yearly terms stable on histories shorter than a year.
+Fitting the five sensors of a field and predicting a year of hourly values
+takes a few milliseconds, so the forecast can be refreshed on every ingest.
+"""
+import warnings
+
+import numpy as np
+
+HOUR = 3600 * 10**9
+HOURS_PER_DAY = 24
+HOURS_PER_YEAR = 24 * 365.25
+
+# Fourier terms of the daily and yearly cycles
+DAILY_HARMONICS = 4
+YEARLY_HARMONICS = 3
+
+# Ridge penalty on every coefficient but the level, relative to the number of
+# hours fitted (the sample history covers only five months of the year; a
+# weaker penalty lets the yearly terms swing far outside the observed range
+# in the months without data)
+RIDGE = 0.1
+
+# Hours further than this many interquartile ranges outside the quartiles
+# are not fitted (as in ``forecasting.training_frame``)
+IQR_FENCE = 1.5
+
+
+def design_matrix(timestamps, origin, daily_harmonics=DAILY_HARMONICS, yearly_harmonics=YEARLY_HARMONICS):
+    """
+    Builds the regression inputs of hourly timestamps.
+
+    The cycles follow the absolute time, so every series sees the same
+    calendar; the trend is counted in years from ``origin``.
+
+    Args:
+        timestamps (numpy.ndarray): Times in epoch nanoseconds.
+        origin (int): Start of the trend in epoch nanoseconds.
+        daily_harmonics (int): Fourier terms of the daily cycle.
+        yearly_harmonics (int): Fourier terms of the yearly cycle.
+
+    Returns:
+        numpy.ndarray: One row per timestamp: level, trend, daily and yearly
+        sine and cosine terms.
+    """
+    hours = timestamps / HOUR
+    columns = [np.ones(len(timestamps)), (timestamps - origin) / HOUR / HOURS_PER_YEAR]
+    for period, harmonics in ((HOURS_PER_DAY, daily_harmonics), (HOURS_PER_YEAR, yearly_harmonics)):
+        for k in range(1, harmonics + 1):
+            angle = 2 * np.pi * k * hours / period
+            columns += [np.sin(angle), np.cos(angle)]
+    return np.column_stack(columns)
+
+
+def fit(timestamps, values, origin, daily_harmonics=DAILY_HARMONICS, yearly_harmonics=YEARLY_HARMONICS, ridge=RIDGE):
+    """
+    Fits every column of ``values`` at once.
+
+    Args:
+        timestamps (numpy.ndarray): Hourly times in epoch nanoseconds.
+        values (numpy.ndarray): One column per series, NaN where missing.
+        origin (int): Start of the trend in epoch nanoseconds.
+        daily_harmonics (int): Fourier terms of the daily cycle.
+        yearly_harmonics (int): Fourier terms of the yearly cycle.
+        ridge (float): Penalty on every coefficient but the level.
+
+    Returns:
+        numpy.ndarray: The coefficients, one row per series (NaN for series
+        with too few hours to fit).
+    """
+    x = design_matrix(timestamps, origin, daily_harmonics, yearly_harmonics)
+    with warnings.catch_warnings():
+        # Series without any value are left unfitted
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1, q3 = np.nanquantile(values, [0.25, 0.75], axis=0)
+    fence = IQR_FENCE * (q3 - q1)
+    with np.errstate(invalid="ignore"):
+        mask = (values >= q1 - fence) & (values <= q3 + fence)
+    weights = mask.astype("float64")
+    y = np.where(mask, values, 0.0)
+
+    # Normal equations of every series: (X' W X + λI) β = X' W y, with the
+    # X' W X of all series as one matrix product over the hourly outer products
+    outer = (x[:, :, None] * x[:, None, :]).reshape(len(x), -1)
+    lhs = (weights.T @ outer).reshape(-1, x.shape[1], x.shape[1])
+    rhs = (x.T @ y).T
+    counts = weights.sum(axis=0)
+    penalty = np.full(x.shape[1], ridge)
+    penalty[0] = 0.0
+    lhs += counts[:, None, None] * np.diag(penalty)
+
+    coefficients = np.full((values.shape[1], x.shape[1]), np.nan)
+    fitted = counts >= x.shape[1]
+    if fitted.any():
+        coefficients[fitted] = np.linalg.solve(lhs[fitted], rhs[fitted][:, :, None])[:, :, 0]
+    return coefficients
+
+
+def predict(coefficients, timestamps, origin, daily_harmonics=DAILY_HARMONICS, yearly_harmonics=YEARLY_HARMONICS):
+    """
+    Evaluates fitted series at the given times.
+
+    Args:
+        coefficients (numpy.ndarray): Coefficients from ``fit``.
+        timestamps (numpy.ndarray): Times in epoch nanoseconds.
+        origin (int): The origin the coefficients were fitted with.
+        daily_harmonics (int): Fourier terms the coefficients were fitted
+            with.
+        yearly_harmonics (int): Fourier terms the coefficients were fitted
+            with.
+
+    Returns:
+        numpy.ndarray: One column of predictions per series.
+    """
+    return design_matrix(timestamps, origin, daily_harmonics, yearly_harmonics) @ coefficients.T
+
+
+def fit_fields(hourly_by_field, columns):
+    """
+    Fits the given columns of every field in one pass.
+
+    Args:
+        hourly_by_field (dict): Hourly averages (with a ``timestamp`` column)
+            per field.
+        columns (list): The series to fit, e.g. ``SENSORS``.
+
+    Returns:
+        tuple: The trend origin in epoch nanoseconds (None if no field has
+        data) and, per field with data, the coefficients of its columns.
+    """
+    fields = [field for field, hourly in hourly_by_field.items() if not hourly.empty]
+    if not fields:
+        return None, {}
+    # One hourly grid covering every field; each series is missing outside its field
+    starts = {field: hourly_by_field[field]["timestamp"].iloc[0].value for field in fields}
+    origin = min(starts.values())
+    end = max(hourly_by_field[field]["timestamp"].iloc[-1].value for field in fields)
+    grid = np.arange(origin, end + HOUR, HOUR, dtype="int64")
+    values = np.full((len(grid), len(fields) * len(columns)), np.nan)
+    for i, field in enumerate(fields):
+        hourly = hourly_by_field[field]
+        rows = (hourly["timestamp"].to_numpy("datetime64[ns]").view("int64") - origin) // HOUR
+        values[rows, i * len(columns):(i + 1) * len(columns)] = hourly[columns].to_numpy("float64")
+
+    coefficients = fit(grid, values, origin)
+    return origin, {field: coefficients[i * len(columns):(i + 1) * len(columns)] for i, field in enumerate(fields)}
+
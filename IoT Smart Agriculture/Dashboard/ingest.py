@@ -0,0 +1,266 @@
+"""
+HTTP ingestion service for new sensor readings.
+
+The sensor nodes (or a gateway in front of them) POST batches of readings to
+this service. Every reading names its field and node (``field_id`` and
+``node_id``, defaulting to the single field and node of the original
+deployment). Every batch is deduplicated on node and timestamp, appended to
+the sensor store as a new part file per field and month, checked for
+anomalies and folded into that field's rollups, so the dashboard only reloads
+the fields, partitions and rollup files that changed.
+
+Run it next to the dashboard::
+
+    python ingest.py --port 8502
+
+and send readings as JSON::
+
+    curl -X POST localhost:8502/readings -H "Content-Type: application/json" \\
+        -d '[{"timestamp": "2023-09-03 22:04:00", "field_id": "prizren",
+              "node_id": "node-1", "TC": 18.2, "HUM": 81.0,
+              "PRES": 97102.4, "US": 25.0, "SOIL1": 1222.5}]'
+
+or as CSV with the same header as ``cleaned_data.csv`` (plus the optional
+``field_id`` and ``node_id`` columns).
+"""
+import argparse
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from anomalies import get_detector_path, read_detector, save_detector, save_flags
+from correlation_engine import get_engine_path, read_engine
+from rollups import ensure_rollups, update_rollups
+from running_stats import get_stats_path, read_stats, save_stats
+from sensor_store import SENSORS, append_readings, compact_partition, ensure_store, get_partitions, list_fields, partition_keys, store_lock, with_ids
+
+# Local time zone of the readings (timestamps are stored as naive local time)
+LOCAL_TZ = "Europe/Belgrade"
+
+# Compact a partition once it has collected this many part files
+MAX_PARTS = 64
+
+# Largest request body accepted (larger histories go through backfill.py)
+MAX_BODY_BYTES = 16 * 2**20
+
+# A timestamp ending in a UTC offset, e.g. "+02:00" or "Z"
+OFFSET_PATTERN = r"(?:Z|[+-]\d{2}:?\d{2})$"
+
+# Only one batch is written at a time
+write_lock = threading.Lock()
+
+# Running statistics, correlation partials and anomaly detectors per field,
+# loaded on the first batch of a field and kept in memory
+running_stats = {}
+correlation = {}
+anomaly_detectors = {}
+
+# Version of the saved states each field's in-memory copies match
+loaded_versions = {}
+
+
+def state_version(manifest, field):
+    """
+    Returns the version of the saved states of a field.
+
+    It changes when the store is imported again (``source_mtime``) and when
+    another process (e.g. ``backfill.py``) rewrites one of the state files.
+
+    Args:
+        manifest (dict): The store manifest.
+        field (str): The field id.
+
+    Returns:
+        tuple: The store generation and the modification time of every state
+        file (None for a missing file).
+    """
+    mtimes = []
+    for path in (get_stats_path(field), get_engine_path(field), get_detector_path(field)):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return (manifest.get("source_mtime"), *mtimes)
+
+
+def load_states(field, manifest):
+    """
+    Loads the states of a field, unless the in-memory copies are current.
+
+    Args:
+        field (str): The field id.
+        manifest (dict): The store manifest.
+    """
+    if field in running_stats and loaded_versions.get(field) == state_version(manifest, field):
+        return
+    running_stats[field] = read_stats(field)
+    correlation[field] = read_engine(field)
+    anomaly_detectors[field] = read_detector(field)
+    loaded_versions[field] = state_version(manifest, field)
+
+
+def parse_batch(body, content_type):
+    """
+    Parses a batch of readings sent to the service.
+
+    Args:
+        body (bytes): The request body.
+        content_type (str): The request content type, JSON or CSV.
+
+    Returns:
+        pandas.DataFrame: The readings with the store schema and a
+        ``field_id`` column.
+
+    Raises:
+        ValueError: If the body cannot be parsed, mixes timestamps with and
+            without a UTC offset, or names an invalid field or node.
+    """
+    if "csv" in content_type:
+        data = pd.read_csv(io.BytesIO(body))
+    else:
+        records = json.loads(body)
+        if isinstance(records, dict):
+            records = records.get("readings", [])
+        data = pd.DataFrame.from_records(records)
+
+    if "timestamp" not in data.columns:
+        raise ValueError("every reading needs a timestamp")
+    has_offset = data["timestamp"].astype(str).str.strip().str.contains(OFFSET_PATTERN)
+    if has_offset.all() and len(data):
+        # Offsets may differ inside a batch (e.g. across a DST change)
+        timestamps = pd.to_datetime(data["timestamp"], format="ISO8601", utc=True)
+        timestamps = timestamps.dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
+    elif has_offset.any():
+        raise ValueError("timestamps must either all have a UTC offset or none")
+    else:
+        timestamps = pd.to_datetime(data["timestamp"], format="ISO8601")
+    if timestamps.isna().any():
+        raise ValueError("every reading needs a valid timestamp")
+
+    batch = pd.DataFrame({"timestamp": timestamps.astype("datetime64[ns]")})
+    for column in ("field_id", "node_id"):
+        if column in data.columns:
+            batch[column] = data[column]
+    batch = with_ids(batch)
+    for sensor in SENSORS:
+        if sensor in data.columns:
+            batch[sensor] = pd.to_numeric(data[sensor]).astype("float64")
+        else:
+            batch[sensor] = float("nan")
+    return batch
+
+
+def ingest_batch(batch):
+    """
+    Appends a parsed batch to the store and updates the rollups, the running
+    statistics, the correlation partials and the anomaly flags of the fields
+    it touches.
+
+    Args:
+        batch (pandas.DataFrame): The readings with the store schema and a
+            ``field_id`` column.
+
+    Returns:
+        dict: How many readings were received, appended and dropped as
+        duplicates.
+    """
+    # The store lock keeps rollup rebuilds in other processes out
+    with write_lock, store_lock():
+        appended = append_readings(batch)
+        update_rollups(appended)
+        manifest = ensure_store()
+        for field, field_data in appended.groupby("field_id", sort=True):
+            load_states(field, manifest)
+            running_stats[field].update_frame(field_data)
+            save_stats(running_stats[field], manifest.get("source_mtime"), field)
+            correlation[field].update(field_data)
+            correlation[field].save(get_engine_path(field), manifest.get("source_mtime"))
+            save_flags(anomaly_detectors[field].update_frame(field_data), field)
+            save_detector(anomaly_detectors[field], manifest.get("source_mtime"), field)
+            loaded_versions[field] = state_version(manifest, field)
+            partitions = get_partitions(manifest, field)
+            for key in partition_keys(field_data["timestamp"]).unique():
+                if len(partitions[key]["parts"]) > MAX_PARTS:
+                    compact_partition(key, field)
+    return {
+        "received": len(batch),
+        "appended": len(appended),
+        "duplicates": len(batch) - len(appended),
+    }
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler accepting ``POST /readings`` and ``GET /health``.
+    """
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/readings":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self._send_json(400, {"error": "invalid Content-Length"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json(413, {"error": f"batches are limited to {MAX_BODY_BYTES} bytes"})
+            return
+        body = self.rfile.read(length)
+        try:
+            batch = parse_batch(body, self.headers.get("Content-Type", "application/json"))
+            result = ingest_batch(batch)
+        except (ValueError, TypeError, KeyError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.log_error("ingesting a batch failed: %r", e)
+            self._send_json(500, {"error": "ingesting the batch failed"})
+            return
+        self._send_json(200, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest sensor readings over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8502, help="port to listen on")
+    args = parser.parse_args()
+
+    # Build the store, rollups and statistics up front so batches are only
+    # ever merged in
+    ensure_rollups()
+    manifest = ensure_store()
+    for field in list_fields():
+        load_states(field, manifest)
+
+    server = ThreadingHTTPServer((args.host, args.port), IngestHandler)
+    print(f"Ingesting readings on http://{args.host}:{args.port}/readings")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Memory held by the dashboard's caches and sessions.
+
+``memory_report()`` collects, in bytes:
+
+* every shared dataset (per cache entry),
+* every ``st.cache_data`` function and the figure cache (all entries),
+* the session state of the current session and of all active sessions.
+
+``show_memory_report()`` renders it in the sidebar of a page.
+"""
+import pandas as pd
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching import get_data_cache_stats_provider
+
+from figure_cache import get_figure_cache
+from sensor_store import cache_entry_bytes
+
+
+def session_bytes():
+    """
+    Returns the memory held by the session state of the current session.
+
+    Returns:
+        int: Size in bytes.
+    """
+    from streamlit.vendor.pympler.asizeof import asizeof
+
+    return asizeof({key: st.session_state[key] for key in st.session_state})
+
+
+def all_sessions_bytes():
+    """
+    Returns the memory held by the session state of all active sessions.
+
+    Returns:
+        int: Size in bytes (0 outside a running server).
+    """
+    if not Runtime.exists():
+        return 0
+    # Only the session state stats are kept: pympler cannot size the NumPy
+    # views held by the resource caches (measured by their owners instead)
+    stats = Runtime.instance().stats_mgr.get_stats()
+    return sum(stat.byte_length for stat in stats if stat.category_name == "st_session_state")
+
+
+def memory_report():
+    """
+    Collects the memory held per cache entry, per cache and per session.
+
+    ``st.cache_data`` functions are measured by Streamlit (pickled size). The
+    datasets and rendered figures held by ``st.cache_resource`` are measured
+    by their owners, since pympler cannot size NumPy views.
+
+    Returns:
+        dict: ``entries`` (bytes per shared dataset),
+        ``caches`` (bytes per cached function), ``session`` (bytes of this
+        session) and ``sessions`` (bytes of all sessions).
+    """
+    caches = {f"st_cache_data: {stat.cache_name}": stat.byte_length for stat in get_data_cache_stats_provider().get_stats()}
+    caches["st_cache_resource: figure_cache.get_figure_cache"] = get_figure_cache().size
+    return {
+        "entries": cache_entry_bytes(),
+        "caches": caches,
+        "session": session_bytes(),
+        "sessions": all_sessions_bytes(),
+    }
+
+
+def format_bytes(size):
+    """
+    Formats a byte count for display.
+
+    Args:
+        size (int): The size in bytes.
+
+    Returns:
+        str: E.g. "1.5 MB".
+    """
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def show_memory_report():
+    """
+    Shows the memory report in the sidebar, behind a checkbox.
+    """
+    if not st.sidebar.checkbox("Show memory usage"):
+        return
+    report = memory_report()
+    st.sidebar.write(f"This session: {format_bytes(report['session'])}")
+    st.sidebar.write(f"All sessions: {format_bytes(report['sessions'])}")
+    for title, sizes in (("Caches", report["caches"]), ("Cached data", report["entries"])):
+        table = pd.DataFrame({"bytes": sizes}).sort_values("bytes", ascending=False) if sizes else pd.DataFrame({"bytes": []})
+        st.sidebar.write(f"{title}: {format_bytes(int(table['bytes'].sum()))}")
+        st.sidebar.dataframe(table["bytes"].map(format_bytes))
@@ -0,0 +1,215 @@
+"""
+On-disk registry of fitted Prophet models.
+
+Every series (e.g. a sensor) with a given set of hyperparameters has a slot in
+``store/models``. The slot keeps the latest fitted model, serialized with
+``prophet.serialize``, together with a fingerprint of the training window it
+was fitted on::
+
+    store/models/TC-3f2a9c1b7e4d/
+        entry.json        fingerprint and model file
+        model.json        the serialized model
+
+Predictions are not stored; they are made on demand for the window a page
+shows (see ``forecast_service``). When the training window is unchanged the
+stored model is reused as it is. When it changed (e.g. after a small append) the new fit is
+warm-started from the stored model's parameters, which converges much faster
+than a fit from scratch.
+"""
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from sensor_store import get_store_dir
+
+
+def get_registry_dir():
+    """
+    Returns the directory holding the model registry.
+
+    Returns:
+        str: The absolute path to ``store/models``.
+    """
+    return os.path.join(get_store_dir(), "models")
+
+
+def fingerprint(sensor_data):
+    """
+    Hashes a training window.
+
+    Args:
+        sensor_data (pandas.DataFrame): Training frame with ``ds`` and ``y``.
+
+    Returns:
+        str: Hex digest of the timestamps and values.
+    """
+    digest = hashlib.sha256()
+    digest.update(sensor_data["ds"].to_numpy(dtype="datetime64[ns]").view("int64").tobytes())
+    digest.update(sensor_data["y"].to_numpy(dtype="float64").tobytes())
+    return digest.hexdigest()
+
+
+def get_slot_dir(key, params):
+    """
+    Returns the registry directory of one series and hyperparameter set.
+
+    Args:
+        key: Identifies the series (e.g. the sensor name).
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        str: The absolute path to the slot directory.
+    """
+    params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(key))
+    return os.path.join(get_registry_dir(), f"{name}-{params_hash}")
+
+
+def read_entry(key, params):
+    """
+    Reads the registry entry of a series.
+
+    Args:
+        key: Identifies the series.
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        dict: The entry, or None if nothing was stored yet.
+    """
+    try:
+        with open(os.path.join(get_slot_dir(key, params), "entry.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_entry(slot_dir, entry):
+    path = os.path.join(slot_dir, "entry.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+def load_model(key, params):
+    """
+    Loads the stored model of a series.
+
+    Args:
+        key: Identifies the series.
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        prophet.Prophet: The model, or None if nothing was stored yet.
+    """
+    from prophet.serialize import model_from_json
+
+    entry = read_entry(key, params)
+    if entry is None:
+        return None
+    with open(os.path.join(get_slot_dir(key, params), entry["model"])) as f:
+        return model_from_json(f.read())
+
+
+def save_model(key, params, data_fingerprint, model):
+    """
+    Stores a freshly fitted model, replacing the previous one.
+
+    Args:
+        key: Identifies the series.
+        params (dict): Prophet hyperparameters.
+        data_fingerprint (str): Fingerprint of the training window.
+        model (prophet.Prophet): The fitted model.
+    """
+    from prophet.serialize import model_to_json
+
+    slot_dir = get_slot_dir(key, params)
+    os.makedirs(slot_dir, exist_ok=True)
+
+    tmp_path = os.path.join(slot_dir, "model.json.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(model_to_json(model))
+    os.replace(tmp_path, os.path.join(slot_dir, "model.json"))
+    _write_entry(slot_dir, {"fingerprint": data_fingerprint, "model": "model.json"})
+
+
+def trained_at(key, params):
+    """
+    Returns when the stored model of a series was fitted.
+
+    Args:
+        key: Identifies the series.
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        float: Modification time of the model file, or None if nothing was
+        stored yet.
+    """
+    entry = read_entry(key, params)
+    if entry is None:
+        return None
+    try:
+        return os.path.getmtime(os.path.join(get_slot_dir(key, params), entry["model"]))
+    except FileNotFoundError:
+        return None
+
+
+def warm_start_params(model):
+    """
+    Extracts the parameters of a fitted model as initial values for a new fit.
+
+    Args:
+        model (prophet.Prophet): A fitted model.
+
+    Returns:
+        dict: Initial values for ``Prophet.fit(init=...)``.
+    """
+    params = {}
+    for name in ("k", "m", "sigma_obs"):
+        values = model.params[name]
+        params[name] = values[0][0] if model.mcmc_samples == 0 else np.mean(values)
+    for name in ("delta", "beta"):
+        values = model.params[name]
+        params[name] = values[0] if model.mcmc_samples == 0 else np.mean(values, axis=0)
+    return params
+
+
+def fit_model(key, sensor_data, params):
+    """
+    Returns a model fitted to a training window, reusing the registry.
+
+    Args:
+        key: Identifies the series.
+        sensor_data (pandas.DataFrame): Training frame with ``ds`` and ``y``.
+        params (dict): Prophet hyperparameters.
+
+    Returns:
+        tuple: The model and how it was obtained: "cached" (stored model
+        reused), "warm" (warm-started fit) or "cold" (fit from scratch).
+    """
+    from prophet import Prophet
+
+    data_fingerprint = fingerprint(sensor_data)
+    entry = read_entry(key, params)
+    previous = load_model(key, params) if entry is not None else None
+    if previous is not None and entry["fingerprint"] == data_fingerprint:
+        return previous, "cached"
+
+    model = Prophet(**params)
+    if previous is not None:
+        try:
+            model.fit(sensor_data, init=warm_start_params(previous))
+            status = "warm"
+        except (ValueError, RuntimeError):
+            # The stored parameters do not fit the new window's shape
+            model = Prophet(**params)
+            model.fit(sensor_data)
+            status = "cold"
+    else:
+        model.fit(sensor_data)
+        status = "cold"
+    save_model(key, params, data_fingerprint, model)
+    return model, status
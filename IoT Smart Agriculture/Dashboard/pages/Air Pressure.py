@@ -1,64 +1,25 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from figure_cache import scatter_figure, show_figure
+from query_client import chart_series, get_data_version, load_anomalies, load_readings, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
-
-# Get the absolute path to the current directory
-current_dir = os.path.dirname(os.path.abspath(__file__))
+# Label this page's timings (see timing)
+track_page("Air Pressure")
 
 # Load custom CSS
 css_file_path = os.path.join(os.path.dirname(__file__), "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Function to construct the file path
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    return os.path.join(current_dir, filename)
-
-# Define the filename
-data_file = "cleaned_data.csv"
-
-
-# Function to load the data
-@st.cache_data
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    data = pd.read_csv(file_path)
-    # Add any necessary data processing steps here (e.g., handling missing values)
-    # ...
-    return data
-
-
-# Load the data using the function
-data = load_data(get_file_path(data_file))
-
-# Data processing (assuming the 'timestamp' column exists)
-data['timestamp'] = pd.to_datetime(data['timestamp'])
-
-# Filter for Air Pressure (PRES)
-pres_data = data[['timestamp', 'PRES']]
+# Field shown on this page (sidebar)
+field = select_field()
 
 
 st.title("Air Pressure (PRES) Visualizations")
@@ -92,25 +53,41 @@ if button_col4.button("Show Air Pressure Scatter Plot"):
 # Display corresponding chart based on the current chart type
 if current_chart == 'line':
     st.markdown("<div class='card1'><h3>Air Pressure Over Time</h3></div>", unsafe_allow_html=True)
-    st.line_chart(pres_data.set_index('timestamp')['PRES'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('PRES', field=field)
+    with phase("load"):
+        flags = load_anomalies('PRES', field=field)
+    with phase("render"):
+        st.altair_chart(anomaly_chart(series, flags, color='#77b5fe'), use_container_width=True)
+        st.caption(describe_anomalies(flags))
 
 elif current_chart == 'bar':
     st.markdown("<div class='card1'><h3>Air Pressure Distribution</h3></div>", unsafe_allow_html=True)
-    st.bar_chart(pres_data.set_index('timestamp')['PRES'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('PRES', how='mean', field=field)
+    with phase("render"):
+        st.bar_chart(series,color='#77b5fe')
 
 elif current_chart == 'pie':
     st.markdown("<div class='card'><h3>Air Pressure Proportions</h3></div>", unsafe_allow_html=True)
-    pres_bins = pd.cut(pres_data['PRES'], bins=5)
-    pres_pie_data = pres_bins.value_counts().reset_index()
-    pres_pie_data.columns = ['Air Pressure Range', 'Count']  # Rename columns
-    fig, ax = plt.subplots()
-    ax.pie(pres_pie_data['Count'], labels=pres_pie_data['Air Pressure Range'], autopct='%1.1f%%')
-    st.pyplot(fig)
+    with phase("load"):
+        pres_data = load_readings(columns=['PRES'], field=field)
+    with phase("aggregate"):
+        pres_bins = pd.cut(pres_data['PRES'], bins=5)
+        pres_pie_data = pres_bins.value_counts().reset_index()
+        pres_pie_data.columns = ['Air Pressure Range', 'Count']  # Rename columns
+    with phase("render"):
+        fig, ax = plt.subplots()
+        ax.pie(pres_pie_data['Count'], labels=pres_pie_data['Air Pressure Range'], autopct='%1.1f%%')
+        st.pyplot(fig)
 
 elif current_chart == 'scatter':
     st.markdown("<div class='card1'><h3>Air Pressure Scatter Plot</h3></div>", unsafe_allow_html=True)
-    fig, ax = plt.subplots()
-    sns.scatterplot(x='timestamp', y='PRES', data=pres_data, ax=ax)
-    st.pyplot(fig)
+    def draw_scatter():
+        with phase("load"):
+            pres_data = load_readings(columns=['PRES'], field=field)
+        return scatter_figure(pres_data, 'PRES')
+    with phase("render"):
+        show_figure(('scatter', 'PRES', field, get_data_version(field)), draw_scatter)
 
 st.markdown("<footer>Smart Agriculture Dashboard © 2024</footer>", unsafe_allow_html=True)
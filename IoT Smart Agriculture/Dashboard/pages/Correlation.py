@@ -1,60 +1,24 @@
+import hashlib
 import streamlit as st
-import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from correlation_engine import WINDOWS
+from figure_cache import show_figure
+from query_client import correlation_matrix, select_field
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
+# Label this page's timings (see timing)
+track_page("Correlation")
+
 # Load custom CSS
 css_file_path = os.path.join(os.path.dirname(__file__), "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-
-# Get the absolute path to the current directory
-current_dir = os.path.dirname(os.path.abspath(__file__))
-
-# Function to construct the file path
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    return os.path.join(current_dir, filename)
-
-# Define the filename
-data_file = "cleaned_data.csv"
-
-# Function to load the data
-@st.cache_data
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    data = pd.read_csv(file_path)
-    # Add any necessary data processing steps here (e.g., handling missing values)
-    # ...
-    return data
-
-# Load the data using the function
-data = load_data(get_file_path(data_file))
-
-# Data processing (assuming the 'timestamp' column exists)
-data['timestamp'] = pd.to_datetime(data['timestamp'])
-
 # Function to explain correlation strength
 def explain_correlation(corr_value):
     """
@@ -72,22 +36,31 @@ def explain_correlation(corr_value):
         return "Very strong correlation."
     
 
-# Calculate the correlation matrix
-corr_matrix = data[["TC", "HUM", "PRES", "US", "SOIL1"]].corr()
-
 # Function to display the full correlation matrix heatmap
 def show_full_heatmap():
     """
     Displays the heatmap for the entire correlation matrix.
     """
-    fig, ax = plt.subplots()
-    sns.heatmap(corr_matrix, annot=True, cmap="coolwarm", fmt=".2f", ax=ax, linewidths=0.5)
-    ax.set_title("Correlation Matrix (All Factors)")
-    st.pyplot(fig)
+    def draw_heatmap():
+        fig, ax = plt.subplots()
+        sns.heatmap(corr_matrix, annot=True, cmap="coolwarm", fmt=".2f", ax=ax, linewidths=0.5)
+        ax.set_title("Correlation Matrix (All Factors)")
+        return fig
+    with phase("render"):
+        show_figure(('heatmap', 'all', field, window, corr_version), draw_heatmap)
 
 # Page title
 st.title("Correlation Analyzer for Environmental Factors")
 
+# Field and time window for the correlation (served from the field's precomputed partial sums)
+field = select_field()
+window = st.selectbox("Time Window:", list(WINDOWS.keys()))
+with phase("aggregate"):
+    corr_matrix = correlation_matrix(WINDOWS[window], field)
+# Version of the matrix, so cached heatmaps are redrawn after new readings
+# (taken from the result, which may come from the query service)
+corr_version = hashlib.sha1(corr_matrix.to_numpy().tobytes()).hexdigest()
+
 # User Input for selecting factors
 factor1 = st.selectbox("Select First Factor:", ["TC", "HUM", "PRES", "US", "SOIL1"])
 factor2 = st.selectbox("Select Second Factor:", ["TC", "HUM", "PRES", "US", "SOIL1"])
@@ -100,10 +73,13 @@ if st.button("Calculate Correlation"):
         corr_value = corr_matrix.loc[factor1, factor2]
 
         # Display correlation heatmap (reduced size for better layout)
-        fig, ax = plt.subplots(figsize=(5, 5))
-        sns.heatmap(corr_matrix[[factor1, factor2]][[factor1, factor2]], annot=True, cmap="coolwarm", fmt=".2f", ax=ax)
-        ax.set_title("Correlation Heatmap (Selected Factors)")
-        st.pyplot(fig)
+        def draw_heatmap():
+            fig, ax = plt.subplots(figsize=(5, 5))
+            sns.heatmap(corr_matrix[[factor1, factor2]][[factor1, factor2]], annot=True, cmap="coolwarm", fmt=".2f", ax=ax)
+            ax.set_title("Correlation Heatmap (Selected Factors)")
+            return fig
+        with phase("render"):
+            show_figure(('heatmap', (factor1, factor2), field, window, corr_version), draw_heatmap)
 
         # Display correlation value and explanation
         st.write(f"*Correlation between {factor1} and {factor2}:* {corr_value:.2f}")
@@ -1,12 +1,18 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from figure_cache import scatter_figure, show_figure
+from query_client import chart_series, get_data_version, get_time_bounds, load_anomalies, load_readings, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
+# Label this page's timings (see timing)
+track_page("Humidity")
+
 # Get the absolute path to the current directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -23,21 +29,6 @@ def get_file_path(filename):
     """
     return os.path.join(current_dir, filename)
 
-# Define the filename
-data_file = "cleaned_data.csv"
-
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    return pd.read_csv(file_path)
-
 # Load custom CSS
 css_file_path = get_file_path("styles.css")
 if os.path.exists(css_file_path):
@@ -46,16 +37,14 @@ if os.path.exists(css_file_path):
 else:
     st.error(f"CSS file not found at path: {css_file_path}")
 
-# Check if the data file exists before attempting to load it
-data_path = get_file_path(data_file)
-if os.path.exists(data_path):
-    # Load the data using the function
-    data = load_data(data_path)
-    data['timestamp'] = pd.to_datetime(data['timestamp'])
-
-    # Filter for Humidity (HUM)
-    hum_data = data[['timestamp', 'HUM']]
+# Field shown on this page (sidebar)
+field = select_field()
 
+# Whether the field has readings (from the store manifest); the full column
+# is only loaded for the pie and scatter charts, the others use the rollups
+with phase("load"):
+    first_timestamp, _ = get_time_bounds(field)
+if first_timestamp is not None:
     st.title("Humidity (HUM) Visualizations")
 
     cols = st.columns(5)
@@ -88,25 +77,43 @@ if os.path.exists(data_path):
     # Display corresponding chart based on the current chart type
     if current_chart == 'line':
         st.markdown("<div class='card1'><h3>Humidity Over Time</h3></div>", unsafe_allow_html=True)
-        st.line_chart(hum_data.set_index('timestamp')['HUM'],color='#77b5fe')
+        with phase("aggregate"):
+            series = chart_series('HUM', field=field)
+        with phase("load"):
+            flags = load_anomalies('HUM', field=field)
+        with phase("render"):
+            st.altair_chart(anomaly_chart(series, flags, color='#77b5fe'), use_container_width=True)
+            st.caption(describe_anomalies(flags))
 
     elif current_chart == 'bar':
         st.markdown("<div class='card1'><h3>Humidity Distribution</h3></div>", unsafe_allow_html=True)
-        st.bar_chart(hum_data.set_index('timestamp')['HUM'],color='#77b5fe')
+        with phase("aggregate"):
+            series = chart_series('HUM', how='mean', field=field)
+        with phase("render"):
+            st.bar_chart(series,color='#77b5fe')
 
     elif current_chart == 'pie':
         st.markdown("<div class='card1'><h3>Humidity Proportions</h3></div>", unsafe_allow_html=True)
-        hum_bins = pd.cut(hum_data['HUM'], bins=5)
-        hum_pie_data = hum_bins.value_counts().reset_index()
-        hum_pie_data.columns = ['Humidity Range', 'Count']  # Rename columns
-        fig, ax = plt.subplots()
-        ax.pie(hum_pie_data['Count'], labels=hum_pie_data['Humidity Range'], autopct='%1.1f%%')
-        st.pyplot(fig)
+        def draw_pie():
+            with phase("load"):
+                hum_data = load_readings(columns=['HUM'], field=field)
+            with phase("aggregate"):
+                hum_bins = pd.cut(hum_data['HUM'], bins=5)
+                hum_pie_data = hum_bins.value_counts().reset_index()
+                hum_pie_data.columns = ['Humidity Range', 'Count']  # Rename columns
+            fig, ax = plt.subplots()
+            ax.pie(hum_pie_data['Count'], labels=hum_pie_data['Humidity Range'], autopct='%1.1f%%')
+            return fig
+        with phase("render"):
+            show_figure(('pie', 'HUM', field, get_data_version(field)), draw_pie)
 
     elif current_chart == 'scatter':
         st.markdown("<div class='card1'><h3>Humidity Scatter Plot</h3></div>", unsafe_allow_html=True)
-        fig, ax = plt.subplots()
-        sns.scatterplot(x='timestamp', y='HUM', data=hum_data, ax=ax)
-        st.pyplot(fig)
+        def draw_scatter():
+            with phase("load"):
+                hum_data = load_readings(columns=['HUM'], field=field)
+            return scatter_figure(hum_data, 'HUM')
+        with phase("render"):
+            show_figure(('scatter', 'HUM', field, get_data_version(field)), draw_scatter)
 
     st.markdown("<footer>Smart Agriculture Dashboard © 2024</footer>", unsafe_allow_html=True)
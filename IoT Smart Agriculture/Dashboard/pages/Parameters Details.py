@@ -1,51 +1,48 @@
 import streamlit as st
 import pandas as pd
 import os
+from query_client import chart_series, get_time_bounds, list_nodes, load_anomalies, query_range, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from export import show_export
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
+# Label this page's timings (see timing)
+track_page("Parameters Details")
 
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, filename)
 
 # Load custom CSS (assuming your CSS file is named "styles.css")
 css_file_path = os.path.join(os.path.dirname(__file__), "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Get the data path (assuming the file is within the app)
-data_path = get_file_path("cleaned_data.csv")
-
-# Load the data
-data = pd.read_csv(data_path)
+# Sidebar for field and node selection
+st.sidebar.header("Filter Data")
+field = select_field()
+node = st.sidebar.selectbox("Node", ["All nodes"] + list_nodes(field))
+nodes = None if node == "All nodes" else [node]
 
-# Convert timestamp column to datetime (assuming consistent format)
-data['timestamp'] = pd.to_datetime(data['timestamp'])
+# Time range covered by the field (read from the store manifest, no data is loaded)
+with phase("load"):
+    first_timestamp, last_timestamp = get_time_bounds(field)
+if first_timestamp is None:
+    st.info("There are no readings for this field yet.")
+    st.stop()
 
 # Sidebar for date/time selection
-st.sidebar.header("Filter Data")
-start_date = st.sidebar.date_input("Start Date", data['timestamp'].min())
-end_date = st.sidebar.date_input("End Date", data['timestamp'].max())
+start_date = st.sidebar.date_input("Start Date", first_timestamp)
+end_date = st.sidebar.date_input("End Date", last_timestamp)
 
 # Check if the start and end dates are the same
 if start_date == end_date:
     st.sidebar.write("Select hours for the same day:")
-    start_time = st.sidebar.time_input("Start Time", pd.to_datetime(data['timestamp']).min().time())
-    end_time = st.sidebar.time_input("End Time", pd.to_datetime(data['timestamp']).max().time())
+    start_time = st.sidebar.time_input("Start Time", first_timestamp.time())
+    end_time = st.sidebar.time_input("End Time", last_timestamp.time())
 else:
-    start_time = pd.to_datetime(data['timestamp']).min().time()
-    end_time = pd.to_datetime(data['timestamp']).max().time()
+    start_time = first_timestamp.time()
+    end_time = last_timestamp.time()
 
 # Sidebar for parameter selection
 parameter_dict = {
@@ -57,25 +54,29 @@ parameter_dict = {
 }
 parameter = st.sidebar.selectbox("Parameter", list(parameter_dict.keys()), format_func=lambda x: parameter_dict[x])
 
-# Filter data based on date and time selection
-if start_date == end_date:
-    filtered_data = data[
-        (data['timestamp'] >= pd.to_datetime(f"{start_date} {start_time}")) &
-        (data['timestamp'] <= pd.to_datetime(f"{end_date} {end_time}"))
-    ]
-else:
-    filtered_data = data[
-        (data['timestamp'] >= pd.to_datetime(f"{start_date} {start_time}")) &
-        (data['timestamp'] <= pd.to_datetime(f"{end_date} {end_time}"))
-    ]
+# Filter data based on field, node, date and time selection (only the field's readings are searched)
+range_start = pd.to_datetime(f"{start_date} {start_time}")
+range_end = pd.to_datetime(f"{end_date} {end_time}")
+with phase("filter"):
+    filtered_data = query_range(range_start, range_end, columns=[parameter], field=field, nodes=nodes)
 
 # Display filtered data
 st.markdown(f"<div class='main'><h2>{parameter_dict[parameter]} Data from {start_date} to {end_date}</h2></div>", unsafe_allow_html=True)
-st.line_chart(filtered_data.set_index('timestamp')[parameter])
+with phase("aggregate"):
+    series = chart_series(parameter, range_start, range_end, field=field, node=None if nodes is None else node)
+with phase("load"):
+    flags = load_anomalies(parameter, range_start, range_end, field=field, node=None if nodes is None else node)
+with phase("render"):
+    st.altair_chart(anomaly_chart(series, flags), use_container_width=True)
+    st.caption(describe_anomalies(flags))
 
 # Display min and max values
-min_value = filtered_data[parameter].min()
-max_value = filtered_data[parameter].max()
+with phase("aggregate"):
+    min_value = filtered_data[parameter].min()
+    max_value = filtered_data[parameter].max()
 st.markdown(f"<div class='card1'><p>Min {parameter_dict[parameter]}: {min_value}</p><p>Max {parameter_dict[parameter]}: {max_value}</p></div>", unsafe_allow_html=True)
 
+# Download the selected range, streamed from the store
+show_export("readings", range_start, range_end, [parameter], field, nodes=nodes)
+
 st.markdown("<footer>Smart Agriculture Dashboard ©️ 2024</footer>", unsafe_allow_html=True)
@@ -1,63 +1,26 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from figure_cache import scatter_figure, show_figure
+from query_client import chart_series, get_data_version, load_anomalies, load_readings, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
+# Label this page's timings (see timing)
+track_page("Soil")
 
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, filename)
-
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    return pd.read_csv(file_path)
-
-def get_data_path():
-    """
-    This function retrieves the data path, assuming it's stored within your deployed app.
-
-    Returns:
-        str: Path to the CSV file (relative to your app's location).
-    """
-    # Assuming your CSV file is named "cleaned_data.csv" and located within the app directory
-    data_path = "cleaned_data.csv"
-    return data_path
 
 # Load custom CSS
 css_file_path = os.path.join(os.path.dirname(__file__), "..", "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Get the data path (assuming the file is within the app)
-data_path = get_data_path()
-
-# Load the data
-data = load_data(get_file_path(data_path))
-data['timestamp'] = pd.to_datetime(data['timestamp'])
-
-# Filter for Soil Moisture (SOIL1)
-soil_data = data[['timestamp', 'SOIL1']]
+# Field shown on this page (sidebar)
+field = select_field()
 
 # Page title
 st.title("Soil Moisture (SOIL1) Visualizations")
@@ -91,25 +54,43 @@ if col4.button("Show Soil Moisture Scatter Plot"):
 # Display the corresponding chart based on the current chart type
 if st.session_state.current_chart == 'line':
     st.markdown("<div class='card1'><h3>Soil Moisture Over Time</h3></div>", unsafe_allow_html=True)
-    st.line_chart(soil_data.set_index('timestamp')['SOIL1'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('SOIL1', field=field)
+    with phase("load"):
+        flags = load_anomalies('SOIL1', field=field)
+    with phase("render"):
+        st.altair_chart(anomaly_chart(series, flags, color='#77b5fe'), use_container_width=True)
+        st.caption(describe_anomalies(flags))
 
 elif st.session_state.current_chart == 'bar':
     st.markdown("<div class='card1'><h3>Soil Moisture Distribution</h3></div>", unsafe_allow_html=True)
-    st.bar_chart(soil_data.set_index('timestamp')['SOIL1'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('SOIL1', how='mean', field=field)
+    with phase("render"):
+        st.bar_chart(series,color='#77b5fe')
 
 elif st.session_state.current_chart == 'pie':
     st.markdown("<div class='card1'><h3>Soil Moisture Proportions</h3></div>", unsafe_allow_html=True)
-    soil_bins = pd.cut(soil_data['SOIL1'], bins=5)
-    soil_pie_data = soil_bins.value_counts().reset_index()
-    soil_pie_data.columns = ['Soil Moisture Range', 'Count']
-    fig, ax = plt.subplots()
-    ax.pie(soil_pie_data['Count'], labels=soil_pie_data['Soil Moisture Range'], autopct='%1.1f%%')
-    st.pyplot(fig)
+    def draw_pie():
+        with phase("load"):
+            soil_data = load_readings(columns=['SOIL1'], field=field)
+        with phase("aggregate"):
+            soil_bins = pd.cut(soil_data['SOIL1'], bins=5)
+            soil_pie_data = soil_bins.value_counts().reset_index()
+            soil_pie_data.columns = ['Soil Moisture Range', 'Count']
+        fig, ax = plt.subplots()
+        ax.pie(soil_pie_data['Count'], labels=soil_pie_data['Soil Moisture Range'], autopct='%1.1f%%')
+        return fig
+    with phase("render"):
+        show_figure(('pie', 'SOIL1', field, get_data_version(field)), draw_pie)
 
 elif st.session_state.current_chart == 'scatter':
     st.markdown("<div class='card1'><h3>Soil Moisture Scatter Plot</h3></div>", unsafe_allow_html=True)
-    fig, ax = plt.subplots()
-    sns.scatterplot(x='timestamp', y='SOIL1', data=soil_data, ax=ax)
-    st.pyplot(fig)
+    def draw_scatter():
+        with phase("load"):
+            soil_data = load_readings(columns=['SOIL1'], field=field)
+        return scatter_figure(soil_data, 'SOIL1')
+    with phase("render"):
+        show_figure(('scatter', 'SOIL1', field, get_data_version(field)), draw_scatter)
 
 st.markdown("<footer>Smart Agriculture Dashboard © 2024</footer>", unsafe_allow_html=True)
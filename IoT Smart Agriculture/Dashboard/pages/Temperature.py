@@ -1,50 +1,17 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from figure_cache import scatter_figure, show_figure
+from query_client import chart_series, get_data_version, load_anomalies, load_readings, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
-
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, filename)
-
-
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    data = pd.read_csv(file_path)
-    return data
-
-
-def get_data_path():
-    """
-    This function retrieves the data path from an environment variable or a default location.
-
-    Returns:
-        str: Path to the CSV file.
-    """
-    data_path = os.environ.get("DATA_PATH", "./cleaned_data.csv")
-    return data_path
+# Label this page's timings (see timing)
+track_page("Temperature")
 
 
 # Load custom CSS
@@ -52,15 +19,8 @@ css_file_path = os.path.join(os.path.dirname(__file__), "..", "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Get the data path
-data_path = get_data_path()
-
-# Load the data
-data = load_data(get_file_path(data_path))
-data['timestamp'] = pd.to_datetime(data['timestamp'])
-
-# Filter for Temperature (TC)
-temp_data = data[['timestamp', 'TC']]
+# Field shown on this page (sidebar)
+field = select_field()
 
 # Page title
 st.title("Temperature (TC) Visualizations")
@@ -94,25 +54,43 @@ if col4.button("Show Scatter Plot"):
 # Display the corresponding chart based on the current chart type
 if st.session_state.current_chart == 'line':
     st.markdown("<div class='card1'><h3>Temperature Over Time</h3></div>", unsafe_allow_html=True)
-    st.line_chart(temp_data.set_index('timestamp')['TC'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('TC', field=field)
+    with phase("load"):
+        flags = load_anomalies('TC', field=field)
+    with phase("render"):
+        st.altair_chart(anomaly_chart(series, flags, color='#77b5fe'), use_container_width=True)
+        st.caption(describe_anomalies(flags))
 
 elif st.session_state.current_chart == 'bar':
     st.markdown("<div class='card1'><h3>Temperature Distribution</h3></div>", unsafe_allow_html=True)
-    st.bar_chart(temp_data.set_index('timestamp')['TC'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('TC', how='mean', field=field)
+    with phase("render"):
+        st.bar_chart(series,color='#77b5fe')
 
 elif st.session_state.current_chart == 'pie':
     st.markdown("<div class='card1'><h3>Temperature Proportions</h3></div>", unsafe_allow_html=True)
-    temp_bins = pd.cut(temp_data['TC'], bins=5)
-    temp_pie_data = temp_bins.value_counts().reset_index()
-    temp_pie_data.columns = ['Temperature Range', 'Count']
-    fig, ax = plt.subplots()
-    ax.pie(temp_pie_data['Count'], labels=temp_pie_data['Temperature Range'], autopct='%1.1f%%')
-    st.pyplot(fig)
+    def draw_pie():
+        with phase("load"):
+            temp_data = load_readings(columns=['TC'], field=field)
+        with phase("aggregate"):
+            temp_bins = pd.cut(temp_data['TC'], bins=5)
+            temp_pie_data = temp_bins.value_counts().reset_index()
+            temp_pie_data.columns = ['Temperature Range', 'Count']
+        fig, ax = plt.subplots()
+        ax.pie(temp_pie_data['Count'], labels=temp_pie_data['Temperature Range'], autopct='%1.1f%%')
+        return fig
+    with phase("render"):
+        show_figure(('pie', 'TC', field, get_data_version(field)), draw_pie)
 
 elif st.session_state.current_chart == 'scatter':
     st.markdown("<div class='card1'><h3>Temperature Scatter Plot</h3></div>", unsafe_allow_html=True)
-    fig, ax = plt.subplots()
-    sns.scatterplot(x='timestamp', y='TC', data=temp_data, ax=ax)
-    st.pyplot(fig)
+    def draw_scatter():
+        with phase("load"):
+            temp_data = load_readings(columns=['TC'], field=field)
+        return scatter_figure(temp_data, 'TC')
+    with phase("render"):
+        show_figure(('scatter', 'TC', field, get_data_version(field)), draw_scatter)
 
 st.markdown("<footer>Smart Agriculture Dashboard © 2024</footer>", unsafe_allow_html=True)
@@ -1,52 +1,17 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from figure_cache import scatter_figure, show_figure
+from query_client import chart_series, get_data_version, load_anomalies, load_readings, select_field
+from anomalies import anomaly_chart, describe_anomalies
+from timing import phase, track_page
 
 # Set page configuration to wide mode
 st.set_page_config(page_title="Smart Agriculture Dashboard", layout="wide")
 
-
-def get_file_path(filename):
-    """
-    Constructs the absolute path to the data file.
-
-    Args:
-        filename (str): The name of the data file (e.g., "cleaned_data.csv").
-
-    Returns:
-        str: The absolute path to the data file.
-    """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(current_dir, filename)
-
-
-def load_data(file_path):
-    """
-    Loads the data from the specified file path.
-
-    Args:
-        file_path (str): The absolute path to the data file.
-
-    Returns:
-        pandas.DataFrame: The loaded data as a pandas DataFrame.
-    """
-    data = pd.read_csv(file_path)
-    # Add any necessary data processing steps here (e.g., handling missing values)
-    # ...
-    return data
-
-
-def get_data_path():
-    """
-    This function retrieves the data path from an environment variable or a default location.
-
-    Returns:
-        str: Path to the CSV file.
-    """
-    data_path = os.environ.get("DATA_PATH", "./cleaned_data.csv")
-    return data_path
+# Label this page's timings (see timing)
+track_page("Ultrasound")
 
 
 # Load custom CSS
@@ -54,15 +19,8 @@ css_file_path = os.path.join(os.path.dirname(__file__), "..", "styles.css")
 with open(css_file_path) as f:
     st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
 
-# Get the data path
-data_path = get_data_path()
-
-# Load the data
-data = load_data(get_file_path(data_path))
-data['timestamp'] = pd.to_datetime(data['timestamp'])
-
-# Filter for Ultrasound (US)
-us_data = data[['timestamp', 'US']]
+# Field shown on this page (sidebar)
+field = select_field()
 
 # Page title
 st.title("Ultrasound (US) Visualizations")
@@ -96,25 +54,43 @@ if col4.button("Show Scatter Plot"):
 # Display the corresponding chart based on the current chart type
 if st.session_state.current_chart == 'line':
     st.markdown("<div class='card1'><h3>Ultrasound Over Time</h3></div>", unsafe_allow_html=True)
-    st.line_chart(us_data.set_index('timestamp')['US'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('US', field=field)
+    with phase("load"):
+        flags = load_anomalies('US', field=field)
+    with phase("render"):
+        st.altair_chart(anomaly_chart(series, flags, color='#77b5fe'), use_container_width=True)
+        st.caption(describe_anomalies(flags))
 
 elif st.session_state.current_chart == 'bar':
     st.markdown("<div class='card1'><h3>Ultrasound Distribution</h3></div>", unsafe_allow_html=True)
-    st.bar_chart(us_data.set_index('timestamp')['US'],color='#77b5fe')
+    with phase("aggregate"):
+        series = chart_series('US', how='mean', field=field)
+    with phase("render"):
+        st.bar_chart(series,color='#77b5fe')
 
 elif st.session_state.current_chart == 'pie':
     st.markdown("<div class='card1'><h3>Ultrasound Proportions</h3></div>", unsafe_allow_html=True)
-    us_bins = pd.cut(us_data['US'], bins=5)
-    us_pie_data = us_bins.value_counts().reset_index()
-    us_pie_data.columns = ['Ultrasound Range', 'Count']
-    fig, ax = plt.subplots()
-    ax.pie(us_pie_data['Count'], labels=us_pie_data['Ultrasound Range'], autopct='%1.1f%%')
-    st.pyplot(fig)
+    def draw_pie():
+        with phase("load"):
+            us_data = load_readings(columns=['US'], field=field)
+        with phase("aggregate"):
+            us_bins = pd.cut(us_data['US'], bins=5)
+            us_pie_data = us_bins.value_counts().reset_index()
+            us_pie_data.columns = ['Ultrasound Range', 'Count']
+        fig, ax = plt.subplots()
+        ax.pie(us_pie_data['Count'], labels=us_pie_data['Ultrasound Range'], autopct='%1.1f%%')
+        return fig
+    with phase("render"):
+        show_figure(('pie', 'US', field, get_data_version(field)), draw_pie)
 
 elif st.session_state.current_chart == 'scatter':
     st.markdown("<div class='card1'><h3>Ultrasound Scatter Plot</h3></div>", unsafe_allow_html=True)
-    fig, ax = plt.subplots()
-    sns.scatterplot(x='timestamp', y='US', data=us_data, ax=ax)
-    st.pyplot(fig)
+    def draw_scatter():
+        with phase("load"):
+            us_data = load_readings(columns=['US'], field=field)
+        return scatter_figure(us_data, 'US')
+    with phase("render"):
+        show_figure(('scatter', 'US', field, get_data_version(field)), draw_scatter)
 
 st.markdown("<footer>Smart Agriculture Dashboard © 2024</footer>", unsafe_allow_html=True)
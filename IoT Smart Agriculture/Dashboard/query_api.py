@@ -0,0 +1,505 @@
+"""
+Local HTTP query service over the sensor store.
+
+One long-running process answers the dashboard's heavy queries, so the
+shared datasets, rollups, statistics and forecast models are loaded and kept
+warm once instead of in every Streamlit server::
+
+    python query_api.py --port 8503
+
+and point the dashboard at it with ``QUERY_API_URL=http://127.0.0.1:8503``
+(see ``query_client``). Every endpoint is a GET with query parameters:
+
+* ``/range``: raw readings (``start``, ``end``, ``closed``, ``columns``,
+  ``compact``, ``field``, ``nodes``), see ``sensor_store.query_range``,
+* ``/series``: a chart-sized series (``sensor``, ``start``, ``end``,
+  ``width``, ``how``, ``field``, ``node``), see ``rollups.chart_series``,
+* ``/rollup``: rollup buckets (``resolution``, ``start``, ``end``,
+  ``field``), see ``rollups.load_rollup``,
+* ``/aggregate``: statistics per sensor (``window``, ``field``), see
+  ``running_stats.window_summary``,
+* ``/means``: the mean of every sensor in every field (``window``),
+* ``/correlation``: the correlation matrix (``days``, ``field``),
+* ``/forecast``: hourly predictions (``start``, ``end``, ``field``,
+  ``engine``), see ``forecast_service.ForecastService.window``,
+* ``/fields``: every field with its nodes, time range and data version,
+  read from the store manifest,
+* ``/anomalies``: flagged readings (``sensor``, ``start``, ``end``,
+  ``field``, ``node``), see ``anomalies.load_anomalies``,
+* ``/forecast_status``: the age of the forecast models and the state of
+  the scheduler training them,
+* ``/export``: a CSV or Parquet file of readings or forecasts, streamed as
+  it is read (``format``, ``source``, ``start``, ``end``, ``sensors``,
+  ``fields``, ``nodes``, ``resolution``, ``engine``), see ``export``,
+* ``/health`` and ``/metrics`` (the phase timings, see ``timing``).
+
+Lists are comma separated and timestamps anything ``pandas.Timestamp``
+accepts, e.g.::
+
+    curl "localhost:8503/range?start=2023-05-01&end=2023-05-02&columns=TC,HUM"
+
+The other results are tables, returned as JSON records by default or as an
+Arrow IPC stream with ``format=arrow`` (or ``Accept:
+application/vnd.apache.arrow.stream``).
+
+The server runs on tornado's event loop; queries run on a thread pool of
+``--threads`` workers, so slow queries do not hold up the others. Every
+table carries the version of the data it was computed from as its ETag: a
+request with a matching ``If-None-Match`` is answered with 304 before any
+work is done.
+
+The service also runs the forecast scheduler (unless ``FORECAST_SCHEDULER``
+is "off"); dashboards using the service do not start their own.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import tornado.ioloop
+import tornado.iostream
+import tornado.log
+import tornado.web
+
+from anomalies import load_anomalies
+from correlation_engine import correlation_matrix
+from export import EXPORT_FORMATS, export_filename, stream_export
+from forecast_scheduler import ForecastScheduler, forecast_age
+from forecast_service import ForecastService
+from forecasting import ENGINES
+from query_client import ARROW_TYPE
+from rollups import CHART_WIDTH, RESOLUTIONS, chart_series, ensure_rollups, load_rollup
+from running_stats import WINDOWS, field_means, window_summary
+from sensor_store import (
+    SENSORS,
+    ensure_store,
+    get_data_version,
+    get_default_field,
+    get_partitions,
+    list_fields,
+    query_range,
+)
+from timing import metrics_text, phase, track_page
+
+# Marks a request answered from the client's copy
+NOT_MODIFIED = object()
+
+
+class QueryError(ValueError):
+    """
+    A query with missing or invalid parameters.
+    """
+
+
+def get_threads():
+    """
+    Returns the number of query threads.
+
+    Returns:
+        int: ``QUERY_API_THREADS``, or the default of ``ThreadPoolExecutor``.
+    """
+    threads = os.environ.get("QUERY_API_THREADS")
+    return int(threads) if threads else min(32, (os.cpu_count() or 1) + 4)
+
+
+def _required(params, name):
+    if not params.get(name):
+        raise QueryError(f"missing parameter: {name}")
+    return params[name]
+
+
+def _timestamp(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return pd.Timestamp(value)
+    except ValueError as e:
+        raise QueryError(f"invalid {name}: {value}") from e
+
+
+def _list(params, name):
+    value = params.get(name)
+    return value.split(",") if value else None
+
+
+def _int(params, name, default=None):
+    value = params.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError as e:
+        raise QueryError(f"invalid {name}: {value}") from e
+
+
+def _flag(params, name):
+    value = params.get(name)
+    return None if not value else value.lower() in ("1", "true", "yes")
+
+
+def _choice(params, name, choices, default=None):
+    value = params.get(name) or default
+    if value is not None and value not in choices:
+        raise QueryError(f"invalid {name}: {value} (one of {', '.join(map(str, choices))})")
+    return value
+
+
+def _field_version(params):
+    return get_data_version(params.get("field") or get_default_field())
+
+
+def _range_query(params):
+    return query_range(
+        _timestamp(params, "start"),
+        _timestamp(params, "end"),
+        _choice(params, "closed", ("both", "left"), "both"),
+        _list(params, "columns"),
+        _flag(params, "compact"),
+        params.get("field"),
+        _list(params, "nodes"),
+    )
+
+
+def _series_query(params):
+    _required(params, "sensor")
+    sensor = _choice(params, "sensor", SENSORS)
+    series = chart_series(
+        sensor,
+        _timestamp(params, "start"),
+        _timestamp(params, "end"),
+        _int(params, "width", CHART_WIDTH),
+        _choice(params, "how", ("envelope", "mean"), "envelope"),
+        params.get("field"),
+        params.get("node"),
+    )
+    return series.rename(sensor).rename_axis("timestamp").reset_index()
+
+
+def _rollup_query(params):
+    resolution = _choice(params, "resolution", list(RESOLUTIONS))
+    if resolution is None:
+        raise QueryError("missing parameter: resolution")
+    return load_rollup(resolution, _timestamp(params, "start"), _timestamp(params, "end"), params.get("field"))
+
+
+def _aggregate_query(params):
+    window = _choice(params, "window", [name for name in WINDOWS.values() if name])
+    summary = window_summary(window, params.get("field"))
+    return pd.DataFrame.from_dict(summary, orient="index").rename_axis("sensor").reset_index()
+
+
+def _means_query(params):
+    window = _choice(params, "window", [name for name in WINDOWS.values() if name])
+    return field_means(window).reset_index()
+
+
+def _correlation_query(params):
+    matrix = correlation_matrix(_int(params, "days"), params.get("field"))
+    return matrix.rename_axis("sensor").reset_index()
+
+
+def _fields_query(params):
+    manifest = ensure_store()
+    rows = []
+    for field in list_fields():
+        partitions = get_partitions(manifest, field)
+        rows.append({
+            "field": field,
+            "nodes": ",".join(sorted({node for entry in partitions.values() for node in entry["nodes"]})),
+            "start": pd.Timestamp(min(entry["start"] for entry in partitions.values())) if partitions else pd.NaT,
+            "end": pd.Timestamp(max(entry["end"] for entry in partitions.values())) if partitions else pd.NaT,
+            "version": get_data_version(field),
+        })
+    return pd.DataFrame(rows, columns=["field", "nodes", "start", "end", "version"])
+
+
+def _anomalies_query(params):
+    _required(params, "sensor")
+    return load_anomalies(
+        _choice(params, "sensor", SENSORS),
+        _timestamp(params, "start"),
+        _timestamp(params, "end"),
+        params.get("field"),
+        params.get("node"),
+    )
+
+
+class Queries:
+    """
+    The endpoints of the service and the state they share.
+
+    Every endpoint has a query, returning a DataFrame (or None if there is
+    nothing to return), and a version function, returning a value that
+    changes whenever the query's result may change.
+
+    Args:
+        forecasts (ForecastService): The forecast cache of this process.
+        scheduler (ForecastScheduler): The scheduler training the models in
+            this process, if any.
+    """
+
+    def __init__(self, forecasts=None, scheduler=None):
+        self.forecasts = forecasts or ForecastService()
+        self.scheduler = scheduler
+        self.endpoints = {
+            "range": (_range_query, _field_version),
+            "series": (_series_query, _field_version),
+            "rollup": (_rollup_query, _field_version),
+            "aggregate": (_aggregate_query, _field_version),
+            "means": (_means_query, lambda params: get_data_version()),
+            "correlation": (_correlation_query, _field_version),
+            "forecast": (self._forecast_query, self._forecast_version),
+            "fields": (_fields_query, lambda params: get_data_version()),
+            "anomalies": (_anomalies_query, _field_version),
+            "forecast_status": (self._forecast_status_query, lambda params: None),
+        }
+
+    def _forecast_status_query(self, params):
+        return pd.DataFrame([{
+            "age": forecast_age(),
+            "running": self.scheduler is not None and self.scheduler.running,
+            "last_error": None if self.scheduler is None else self.scheduler.last_error,
+        }])
+
+    def _forecast_query(self, params):
+        start, end = _timestamp(params, "start"), _timestamp(params, "end")
+        if start is None or end is None:
+            raise QueryError("missing parameter: start or end")
+        engine = _choice(params, "engine", ENGINES)
+        return self.forecasts.window(start, end, field=params.get("field"), engine=engine)
+
+    def _forecast_version(self, params):
+        models = self.forecasts.models(_choice(params, "engine", ENGINES))
+        return None if models is None else models.version
+
+    def run(self, name, params, etag=None):
+        """
+        Answers a query.
+
+        Args:
+            name (str): The endpoint.
+            params (dict): The query parameters.
+            etag (str): The client's ``If-None-Match`` header, if any.
+
+        Returns:
+            tuple: The ETag of the result (None if the result is not
+            versioned) and the result: a DataFrame, None if there is no
+            data, or ``NOT_MODIFIED`` if the client's copy is current.
+
+        Raises:
+            QueryError: If a parameter is missing or invalid.
+        """
+        query, version = self.endpoints[name]
+        # Label this endpoint's timings (see timing)
+        track_page(f"api:{name}")
+        current = version(params)
+        tag = None if current is None else '"' + hashlib.sha1(repr(current).encode()).hexdigest()[:16] + '"'
+        if tag is not None and tag == etag:
+            return tag, NOT_MODIFIED
+        try:
+            return tag, query(params)
+        except KeyError as e:
+            # A sensor or column the data does not have
+            raise QueryError(f"unknown column {e.args[0]}") from e
+        except ValueError as e:
+            raise QueryError(str(e)) from e
+
+
+def encode(data, arrow):
+    """
+    Serializes a result table.
+
+    Args:
+        data (pandas.DataFrame): The table.
+        arrow (bool): Whether to write an Arrow IPC stream instead of JSON.
+
+    Returns:
+        bytes: The response body.
+    """
+    with phase("encode"):
+        if not arrow:
+            return data.to_json(orient="records", date_format="iso").encode()
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class QueryHandler(tornado.web.RequestHandler):
+    """
+    Answers ``GET /<endpoint>`` on the thread pool.
+    """
+
+    def initialize(self, queries, executor):
+        self.queries = queries
+        self.executor = executor
+
+    def compute_etag(self):
+        # The data version is the ETag; don't hash every body
+        return None
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"error": self._reason}))
+
+    def _answer(self, name, params, etag, arrow):
+        tag, data = self.queries.run(name, params, etag)
+        if data is None or data is NOT_MODIFIED:
+            return tag, data
+        return tag, encode(data, arrow)
+
+    async def get(self, name):
+        if name not in self.queries.endpoints:
+            raise tornado.web.HTTPError(404, reason=f"unknown endpoint: {name}")
+        params = {key: self.get_argument(key) for key in self.request.arguments}
+        arrow = params.pop("format", None) == "arrow" or ARROW_TYPE in self.request.headers.get("Accept", "")
+        etag = self.request.headers.get("If-None-Match")
+        try:
+            tag, body = await tornado.ioloop.IOLoop.current().run_in_executor(
+                self.executor, self._answer, name, params, etag, arrow
+            )
+        except QueryError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        if tag is not None:
+            self.set_header("ETag", tag)
+        if body is NOT_MODIFIED:
+            self.set_status(304)
+        elif body is None:
+            raise tornado.web.HTTPError(404, reason="no data")
+        else:
+            self.set_header("Content-Type", ARROW_TYPE if arrow else "application/json")
+            self.write(body)
+
+
+class ExportHandler(QueryHandler):
+    """
+    Streams ``GET /export`` (see ``export``), writing every chunk as soon as
+    it is ready.
+    """
+
+    def _start(self, params):
+        # Label this endpoint's timings (see timing)
+        track_page("api:export")
+        fmt = params.pop("format", None) or "csv"
+        source = params.get("source") or "readings"
+        resolution = params.get("resolution")
+        query = dict(
+            source=source,
+            start=_timestamp(params, "start"),
+            end=_timestamp(params, "end"),
+            sensors=_list(params, "sensors"),
+            fields=_list(params, "fields"),
+            nodes=_list(params, "nodes"),
+            resolution=None if resolution in (None, "", "raw") else resolution,
+        )
+        if source == "forecast":
+            query["engine"] = params.get("engine")
+            query["service"] = self.queries.forecasts
+        try:
+            chunks = stream_export(fmt, **query)
+        except ValueError as e:
+            raise QueryError(str(e)) from e
+        return fmt, export_filename(fmt, source, query["start"], query["end"], query["fields"]), chunks
+
+    @staticmethod
+    def _next(chunks):
+        track_page("api:export")
+        return next(chunks, None)
+
+    async def get(self):
+        params = {key: self.get_argument(key) for key in self.request.arguments}
+        loop = tornado.ioloop.IOLoop.current()
+        try:
+            fmt, filename, chunks = await loop.run_in_executor(self.executor, self._start, params)
+        except QueryError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        self.set_header("Content-Type", EXPORT_FORMATS[fmt])
+        self.set_header("Content-Disposition", f'attachment; filename="{filename}"')
+        try:
+            while True:
+                data = await loop.run_in_executor(self.executor, self._next, chunks)
+                if data is None:
+                    break
+                if data:
+                    self.write(data)
+                    await self.flush()
+        except tornado.iostream.StreamClosedError:
+            # The client went away; stop reading
+            pass
+        finally:
+            chunks.close()
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"status": "ok"})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics_text())
+
+
+def make_app(threads=None, scheduler=None):
+    """
+    Creates the tornado application of the service.
+
+    Args:
+        threads (int): Query threads (``get_threads()`` if not given).
+        scheduler (ForecastScheduler): The scheduler running in this
+            process, if any (reported by ``/forecast_status``).
+
+    Returns:
+        tornado.web.Application: The application.
+    """
+    executor = ThreadPoolExecutor(threads or get_threads(), thread_name_prefix="query")
+    handler_args = {"queries": Queries(scheduler=scheduler), "executor": executor}
+    return tornado.web.Application([
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/export", ExportHandler, handler_args),
+        (r"/(\w+)", QueryHandler, handler_args),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve queries over the sensor store.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8503, help="port to listen on")
+    parser.add_argument("--threads", type=int, default=None, help="query threads (QUERY_API_THREADS)")
+    args = parser.parse_args()
+
+    # The caches are used without a Streamlit server; don't warn about it on every query
+    from streamlit.logger import get_logger
+
+    get_logger("streamlit.runtime.caching.cache_data_api").disabled = True
+    get_logger("streamlit.runtime.caching.cache_resource_api").disabled = True
+    # Build the store and rollups up front so queries only ever read them
+    ensure_rollups()
+    # The forecasts are served from here, so the models are trained here too
+    scheduler = None
+    if os.environ.get("FORECAST_SCHEDULER", "on") != "off":
+        scheduler = ForecastScheduler()
+        scheduler.start()
+
+    # Log every request, like the ingest service
+    tornado.log.enable_pretty_logging()
+    app = make_app(args.threads, scheduler)
+    app.listen(args.port, args.host)
+    print(f"Serving queries on http://{args.host}:{args.port}")
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+The dashboard's queries, answered locally or by the query service.
+
+Pages import their queries from here instead of from the modules that
+compute them, together with what they read from the store manifest (the
+fields, nodes, time bounds and data versions) and the state of the forecast
+models::
+
+    from query_client import chart_series, query_range, select_field
+
+Without ``QUERY_API_URL`` every function calls its local implementation in
+this process. With it (e.g. ``QUERY_API_URL=http://127.0.0.1:8503``, see
+``query_api``) the queries are sent to the service, which keeps the data and
+models warm for every dashboard process, so the dashboard never opens the
+store itself:
+
+* requests go through one pool of keep-alive connections per process
+  (``QUERY_API_POOL`` connections, 8 by default), shared by all sessions,
+* results come back as Arrow IPC streams,
+* the last ``CACHE_ENTRIES`` results are kept with their ETag and
+  revalidated with ``If-None-Match``, so a rerun over unchanged data costs a
+  304 and no transfer.
+"""
+import os
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+import urllib3
+
+import anomalies
+import correlation_engine
+import forecast_scheduler
+import rollups
+import running_stats
+import sensor_store
+from forecast_service import get_forecast_service
+from timing import cache_miss, cache_request, phase
+
+# Results kept for revalidation per process
+CACHE_ENTRIES = 64
+
+# Content type of the Arrow IPC streams exchanged with the service
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+# Seconds to wait for the service to connect and to answer
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 300.0
+
+
+class QueryClient:
+    """
+    Thread-safe client of the query service.
+
+    Args:
+        url (str): Base URL of the service, e.g. "http://127.0.0.1:8503".
+        pool_size (int): Connections kept open to the service.
+        cache_entries (int): Results kept for revalidation.
+    """
+
+    def __init__(self, url, pool_size=8, cache_entries=CACHE_ENTRIES):
+        self.url = url.rstrip("/")
+        self.pool = urllib3.PoolManager(
+            maxsize=pool_size,
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+        )
+        self.cache_entries = cache_entries
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, **params):
+        """
+        Runs a query on the service.
+
+        Args:
+            endpoint (str): The endpoint, e.g. "range".
+            **params: The query parameters; None values are left out, lists
+                are joined with commas.
+
+        Returns:
+            pandas.DataFrame: The result, or None if the service has no data
+            for the query.
+
+        Raises:
+            RuntimeError: If the service rejects the query or fails.
+        """
+        query = {}
+        for name, value in params.items():
+            if value is None:
+                continue
+            query[name] = ",".join(map(str, value)) if isinstance(value, (list, tuple)) else str(value)
+        url = f"{self.url}/{endpoint}"
+        if query:
+            url += "?" + urllib.parse.urlencode(sorted(query.items()))
+
+        cache_request("query_api")
+        with self._lock:
+            cached = self._results.get(url)
+        headers = {"Accept": ARROW_TYPE}
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        with phase("load"):
+            response = self.pool.request("GET", url, headers=headers)
+        if response.status == 304:
+            with self._lock:
+                cached = self._results.get(url)
+                if cached is not None:
+                    self._results.move_to_end(url)
+                    return cached[1]
+            # Evicted by another thread meanwhile: fetch the result again
+            del headers["If-None-Match"]
+            with phase("load"):
+                response = self.pool.request("GET", url, headers=headers)
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise RuntimeError(f"query service: {response.status} {response.reason} ({url})")
+
+        cache_miss("query_api")
+        with phase("load"):
+            data = pa.ipc.open_stream(response.data).read_pandas()
+        tag = response.headers.get("ETag")
+        if tag is not None:
+            with self._lock:
+                self._results[url] = (tag, data)
+                self._results.move_to_end(url)
+                while len(self._results) > self.cache_entries:
+                    self._results.popitem(last=False)
+        return data
+
+
+def _result(data, endpoint):
+    # Only forecasts may be missing; the other queries always have a result
+    if data is None:
+        raise RuntimeError(f"query service: no result for /{endpoint}")
+    return data
+
+
+@st.cache_resource
+def get_client():
+    """
+    Returns the query client shared by all sessions of this server process.
+
+    Returns:
+        QueryClient: The client, or None if ``QUERY_API_URL`` is not set.
+    """
+    url = os.environ.get("QUERY_API_URL")
+    if not url:
+        return None
+    return QueryClient(url, int(os.environ.get("QUERY_API_POOL", 8)))
+
+
+def query_range(start=None, end=None, closed="both", columns=None, compact=None, field=None, nodes=None):
+    """
+    Returns the readings of a field inside a time range (see
+    ``sensor_store.query_range``).
+    """
+    client = get_client()
+    if client is None:
+        return sensor_store.query_range(start, end, closed, columns, compact, field, nodes)
+    compact = None if compact is None else int(compact)
+    data = client.get("range", start=start, end=end, closed=closed, columns=columns, compact=compact, field=field, nodes=nodes)
+    return _result(data, "range")
+
+
+def load_readings(columns=None, compact=None, field=None):
+    """
+    Returns the complete sensor history of a field (see
+    ``sensor_store.load_readings``).
+    """
+    return query_range(columns=columns, compact=compact, field=field)
+
+
+def chart_series(sensor, start=None, end=None, width=rollups.CHART_WIDTH, how="envelope", field=None, node=None):
+    """
+    Returns a series sized for a chart of the given pixel width (see
+    ``rollups.chart_series``).
+    """
+    client = get_client()
+    if client is None:
+        return rollups.chart_series(sensor, start, end, width, how, field, node)
+    data = client.get("series", sensor=sensor, start=start, end=end, width=width, how=how, field=field, node=node)
+    if data is None:
+        return pd.Series(dtype="float64", name=sensor)
+    return data.set_index("timestamp")[sensor]
+
+
+def load_rollup(resolution, start=None, end=None, field=None):
+    """
+    Loads the buckets of one resolution that overlap a time range (see
+    ``rollups.load_rollup``).
+    """
+    client = get_client()
+    if client is None:
+        return rollups.load_rollup(resolution, start, end, field)
+    return _result(client.get("rollup", resolution=resolution, start=start, end=end, field=field), "rollup")
+
+
+def window_summary(name=None, field=None):
+    """
+    Returns count, mean, std, min and max per sensor over a window (see
+    ``running_stats.window_summary``).
+    """
+    client = get_client()
+    if client is None:
+        return running_stats.window_summary(name, field)
+    data = _result(client.get("aggregate", window=name, field=field), "aggregate")
+    return data.set_index("sensor").to_dict(orient="index")
+
+
+def field_means(name=None):
+    """
+    Returns the mean of every sensor in every field over a window (see
+    ``running_stats.field_means``).
+    """
+    client = get_client()
+    if client is None:
+        return running_stats.field_means(name)
+    return _result(client.get("means", window=name), "means").set_index("field")
+
+
+def correlation_matrix(days=None, field=None):
+    """
+    Returns the correlation matrix of the sensors of a field (see
+    ``correlation_engine.correlation_matrix``).
+    """
+    client = get_client()
+    if client is None:
+        return correlation_engine.correlation_matrix(days, field)
+    data = _result(client.get("correlation", days=days, field=field), "correlation")
+    return data.set_index("sensor").rename_axis(None)
+
+
+def forecast_window(start, end, field=None, engine=None):
+    """
+    Returns hourly predictions for a time window (see
+    ``forecast_service.ForecastService.window``).
+    """
+    client = get_client()
+    if client is None:
+        return get_forecast_service().window(start, end, field=field, engine=engine)
+    return client.get("forecast", start=start, end=end, field=field, engine=engine)
+
+
+def _field_info(field=None):
+    # The field's row of /fields (None if the store has no such field)
+    fields = _result(get_client().get("fields"), "fields")
+    rows = fields[fields["field"] == (field or sensor_store.get_default_field())]
+    return None if rows.empty else rows.iloc[0]
+
+
+def list_fields():
+    """
+    Returns the fields present in the store (see ``sensor_store.list_fields``).
+    """
+    client = get_client()
+    if client is None:
+        return sensor_store.list_fields()
+    return _result(client.get("fields"), "fields")["field"].tolist() or [sensor_store.get_default_field()]
+
+
+def list_nodes(field=None):
+    """
+    Returns the sensor nodes of a field (see ``sensor_store.list_nodes``).
+    """
+    if get_client() is None:
+        return sensor_store.list_nodes(field)
+    info = _field_info(field)
+    return [] if info is None or not info["nodes"] else info["nodes"].split(",")
+
+
+def get_time_bounds(field=None):
+    """
+    Returns the time range covered by a field (see
+    ``sensor_store.get_time_bounds``).
+    """
+    if get_client() is None:
+        return sensor_store.get_time_bounds(field)
+    info = _field_info(field)
+    if info is None or pd.isna(info["start"]):
+        return None, None
+    return pd.Timestamp(info["start"]), pd.Timestamp(info["end"])
+
+
+def get_data_version(field=None):
+    """
+    Returns a value that changes whenever a field is written (see
+    ``sensor_store.get_data_version``; without a field, the latest version of
+    any field).
+    """
+    client = get_client()
+    if client is None:
+        return sensor_store.get_data_version(field)
+    if field is None:
+        return int(_result(client.get("fields"), "fields")["version"].max())
+    info = _field_info(field)
+    return 0 if info is None else int(info["version"])
+
+
+def select_field():
+    """
+    Shows the field selector in the sidebar (see
+    ``sensor_store.select_field``).
+    """
+    return sensor_store.select_field(list_fields())
+
+
+def load_anomalies(sensor, start=None, end=None, field=None, node=None):
+    """
+    Returns the flagged readings of a sensor inside a time range (see
+    ``anomalies.load_anomalies``).
+    """
+    client = get_client()
+    if client is None:
+        return anomalies.load_anomalies(sensor, start, end, field, node)
+    data = client.get("anomalies", sensor=sensor, start=start, end=end, field=field, node=node)
+    return _result(data, "anomalies")
+
+
+def forecast_status():
+    """
+    Returns how old the forecast models are and whether they are being
+    retrained.
+
+    Returns:
+        dict: ``age`` (seconds, None if a model is missing, see
+        ``forecast_scheduler.forecast_age``), ``running`` (a training is in
+        progress) and ``last_error`` (why the last training failed, or None).
+    """
+    client = get_client()
+    if client is None:
+        scheduler = forecast_scheduler.get_scheduler()
+        return {
+            "age": forecast_scheduler.forecast_age(),
+            "running": scheduler is not None and scheduler.running,
+            "last_error": None if scheduler is None else scheduler.last_error,
+        }
+    status = _result(client.get("forecast_status"), "forecast_status").iloc[0]
+    return {
+        "age": None if pd.isna(status["age"]) else float(status["age"]),
+        "running": bool(status["running"]),
+        "last_error": None if pd.isna(status["last_error"]) else status["last_error"],
+    }
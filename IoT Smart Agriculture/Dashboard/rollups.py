@@ -0,0 +1,433 @@
+"""
+Pre-aggregated rollups of the sensor readings and chart downsampling.
+
+The raw 5-minute readings are rolled up into 1 minute, 1 hour, 1 day and
+1 week buckets. Every bucket holds count, min, max, mean and last for each
+sensor, so a chart over a long range can be drawn from a few hundred buckets
+instead of every raw point. Rollups are kept per field, over all of the
+field's nodes, and stored next to the readings, one Parquet file per field,
+resolution and month::
+
+    store/rollups/prizren/1h/2023-05.parquet
+
+Charts of a single node are drawn from the raw readings.
+
+They are built from the store the first time they are needed and then kept
+up to date with ``update_rollups`` as new readings arrive.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from sensor_store import (
+    LAYOUT_VERSION,
+    SENSORS,
+    TimeIndex,
+    ensure_store,
+    get_default_field,
+    get_partitions,
+    get_store_dir,
+    get_time_bounds,
+    partition_keys,
+    query_range,
+    read_partition,
+    store_lock,
+    to_epoch,
+    write_table,
+)
+from timing import cache_miss, cache_request, phase
+
+# Bucket width of every resolution in nanoseconds, finest first
+RESOLUTIONS = {
+    "1min": 60 * 10**9,
+    "1h": 3600 * 10**9,
+    "1d": 86400 * 10**9,
+    "1w": 7 * 86400 * 10**9,
+}
+
+# Weekly buckets start on Monday (the epoch, 1970-01-01, was a Thursday)
+WEEK_OFFSET = 4 * 86400 * 10**9
+
+# Statistics kept per sensor and bucket
+STATS = ["count", "min", "max", "mean", "last"]
+
+# Default chart width in pixels (the pages use the wide layout)
+CHART_WIDTH = 1200
+
+
+def get_rollup_dir(resolution=None, field=None):
+    """
+    Returns the directory holding the rollups.
+
+    Args:
+        resolution (str): One of ``RESOLUTIONS``, or None for the top directory.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to the directory.
+    """
+    rollup_dir = os.path.join(get_store_dir(), "rollups")
+    return rollup_dir if resolution is None else os.path.join(rollup_dir, field or get_default_field(), resolution)
+
+
+def bucket_starts(timestamps, resolution):
+    """
+    Assigns every timestamp to the start of its bucket.
+
+    Args:
+        timestamps (pandas.Series): Datetime64 values.
+        resolution (str): One of ``RESOLUTIONS``.
+
+    Returns:
+        numpy.ndarray: Bucket starts as int64 nanoseconds since the epoch.
+    """
+    width = RESOLUTIONS[resolution]
+    offset = WEEK_OFFSET if resolution == "1w" else 0
+    epochs = np.asarray(timestamps, dtype="datetime64[ns]").view("int64")
+    return (epochs - offset) // width * width + offset
+
+
+def aggregate(data, resolution):
+    """
+    Rolls raw readings up into buckets.
+
+    Args:
+        data (pandas.DataFrame): Readings with a ``timestamp`` column.
+        resolution (str): One of ``RESOLUTIONS``.
+
+    Returns:
+        pandas.DataFrame: One row per bucket with a ``timestamp`` (bucket
+        start), a ``last_ts`` (latest reading in the bucket) and
+        ``<sensor>_<stat>`` columns.
+    """
+    buckets = bucket_starts(data["timestamp"], resolution)
+    grouped = data[SENSORS].groupby(buckets, sort=True)
+    rollup = grouped.agg(STATS)
+    rollup.columns = [f"{sensor}_{stat}" for sensor, stat in rollup.columns]
+    rollup.insert(0, "last_ts", data["timestamp"].groupby(buckets, sort=True).max())
+    rollup.insert(0, "timestamp", pd.to_datetime(rollup.index.to_numpy(), unit="ns"))
+    return rollup.reset_index(drop=True)
+
+
+def merge_rollups(old, new):
+    """
+    Merges two rollups of the same resolution.
+
+    Buckets present in both are combined: counts add up, means are weighted by
+    count, min/max are combined and ``last`` comes from the newer reading.
+
+    Args:
+        old (pandas.DataFrame): The existing rollup.
+        new (pandas.DataFrame): The rollup of newly arrived readings.
+
+    Returns:
+        pandas.DataFrame: The merged rollup, sorted by bucket.
+    """
+    if old.empty:
+        return new
+    a = old.set_index("timestamp")
+    b = new.set_index("timestamp")
+    index = a.index.union(b.index)
+    a = a.reindex(index)
+    b = b.reindex(index)
+
+    b_newer = b["last_ts"].notna() & (a["last_ts"].isna() | (b["last_ts"] >= a["last_ts"]))
+    merged = pd.DataFrame({"last_ts": b["last_ts"].where(b_newer, a["last_ts"])}, index=index)
+    for sensor in SENSORS:
+        count_a = a[f"{sensor}_count"].fillna(0)
+        count_b = b[f"{sensor}_count"].fillna(0)
+        count = count_a + count_b
+        total = a[f"{sensor}_mean"].fillna(0) * count_a + b[f"{sensor}_mean"].fillna(0) * count_b
+        merged[f"{sensor}_count"] = count.astype("int64")
+        merged[f"{sensor}_min"] = np.fmin(a[f"{sensor}_min"], b[f"{sensor}_min"])
+        merged[f"{sensor}_max"] = np.fmax(a[f"{sensor}_max"], b[f"{sensor}_max"])
+        merged[f"{sensor}_mean"] = (total / count).where(count > 0)
+        last = b[f"{sensor}_last"].where(b_newer & b[f"{sensor}_last"].notna(), a[f"{sensor}_last"])
+        merged[f"{sensor}_last"] = last.fillna(b[f"{sensor}_last"])
+    return merged.rename_axis("timestamp").reset_index()
+
+
+def _empty_rollup():
+    columns = ["timestamp", "last_ts"] + [f"{sensor}_{stat}" for sensor in SENSORS for stat in STATS]
+    return pd.DataFrame(columns=columns)
+
+
+def _rollup_path(resolution, key, field=None):
+    return os.path.join(get_rollup_dir(resolution, field), f"{key}.parquet")
+
+
+def _read_rollup_file(path):
+    try:
+        return pq.read_table(path).to_pandas()
+    except FileNotFoundError:
+        return None
+
+
+def read_rollup_month(resolution, key, field=None):
+    """
+    Reads the buckets of one resolution starting in one month, bypassing the
+    rollup cache.
+
+    For one pass over a long range (exports), so only the month being
+    processed is held in memory.
+
+    Args:
+        resolution (str): One of ``RESOLUTIONS``.
+        key (str): The month, e.g. "2023-05".
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        pandas.DataFrame: The buckets, sorted by bucket start, or None if the
+        month has no readings.
+    """
+    return _read_rollup_file(_rollup_path(resolution, key, field))
+
+
+def update_rollups(data, field=None):
+    """
+    Folds newly arrived readings into every rollup resolution.
+
+    Only the monthly rollup files of the touched fields and buckets are read
+    and rewritten; the rest of the history is left alone.
+
+    Args:
+        data (pandas.DataFrame): The new readings. Readings are grouped by
+            their ``field_id`` column if there is one.
+        field (str): The field of all readings, if ``data`` has no
+            ``field_id`` column (``get_default_field()`` if not given).
+    """
+    if data.empty:
+        return
+    if "field_id" in data.columns:
+        groups = data.groupby("field_id", sort=True)
+    else:
+        groups = [(field or get_default_field(), data)]
+    for field, field_data in groups:
+        for resolution in RESOLUTIONS:
+            new = aggregate(field_data, resolution)
+            months = partition_keys(new["timestamp"])
+            for key, new_month in new.groupby(months, sort=True):
+                path = _rollup_path(resolution, key, field)
+                old = _read_rollup_file(path)
+                merged = new_month if old is None else merge_rollups(old, new_month)
+                write_table(pa.Table.from_pandas(merged, preserve_index=False), path)
+
+
+def _read_state():
+    try:
+        with open(os.path.join(get_rollup_dir(), "state.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(state):
+    path = os.path.join(get_rollup_dir(), "state.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def build_rollups():
+    """
+    Rebuilds the rollups of every field from the readings store, one
+    partition at a time.
+    """
+    with store_lock():
+        manifest = ensure_store()
+        shutil.rmtree(get_rollup_dir(), ignore_errors=True)
+        os.makedirs(get_rollup_dir(), exist_ok=True)
+        for field in sorted(manifest["fields"]):
+            for key in sorted(get_partitions(manifest, field)):
+                update_rollups(read_partition(key, manifest, field=field), field)
+        _write_state({"source_mtime": manifest.get("source_mtime"), "layout": LAYOUT_VERSION})
+
+
+def _rollups_current(manifest):
+    state = _read_state()
+    return state.get("source_mtime", -1) == manifest.get("source_mtime") and state.get("layout") == LAYOUT_VERSION
+
+
+def ensure_rollups():
+    """
+    Makes sure the rollups exist and belong to the current store and layout.
+    """
+    if _rollups_current(ensure_store()):
+        return
+    with store_lock():
+        # Another process may have rebuilt them while this one waited
+        if not _rollups_current(ensure_store()):
+            build_rollups()
+
+
+@st.cache_data(show_spinner=False)
+def _load_rollup_file(path, mtime):
+    # The modification time is only part of the cache key
+    cache_miss("rollup")
+    return _read_rollup_file(path)
+
+
+def load_rollup(resolution, start=None, end=None, field=None):
+    """
+    Loads the buckets of one resolution that overlap a time range.
+
+    Args:
+        resolution (str): One of ``RESOLUTIONS``.
+        start: Start of the range, or None for an open start.
+        end: End of the range, or None for an open end.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        pandas.DataFrame: The buckets, sorted by bucket start.
+    """
+    ensure_rollups()
+    first, last = get_time_bounds(field)
+    if first is None:
+        return _empty_rollup()
+    # A bucket starting before ``start`` may still overlap it
+    start = pd.Timestamp(first if start is None else start)
+    end = pd.Timestamp(last if end is None else end)
+    bucket_start = pd.Timestamp(int(bucket_starts(pd.Series([start]), resolution)[0]))
+
+    frames = []
+    for month in pd.period_range(bucket_start, end, freq="M"):
+        path = _rollup_path(resolution, month.strftime("%Y-%m"), field)
+        if os.path.exists(path):
+            cache_request("rollup")
+            frames.append(_load_rollup_file(path, os.path.getmtime(path)))
+    if not frames:
+        return _empty_rollup()
+    rollup = pd.concat(frames, ignore_index=True)
+    return rollup.iloc[TimeIndex(rollup["timestamp"]).slice(bucket_start, end)]
+
+
+def estimate_rows(start=None, end=None, field=None):
+    """
+    Estimates the number of raw readings in a range from the manifest alone.
+
+    Args:
+        start: Start of the range, or None for an open start.
+        end: End of the range, or None for an open end.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        int: The estimated number of rows.
+    """
+    partitions = get_partitions(ensure_store(), field).values()
+    start_epoch = -np.inf if start is None else to_epoch(start)
+    end_epoch = np.inf if end is None else to_epoch(end)
+    rows = 0.0
+    for entry in partitions:
+        overlap = min(entry["end"], end_epoch) - max(entry["start"], start_epoch)
+        if overlap < 0:
+            continue
+        span = max(entry["end"] - entry["start"], 1)
+        rows += entry["rows"] * min(1.0, (overlap + 1) / span)
+    return int(np.ceil(rows))
+
+
+def choose_resolution(start, end, width=CHART_WIDTH, field=None):
+    """
+    Picks the finest rollup that still fits a chart of the given width.
+
+    Args:
+        start: Start of the visible range.
+        end: End of the visible range.
+        width (int): Chart width in pixels.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The resolution, or None when the raw readings fit.
+    """
+    if estimate_rows(start, end, field) <= 2 * width:
+        return None
+    span = to_epoch(end) - to_epoch(start)
+    for resolution, bucket_width in RESOLUTIONS.items():
+        if span / bucket_width <= width:
+            return resolution
+    return "1w"
+
+
+def downsample_minmax(series, points):
+    """
+    Downsamples a series while keeping its extremes.
+
+    The series is cut into ``points / 2`` equal-count bins and only the minimum
+    and the maximum of every bin are kept, in time order, so spikes survive
+    downsampling.
+
+    Args:
+        series (pandas.Series): The values, indexed by timestamp.
+        points (int): The maximum number of points to return.
+
+    Returns:
+        pandas.Series: The downsampled series.
+    """
+    series = series.dropna()
+    if len(series) <= points:
+        return series
+    bins = max(points // 2, 1)
+    values = pd.Series(series.to_numpy())
+    grouped = values.groupby(np.arange(len(values)) * bins // len(values))
+    keep = np.union1d(grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy())
+    return series.iloc[keep]
+
+
+def chart_series(sensor, start=None, end=None, width=CHART_WIDTH, how="envelope", field=None, node=None):
+    """
+    Returns a series sized for a chart of the given pixel width.
+
+    Small ranges are served from the raw readings; larger ones from the finest
+    rollup of the field that fits, so the browser never receives more than
+    about two points per pixel. A single node is always served from its raw
+    readings (downsampled the same way).
+
+    Args:
+        sensor (str): One of ``SENSORS``.
+        start: Start of the visible range, or None for the first reading.
+        end: End of the visible range, or None for the last reading.
+        width (int): Chart width in pixels.
+        how (str): "envelope" to keep every bucket's min and max (line
+            charts), "mean" for one mean value per bucket (bar charts).
+        field (str): The field id (``get_default_field()`` if not given).
+        node (str): Only chart this node (all of the field's nodes if not
+            given).
+
+    Returns:
+        pandas.Series: The values, indexed by timestamp.
+    """
+    first, last = get_time_bounds(field)
+    start = first if start is None else pd.Timestamp(start)
+    end = last if end is None else pd.Timestamp(end)
+    if first is None:
+        return pd.Series(dtype="float64", name=sensor)
+
+    resolution = None if node is not None else choose_resolution(start, end, width, field)
+    if resolution is None:
+        nodes = None if node is None else [node]
+        with phase("load"):
+            raw = query_range(start, end, columns=[sensor], compact=False, field=field, nodes=nodes)
+        with phase("resample"):
+            return downsample_minmax(raw.set_index("timestamp")[sensor], 2 * width)
+
+    with phase("load"):
+        rollup = load_rollup(resolution, start, end, field)
+    with phase("resample"):
+        rollup = rollup[rollup[f"{sensor}_count"] > 0]
+        if how == "mean":
+            series = rollup.set_index("timestamp")[f"{sensor}_mean"]
+        else:
+            # Draw each bucket as its min followed by its max, half a bucket later
+            half = pd.Timedelta(RESOLUTIONS[resolution] // 2, unit="ns")
+            series = pd.concat([
+                pd.Series(rollup[f"{sensor}_min"].to_numpy(), index=rollup["timestamp"]),
+                pd.Series(rollup[f"{sensor}_max"].to_numpy(), index=rollup["timestamp"] + half),
+            ]).sort_index(kind="stable")
+        return downsample_minmax(series.rename(sensor), 2 * width)
@@ -0,0 +1,399 @@
+"""
+Streaming running statistics for the home page cards.
+
+Every field keeps, for every sensor and over all of the field's nodes, a
+Welford accumulator (count, mean, variance, min, max) over
+its whole history, plus hourly and daily accumulators that make up the time
+windows shown on the home page (last 24 hours, last 7 days, this season).
+Adding a reading is O(1); a window is served by merging at most a few hundred
+bucket accumulators, without touching the raw readings.
+
+The accumulators are saved to ``store/stats/<field>.json``, one file per field.
+They are built from the store once and then updated by the ingestion service
+as readings arrive.
+"""
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from sensor_store import SENSORS, ensure_store, get_default_field, get_partitions, get_store_dir, list_fields, read_partition
+from timing import cache_miss, cache_request
+
+HOUR = 3600 * 10**9
+DAY = 24 * HOUR
+
+# Hourly buckets are kept for a week, daily buckets for a season and a bit
+HOUR_RETENTION = 7 * DAY
+DAY_RETENTION = 100 * DAY
+
+# Time windows offered on the home page
+WINDOWS = {
+    "All time": None,
+    "Last 24 hours": "24h",
+    "Last 7 days": "7d",
+    "This season": "season",
+}
+
+# First month of each meteorological season
+SEASON_START_MONTHS = {12: 12, 1: 12, 2: 12, 3: 3, 4: 3, 5: 3, 6: 6, 7: 6, 8: 6, 9: 9, 10: 9, 11: 9}
+
+
+class RunningStats:
+    """
+    Welford accumulator for count, mean, variance, min and max.
+    """
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min=math.inf, max=-math.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Builds an accumulator from an array of values in one vectorized pass.
+
+        Args:
+            values (numpy.ndarray): The values; NaNs are ignored.
+
+        Returns:
+            RunningStats: The accumulator.
+        """
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return cls()
+        mean = float(values.mean())
+        return cls(len(values), mean, float(((values - mean) ** 2).sum()), float(values.min()), float(values.max()))
+
+    def update(self, value):
+        """
+        Adds one value (NaN is ignored).
+
+        Args:
+            value (float): The new value.
+        """
+        if value is None or math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """
+        Folds another accumulator into this one (Chan et al.).
+
+        Args:
+            other (RunningStats): The accumulator to merge.
+
+        Returns:
+            RunningStats: This accumulator.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self):
+        """float: The sample variance (NaN with fewer than two values)."""
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self):
+        """float: The sample standard deviation."""
+        return math.sqrt(self.variance)
+
+    def to_list(self):
+        return [self.count, self.mean, self.m2, self.min, self.max]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+
+def season_start(timestamp):
+    """
+    Returns the start of the meteorological season containing a timestamp.
+
+    Args:
+        timestamp (pandas.Timestamp): The timestamp.
+
+    Returns:
+        pandas.Timestamp: Midnight on the first day of the season.
+    """
+    month = SEASON_START_MONTHS[timestamp.month]
+    year = timestamp.year - 1 if month == 12 and timestamp.month != 12 else timestamp.year
+    return pd.Timestamp(year=year, month=month, day=1)
+
+
+class SensorStats:
+    """
+    All-time, hourly and daily accumulators for every sensor.
+    """
+
+    def __init__(self):
+        self.total = {sensor: RunningStats() for sensor in SENSORS}
+        self.hours = {}
+        self.days = {}
+        self.latest = None
+
+    def _bucket(self, buckets, start):
+        if start not in buckets:
+            buckets[start] = {sensor: RunningStats() for sensor in SENSORS}
+        return buckets[start]
+
+    def update(self, timestamp, readings):
+        """
+        Adds one reading in O(1).
+
+        Args:
+            timestamp (pandas.Timestamp): Time of the reading.
+            readings (dict): Value per sensor.
+        """
+        epoch = pd.Timestamp(timestamp).value
+        new_hour = epoch // HOUR * HOUR not in self.hours
+        hour = self._bucket(self.hours, epoch // HOUR * HOUR)
+        day = self._bucket(self.days, epoch // DAY * DAY)
+        for sensor in SENSORS:
+            value = readings.get(sensor)
+            self.total[sensor].update(value)
+            hour[sensor].update(value)
+            day[sensor].update(value)
+        self.latest = epoch if self.latest is None else max(self.latest, epoch)
+        # Old buckets can only fall out of the windows when a new hour starts
+        if new_hour:
+            self.prune()
+
+    def update_frame(self, data):
+        """
+        Adds a batch of readings, aggregated per hour and day with NumPy.
+
+        Args:
+            data (pandas.DataFrame): Readings with a ``timestamp`` column.
+        """
+        if data.empty:
+            return
+        epochs = data["timestamp"].to_numpy().view("int64")
+        for width, buckets in ((HOUR, self.hours), (DAY, self.days)):
+            grouped = data[SENSORS].groupby(epochs // width * width).agg(["count", "mean", "var", "min", "max"])
+            for start, row in zip(grouped.index, grouped.itertuples(index=False)):
+                bucket = self._bucket(buckets, int(start))
+                for i, sensor in enumerate(SENSORS):
+                    count, mean, var, low, high = row[5 * i:5 * i + 5]
+                    if count:
+                        m2 = var * (count - 1) if count > 1 else 0.0
+                        bucket[sensor].merge(RunningStats(int(count), mean, m2, low, high))
+        for sensor in SENSORS:
+            self.total[sensor].merge(RunningStats.from_values(data[sensor].to_numpy()))
+        latest = int(epochs.max())
+        self.latest = latest if self.latest is None else max(self.latest, latest)
+        self.prune()
+
+    def prune(self):
+        """
+        Drops hourly and daily buckets that no window can reach any more.
+        """
+        if self.latest is None:
+            return
+        for buckets, retention in ((self.hours, HOUR_RETENTION), (self.days, DAY_RETENTION)):
+            for start in [start for start in buckets if start < self.latest - retention]:
+                del buckets[start]
+
+    def window(self, name=None):
+        """
+        Returns the statistics of every sensor over a time window.
+
+        Windows end at the latest reading.
+
+        Args:
+            name (str): None for all time, "24h", "7d" or "season".
+
+        Returns:
+            dict: A ``RunningStats`` per sensor.
+        """
+        if name is None or self.latest is None:
+            return self.total
+        if name == "24h":
+            buckets, start = self.hours, self.latest // HOUR * HOUR - 23 * HOUR
+        elif name == "7d":
+            buckets, start = self.hours, self.latest // HOUR * HOUR - (7 * 24 - 1) * HOUR
+        elif name == "season":
+            buckets, start = self.days, season_start(pd.Timestamp(self.latest)).value
+        else:
+            raise ValueError(f"unknown window: {name}")
+
+        result = {sensor: RunningStats() for sensor in SENSORS}
+        for bucket_start, bucket in buckets.items():
+            if bucket_start >= start:
+                for sensor in SENSORS:
+                    result[sensor].merge(bucket[sensor])
+        return result
+
+    def to_dict(self):
+        def dump(buckets):
+            return {str(start): {s: stats.to_list() for s, stats in bucket.items()} for start, bucket in buckets.items()}
+
+        return {
+            "latest": self.latest,
+            "total": {sensor: stats.to_list() for sensor, stats in self.total.items()},
+            "hours": dump(self.hours),
+            "days": dump(self.days),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        def load(buckets):
+            return {int(start): {s: RunningStats.from_list(v) for s, v in bucket.items()} for start, bucket in buckets.items()}
+
+        stats = cls()
+        stats.latest = state["latest"]
+        stats.total = {sensor: RunningStats.from_list(v) for sensor, v in state["total"].items()}
+        stats.hours = load(state["hours"])
+        stats.days = load(state["days"])
+        return stats
+
+
+def get_stats_path(field=None):
+    """
+    Returns the path of the saved accumulators of a field.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to ``stats/<field>.json``.
+    """
+    return os.path.join(get_store_dir(), "stats", f"{field or get_default_field()}.json")
+
+
+def save_stats(stats, source_mtime, field=None):
+    """
+    Saves the accumulators of a field atomically.
+
+    Args:
+        stats (SensorStats): The accumulators.
+        source_mtime (float): The store generation they belong to.
+        field (str): The field id (``get_default_field()`` if not given).
+    """
+    path = get_stats_path(field)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"source_mtime": source_mtime, "stats": stats.to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+def build_stats(field=None):
+    """
+    Builds the accumulators of a field from the readings store, one partition
+    at a time.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        SensorStats: The accumulators.
+    """
+    manifest = ensure_store()
+    stats = SensorStats()
+    for key in sorted(get_partitions(manifest, field)):
+        stats.update_frame(read_partition(key, manifest, field=field))
+    save_stats(stats, manifest.get("source_mtime"), field)
+    return stats
+
+
+def read_stats(field=None):
+    """
+    Reads the saved accumulators of a field, rebuilding them if they are
+    missing or belong to an older store.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        SensorStats: The accumulators.
+    """
+    manifest = ensure_store()
+    try:
+        with open(get_stats_path(field)) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return build_stats(field)
+    if saved["source_mtime"] != manifest.get("source_mtime"):
+        return build_stats(field)
+    return SensorStats.from_dict(saved["stats"])
+
+
+@st.cache_data(show_spinner=False)
+def _window_summary(name, field, path, mtime):
+    # The file path and modification time are only part of the cache key
+    cache_miss("stats")
+    stats = read_stats(field).window(name)
+    return {
+        sensor: {
+            "count": s.count,
+            "mean": s.mean if s.count else math.nan,
+            "std": s.std if s.count > 1 else math.nan,
+            "min": s.min,
+            "max": s.max,
+        }
+        for sensor, s in stats.items()
+    }
+
+
+def window_summary(name=None, field=None):
+    """
+    Returns count, mean, std, min and max per sensor over a window.
+
+    Args:
+        name (str): None for all time, "24h", "7d" or "season".
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        dict: A dict of statistics per sensor.
+    """
+    field = field or get_default_field()
+    path = get_stats_path(field)
+    if not os.path.exists(path):
+        build_stats(field)
+    cache_request("stats")
+    return _window_summary(name, field, path, os.path.getmtime(path))
+
+
+def field_means(name=None):
+    """
+    Returns the mean of every sensor in every field over a window.
+
+    Args:
+        name (str): None for all time, "24h", "7d" or "season".
+
+    Returns:
+        pandas.DataFrame: One row per field, one column per sensor.
+    """
+    means = {
+        field: {sensor: stats["mean"] for sensor, stats in window_summary(name, field).items()}
+        for field in list_fields()
+    }
+    return pd.DataFrame.from_dict(means, orient="index", columns=SENSORS).rename_axis("field")
@@ -0,0 +1,1158 @@
+"""
+Shared data access for the Smart Agriculture dashboard.
+
+All pages and app.py read the sensor readings through this module instead of
+parsing ``cleaned_data.csv`` themselves. The readings are kept in a columnar
+Parquet store with a fixed schema and an already parsed timestamp column. The
+store is (re)built automatically from the CSV whenever it is missing or older
+than the CSV.
+
+Every reading belongs to a field (``field_id``) and was recorded by one of the
+field's sensor nodes (``node_id``). The store is partitioned by field and then
+by calendar month::
+
+    store/
+        manifest.json
+        readings/
+            prizren/
+                2023-01/part-00000.parquet
+                2023-02/part-00000.parquet
+            ...
+
+The field is only recorded in the directory name; the node is a column.
+``manifest.json`` records the partitions of every field with their time range
+and nodes, so a query for one field never opens another field's files.
+Partition-by-partition readers (the export, the rollup, statistics and anomaly
+builds, see ``read_partition``) open one month at a time; the dashboard's
+range queries instead go through the field's shared ``Dataset`` below, which
+holds the whole field in memory and binary searches its sorted timestamps
+(see ``TimeIndex``). Readings without a field or node (such as
+``cleaned_data.csv``) belong to ``DEFAULT_FIELD`` and ``DEFAULT_NODE``.
+
+New readings are appended with ``append_readings``: every batch becomes a new
+part file in its month and history is never rewritten. Replacing the source
+CSV imports it again: its readings replace the stored readings of the same
+node and time, and readings appended since (by ingestion or ``backfill.py``,
+see ``read_csv_batches``) are kept. A store written with an older layout is
+moved aside to ``readings-layout<N>`` rather than deleted. Processes sharing
+the store take ``store_lock`` around every write.
+
+The dashboard reads the store through one ``Dataset`` per field and server
+process (see ``get_dataset``): every column is held once, in a read-only NumPy
+array, and ``query_range``/``load_readings`` hand out DataFrames of views into
+those arrays. Sessions share the data without copying it, so memory stays flat
+as users are added; a field's dataset is reloaded once whenever that field
+changes.
+
+Pages load only the sensor columns they show (``columns=``). With
+``COMPACT_MODE=1`` the dataset is also compacted: float32 sensor columns and
+int64 epoch nanosecond timestamps. ``memory_report`` shows what the caches and
+sessions hold.
+"""
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import streamlit as st
+
+from timing import cache_miss, cache_request, phase
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writes are only serialized within one process
+    fcntl = None
+
+# Directory of the dashboard app (where app.py lives)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Sensor columns recorded by every node
+SENSORS = ["TC", "HUM", "PRES", "US", "SOIL1"]
+
+# Field and node of readings that do not name one
+DEFAULT_FIELD = "prizren"
+DEFAULT_NODE = "node-1"
+
+# Field and node ids are used as directory names
+ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Timestamp format used by the logger exports
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Fixed schema of the readings store
+SCHEMA = pa.schema(
+    [pa.field("timestamp", pa.timestamp("ns")), pa.field("node_id", pa.string())]
+    + [pa.field(sensor, pa.float64()) for sensor in SENSORS]
+)
+
+# Dtypes of the loaded frames in compact mode
+COMPACT_DTYPES = {"timestamp": "int64", **{sensor: "float32" for sensor in SENSORS}}
+
+# Column types of logger CSV exports (``field_id`` and ``node_id`` are optional)
+CSV_TYPES = {
+    "timestamp": pa.timestamp("ns"),
+    **{sensor: pa.float64() for sensor in SENSORS},
+    "field_id": pa.string(),
+    "node_id": pa.string(),
+}
+
+# Bytes of CSV parsed per batch by ``read_csv_batches``
+CSV_BLOCK_SIZE = 32 * 2**20
+
+# Bumped whenever the on-disk layout changes; older stores are rebuilt
+LAYOUT_VERSION = 3
+
+# Serializes writes to the store within this process (see ``store_lock``)
+_store_lock = threading.RLock()
+_store_lock_depth = 0
+_store_lock_file = None
+
+
+class TimeIndex:
+    """
+    Binary-search index over a sorted timestamp column.
+
+    The timestamps are viewed as int64 nanoseconds since the epoch, so building
+    the index does not copy the column and every lookup is O(log N).
+
+    Args:
+        timestamps (pandas.Series or numpy.ndarray): Sorted datetime64 values
+            (or int64 epoch nanoseconds, as in compact frames).
+    """
+
+    def __init__(self, timestamps):
+        self.epochs = np.asarray(timestamps, dtype="datetime64[ns]").view("int64")
+
+    def __len__(self):
+        return len(self.epochs)
+
+    @property
+    def first(self):
+        """pandas.Timestamp: The earliest timestamp (None if empty)."""
+        return pd.Timestamp(self.epochs[0]) if len(self.epochs) else None
+
+    @property
+    def last(self):
+        """pandas.Timestamp: The latest timestamp (None if empty)."""
+        return pd.Timestamp(self.epochs[-1]) if len(self.epochs) else None
+
+    def slice(self, start=None, end=None, closed="both"):
+        """
+        Finds the rows falling inside a time range.
+
+        Args:
+            start: Start of the range (anything ``pandas.Timestamp`` accepts),
+                or None for an open start.
+            end: End of the range, or None for an open end.
+            closed (str): "both" to include ``end``, "left" to exclude it.
+
+        Returns:
+            slice: Positional slice of the matching rows.
+        """
+        lo = 0 if start is None else np.searchsorted(self.epochs, to_epoch(start), side="left")
+        if end is None:
+            hi = len(self.epochs)
+        else:
+            side = "right" if closed == "both" else "left"
+            hi = np.searchsorted(self.epochs, to_epoch(end), side=side)
+        return slice(int(lo), int(max(lo, hi)))
+
+
+class DayIndex:
+    """
+    Row offsets of every calendar day in a sorted timestamp column.
+
+    The offsets are computed once, in a single vectorized pass, so looking up
+    the rows of a day is a dict lookup regardless of how many days the column
+    covers. Timestamps must be naive local wall-clock times.
+
+    Args:
+        timestamps (pandas.Series or numpy.ndarray): Sorted datetime64 values.
+    """
+
+    DAY = 86400 * 10**9
+
+    def __init__(self, timestamps):
+        days = np.asarray(timestamps, dtype="datetime64[ns]").view("int64") // self.DAY
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.array([], dtype="int64")
+        ends = np.r_[starts[1:], len(days)]
+        self.offsets = {int(days[lo]): slice(int(lo), int(hi)) for lo, hi in zip(starts, ends)}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def day(self, date):
+        """
+        Finds the rows of one calendar day.
+
+        Args:
+            date: The day (anything ``pandas.Timestamp`` accepts).
+
+        Returns:
+            slice: Positional slice of the day's rows (empty if there are none).
+        """
+        return self.offsets.get(to_epoch(date) // self.DAY, slice(0, 0))
+
+
+def to_epoch(value):
+    """
+    Converts a timestamp-like value to int64 nanoseconds since the epoch.
+
+    Args:
+        value: A datetime, date, string or ``pandas.Timestamp``.
+
+    Returns:
+        int: Nanoseconds since the epoch.
+    """
+    return pd.Timestamp(value).value
+
+
+def check_id(value):
+    """
+    Validates a field or node id.
+
+    Args:
+        value (str): The id.
+
+    Returns:
+        str: The id.
+
+    Raises:
+        ValueError: If the id is not 1-64 letters, digits, "_" or "-".
+    """
+    if not isinstance(value, str) or not ID_PATTERN.match(value):
+        raise ValueError(f"invalid field or node id: {value!r}")
+    return value
+
+
+def get_default_field():
+    """
+    Returns the field shown when none is selected.
+
+    The field can be overridden with the ``FIELD_ID`` environment variable.
+
+    Returns:
+        str: The field id.
+    """
+    return os.environ.get("FIELD_ID", DEFAULT_FIELD)
+
+
+def partition_keys(timestamps):
+    """
+    Returns the monthly partition of every timestamp of a column.
+
+    Only the distinct months are formatted, which is much faster than
+    ``strftime`` on every row.
+
+    Args:
+        timestamps (pandas.Series): datetime64 values.
+
+    Returns:
+        pandas.Series: The partition keys, with the index of ``timestamps``.
+    """
+    months = timestamps.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]")
+    unique, inverse = np.unique(months, return_inverse=True)
+    return pd.Series(np.datetime_as_string(unique, unit="M").astype(object)[inverse], index=timestamps.index)
+
+
+def get_csv_path():
+    """
+    Returns the path of the source CSV file.
+
+    The path can be overridden with the ``DATA_PATH`` environment variable;
+    relative paths are resolved against the app directory.
+
+    Returns:
+        str: The absolute path to the CSV file.
+    """
+    data_path = os.environ.get("DATA_PATH", "cleaned_data.csv")
+    return os.path.join(APP_DIR, data_path)
+
+
+def get_store_dir():
+    """
+    Returns the directory holding the columnar store.
+
+    The directory can be overridden with the ``SENSOR_STORE_DIR`` environment
+    variable.
+
+    Returns:
+        str: The absolute path to the store directory.
+    """
+    store_dir = os.environ.get("SENSOR_STORE_DIR", "store")
+    return os.path.join(APP_DIR, store_dir)
+
+
+def get_manifest_path():
+    """
+    Returns the path of the store manifest.
+
+    Returns:
+        str: The absolute path to ``manifest.json``.
+    """
+    return os.path.join(get_store_dir(), "manifest.json")
+
+
+def get_partition_dir(key, field=None):
+    """
+    Returns the directory holding one monthly partition of a field.
+
+    Args:
+        key (str): The partition key, e.g. "2023-05".
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        str: The absolute path to the partition directory.
+    """
+    return os.path.join(get_store_dir(), "readings", field or get_default_field(), key)
+
+
+@contextlib.contextmanager
+def store_lock():
+    """
+    Holds the write lock of the store.
+
+    Store rebuilds, appends and compactions and rollup rebuilds run under
+    it, so the dashboard servers, the ingestion and query services and
+    backfills sharing a store never write it at the same time. The lock is
+    re-entrant within a thread; across processes it is an advisory lock on
+    ``store/store.lock``.
+    """
+    global _store_lock_depth, _store_lock_file
+    with _store_lock:
+        if _store_lock_depth == 0 and fcntl is not None:
+            os.makedirs(get_store_dir(), exist_ok=True)
+            _store_lock_file = open(os.path.join(get_store_dir(), "store.lock"), "a")
+            fcntl.flock(_store_lock_file, fcntl.LOCK_EX)
+        _store_lock_depth += 1
+        try:
+            yield
+        finally:
+            _store_lock_depth -= 1
+            if _store_lock_depth == 0 and _store_lock_file is not None:
+                fcntl.flock(_store_lock_file, fcntl.LOCK_UN)
+                _store_lock_file.close()
+                _store_lock_file = None
+
+
+def with_ids(data):
+    """
+    Fills in the field and node of readings that do not name them.
+
+    Args:
+        data (pandas.DataFrame): The readings, with or without ``field_id``
+            and ``node_id`` columns.
+
+    Returns:
+        pandas.DataFrame: The readings with validated ``field_id`` and
+        ``node_id`` columns.
+
+    Raises:
+        ValueError: If a field or node id is invalid.
+    """
+    data = data.copy()
+    for column, default in (("field_id", DEFAULT_FIELD), ("node_id", DEFAULT_NODE)):
+        ids = data[column].fillna(default).astype(str) if column in data.columns else default
+        data[column] = ids
+        for value in data[column].unique():
+            check_id(value)
+    return data
+
+
+def read_csv(csv_path):
+    """
+    Reads a logger CSV export with the explicit store schema.
+
+    The CSV may carry ``field_id`` and ``node_id`` columns; readings without
+    them belong to ``DEFAULT_FIELD`` and ``DEFAULT_NODE``.
+
+    Args:
+        csv_path (str): The path to the CSV file.
+
+    Returns:
+        pandas.DataFrame: The readings with a ``field_id`` column, sorted by
+        timestamp and node.
+    """
+    data = pd.read_csv(csv_path, dtype={sensor: "float64" for sensor in SENSORS})
+    data["timestamp"] = pd.to_datetime(data["timestamp"], format=TIMESTAMP_FORMAT)
+    data = with_ids(data)
+    return data[["field_id"] + SCHEMA.names].sort_values(["timestamp", "node_id"], ignore_index=True)
+
+
+def read_csv_batches(csv_path, block_size=CSV_BLOCK_SIZE, timestamp_format=TIMESTAMP_FORMAT):
+    """
+    Streams a logger CSV export in batches, with the explicit store schema.
+
+    The file is parsed by pyarrow on multiple threads, ``block_size`` bytes at
+    a time, so it is never held in memory whole. Readings without a field or
+    node belong to ``DEFAULT_FIELD`` and ``DEFAULT_NODE``; sensor columns
+    missing from the file are NaN.
+
+    Args:
+        csv_path (str): The path to the CSV file.
+        block_size (int): Bytes of CSV per batch.
+        timestamp_format (str): ``strptime`` format of the timestamps.
+
+    Yields:
+        pandas.DataFrame: The readings of one batch with a ``field_id``
+        column, in file order.
+
+    Raises:
+        ValueError: If a value cannot be parsed or a field or node id is
+            invalid.
+    """
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(block_size=block_size, use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types=CSV_TYPES,
+            timestamp_parsers=[timestamp_format],
+            include_columns=list(CSV_TYPES),
+            include_missing_columns=True,
+        ),
+    )
+    for batch in reader:
+        data = batch.to_pandas()
+        for sensor in SENSORS:
+            data[sensor] = data[sensor].astype("float64")
+        yield with_ids(data)[["field_id"] + SCHEMA.names]
+
+
+def to_table(data):
+    """
+    Converts a readings DataFrame to an Arrow table with the store schema.
+
+    NaN values are kept as NaN (not converted to nulls) so the float columns can
+    later be handed to pandas without a copy.
+
+    Args:
+        data (pandas.DataFrame): The readings.
+
+    Returns:
+        pyarrow.Table: The readings as an Arrow table.
+    """
+    arrays = [
+        pa.array(data["timestamp"].to_numpy(), type=pa.timestamp("ns")),
+        pa.array(data["node_id"].astype(str).to_numpy(), type=pa.string()),
+    ]
+    arrays += [pa.array(data[sensor].to_numpy(), type=pa.float64(), from_pandas=False) for sensor in SENSORS]
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+
+def write_table(table, path):
+    """
+    Writes an Arrow table to a Parquet file atomically.
+
+    The table is written to a temporary file first and then moved into place,
+    so readers never see a half-written file.
+
+    Args:
+        table (pyarrow.Table): The table to write.
+        path (str): The destination path.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_manifest(manifest):
+    """
+    Writes the store manifest atomically.
+
+    Args:
+        manifest (dict): The manifest to write.
+    """
+    path = get_manifest_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_manifest():
+    """
+    Reads the store manifest.
+
+    Returns:
+        dict: The manifest, or None if the store has not been built yet.
+    """
+    try:
+        with open(get_manifest_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_data_version(field=None):
+    """
+    Returns a value that changes whenever the store (or one field) is written.
+
+    The manifest is rewritten by every build, append and compaction, so its
+    modification time identifies the current generation of the data. Every
+    field also records when it was last written, so caches of one field are
+    not invalidated by readings arriving for another.
+
+    Args:
+        field (str): The field id, or None for the whole store.
+
+    Returns:
+        int: Nanoseconds timestamp of the last write (0 if there is no data
+        yet).
+    """
+    if field is not None:
+        manifest = read_manifest() or {}
+        return manifest.get("fields", {}).get(field, {}).get("updated", 0)
+    try:
+        return os.stat(get_manifest_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def get_partitions(manifest, field=None):
+    """
+    Returns the partitions of one field from the manifest.
+
+    Args:
+        manifest (dict): The store manifest.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        dict: Manifest entry per partition key (empty for an unknown field).
+    """
+    entry = manifest["fields"].get(field or get_default_field())
+    return {} if entry is None else entry["partitions"]
+
+
+def list_fields():
+    """
+    Returns the fields present in the store.
+
+    Returns:
+        list: Sorted field ids (just the default field for an empty store).
+    """
+    return sorted(ensure_store()["fields"]) or [get_default_field()]
+
+
+def list_nodes(field=None):
+    """
+    Returns the sensor nodes of a field, from the manifest alone.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        list: Sorted node ids.
+    """
+    partitions = get_partitions(ensure_store(), field)
+    return sorted({node for entry in partitions.values() for node in entry["nodes"]})
+
+
+def describe_partition(data, parts):
+    """
+    Builds the manifest entry of a partition.
+
+    Args:
+        data (pandas.DataFrame): All readings of the partition, sorted.
+        parts (list): File names of the partition's Parquet parts.
+
+    Returns:
+        dict: The manifest entry.
+    """
+    return {
+        "parts": parts,
+        "rows": len(data),
+        "nodes": sorted(data["node_id"].unique().tolist()),
+        "start": to_epoch(data["timestamp"].iloc[0]),
+        "end": to_epoch(data["timestamp"].iloc[-1]),
+    }
+
+
+def part_name(number):
+    """
+    Returns the file name of a partition part.
+
+    Args:
+        number (int): The sequence number of the part.
+
+    Returns:
+        str: The file name, e.g. "part-00003.parquet".
+    """
+    return f"part-{number:05d}.parquet"
+
+
+def next_part_name(parts):
+    """
+    Returns the file name for the next part of a partition.
+
+    Args:
+        parts (list): File names of the partition's existing parts.
+
+    Returns:
+        str: A file name not used by any existing part.
+    """
+    numbers = [int(part[len("part-"):-len(".parquet")]) for part in parts]
+    return part_name(max(numbers, default=-1) + 1)
+
+
+def build_store(data, source_mtime=None):
+    """
+    Replaces the whole store with the given readings.
+
+    Callers hold ``store_lock``.
+
+    Args:
+        data (pandas.DataFrame): The readings with a ``field_id`` column,
+            sorted by timestamp and node.
+        source_mtime (float): Modification time of the CSV the readings came
+            from, used to detect when the store is out of date.
+    """
+    readings_dir = os.path.join(get_store_dir(), "readings")
+    shutil.rmtree(readings_dir, ignore_errors=True)
+
+    fields = {}
+    for field, field_data in data.groupby("field_id", sort=True):
+        partitions = {}
+        months = partition_keys(field_data["timestamp"])
+        for key, month_data in field_data.groupby(months, sort=True):
+            write_table(to_table(month_data), os.path.join(get_partition_dir(key, field), part_name(0)))
+            partitions[key] = describe_partition(month_data, [part_name(0)])
+        fields[field] = {"updated": time.time_ns(), "partitions": partitions}
+
+    write_manifest({
+        "layout": LAYOUT_VERSION,
+        "source_mtime": source_mtime,
+        "fields": fields,
+    })
+
+
+def _stored_readings(manifest):
+    # Every reading of the store, with a ``field_id`` column
+    frames = [
+        _read_parts(key, entry["parts"], field=field).to_pandas().assign(field_id=field)
+        for field in manifest["fields"]
+        for key, entry in get_partitions(manifest, field).items()
+    ]
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def convert_csv(csv_path, manifest=None):
+    """
+    Imports a logger CSV export into the partitioned store.
+
+    Readings of the store that are not in the CSV (appended by ingestion or
+    backfills) are kept; where both have a reading of the same node at the
+    same time, the CSV's is kept.
+
+    Args:
+        csv_path (str): The path to the CSV file.
+        manifest (dict): The manifest of the current store, or None to build
+            the store from the CSV alone.
+    """
+    with store_lock():
+        data = read_csv(csv_path)
+        stored = None if manifest is None else _stored_readings(manifest)
+        if stored is not None:
+            data = pd.concat([data, stored[data.columns]], ignore_index=True)
+            data = data.drop_duplicates(["field_id", "node_id", "timestamp"], keep="first")
+            data = data.sort_values(["timestamp", "node_id"], ignore_index=True)
+        build_store(data, source_mtime=os.path.getmtime(csv_path))
+
+
+def _set_aside(manifest):
+    # Moves readings written with another layout out of the way
+    readings_dir = os.path.join(get_store_dir(), "readings")
+    if manifest is None or not os.path.exists(readings_dir):
+        return
+    old_dir = f"{readings_dir}-layout{manifest.get('layout', 1)}"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.replace(readings_dir, old_dir)
+    logger.info("Moved the readings of store layout %s to %s", manifest.get("layout", 1), old_dir)
+
+
+def _is_current(manifest, csv_path):
+    if manifest is None or manifest.get("layout") != LAYOUT_VERSION:
+        return False
+    return not os.path.exists(csv_path) or os.path.getmtime(csv_path) <= (manifest.get("source_mtime") or 0)
+
+
+def ensure_store():
+    """
+    Makes sure the store exists, has the current layout and is not older than
+    the source CSV.
+
+    Returns:
+        dict: The store manifest.
+    """
+    csv_path = get_csv_path()
+    manifest = read_manifest()
+    if _is_current(manifest, csv_path):
+        return manifest
+    with store_lock():
+        # Another process may have rebuilt the store while this one waited
+        manifest = read_manifest()
+        if _is_current(manifest, csv_path):
+            return manifest
+        if manifest is not None and manifest.get("layout") != LAYOUT_VERSION:
+            _set_aside(manifest)
+            manifest = None
+        if os.path.exists(csv_path):
+            convert_csv(csv_path, manifest)
+        elif manifest is None:
+            # No CSV to start from: begin with an empty store fed by ingestion
+            build_store(with_ids(SCHEMA.empty_table().to_pandas()))
+        return read_manifest()
+
+
+def _read_parts(key, parts, columns=None, field=None):
+    tables = [
+        pq.read_table(os.path.join(get_partition_dir(key, field), part), columns=columns, memory_map=True)
+        for part in parts
+    ]
+    return pa.concat_tables(tables)
+
+
+def _reading_keys(timestamps, nodes):
+    # One comparable key per (node, timestamp) pair
+    return pd.MultiIndex.from_arrays([np.asarray(nodes, dtype=object), np.asarray(timestamps).view("int64")])
+
+
+def append_readings(data):
+    """
+    Appends a batch of readings to the store.
+
+    Readings without a timestamp, or whose node and timestamp are already
+    stored (or repeated inside the batch), are dropped. The remaining rows are written as a new part file
+    in each field and month they fall into; existing files are never
+    rewritten. Appends run under ``store_lock``.
+
+    Args:
+        data (pandas.DataFrame): The readings, with the store schema and
+            optionally a ``field_id`` column.
+
+    Returns:
+        pandas.DataFrame: The rows that were actually appended, with a
+        ``field_id`` column.
+
+    Raises:
+        ValueError: If a field or node id is invalid.
+    """
+    with store_lock():
+        manifest = ensure_store()
+        data = with_ids(data)[["field_id"] + SCHEMA.names]
+        data = data[data["timestamp"].notna()]
+        data = data.drop_duplicates(["field_id", "node_id", "timestamp"], keep="last")
+        data = data.sort_values(["timestamp", "node_id"], ignore_index=True)
+
+        appended = []
+        for field, field_data in data.groupby("field_id", sort=True):
+            field_entry = manifest["fields"].setdefault(field, {"updated": 0, "partitions": {}})
+            months = partition_keys(field_data["timestamp"])
+            for key, batch in field_data.groupby(months, sort=True):
+                entry = field_entry["partitions"].get(key)
+                parts = [] if entry is None else list(entry["parts"])
+                if parts:
+                    stored = _read_parts(key, parts, columns=["timestamp", "node_id"], field=field)
+                    stored = _reading_keys(stored.column("timestamp").to_numpy(), stored.column("node_id").to_numpy())
+                    batch = batch[~_reading_keys(batch["timestamp"].to_numpy(), batch["node_id"].to_numpy()).isin(stored)]
+                if batch.empty:
+                    continue
+
+                part = next_part_name(parts)
+                write_table(to_table(batch), os.path.join(get_partition_dir(key, field), part))
+                new_entry = describe_partition(batch, parts + [part])
+                if entry is not None:
+                    new_entry["rows"] += entry["rows"]
+                    new_entry["nodes"] = sorted(set(new_entry["nodes"]) | set(entry["nodes"]))
+                    new_entry["start"] = min(new_entry["start"], entry["start"])
+                    new_entry["end"] = max(new_entry["end"], entry["end"])
+                field_entry["partitions"][key] = new_entry
+                field_entry["updated"] = time.time_ns()
+                appended.append(batch)
+
+        if not appended:
+            return with_ids(SCHEMA.empty_table().to_pandas())[["field_id"] + SCHEMA.names]
+        write_manifest(manifest)
+        return pd.concat(appended, ignore_index=True)
+
+
+def compact_partition(key, field=None):
+    """
+    Merges the part files of one partition into a single file.
+
+    Frequent small appends leave many tiny parts behind; compacting the
+    current month keeps reads fast without touching older partitions or
+    other fields.
+
+    Args:
+        key (str): The partition key, e.g. "2023-05".
+        field (str): The field id (``get_default_field()`` if not given).
+    """
+    with store_lock():
+        field = field or get_default_field()
+        manifest = ensure_store()
+        entry = get_partitions(manifest, field).get(key)
+        if entry is None or len(entry["parts"]) <= 1:
+            return
+        old_parts = list(entry["parts"])
+        data = _read_parts(key, old_parts, field=field).sort_by([("timestamp", "ascending"), ("node_id", "ascending")])
+        part = next_part_name(old_parts)
+        write_table(data, os.path.join(get_partition_dir(key, field), part))
+        entry["parts"] = [part]
+        manifest["fields"][field]["updated"] = time.time_ns()
+        write_manifest(manifest)
+        for old_part in old_parts:
+            os.remove(os.path.join(get_partition_dir(key, field), old_part))
+
+
+def get_compact_mode():
+    """
+    Tells whether loaded frames are compacted.
+
+    Returns:
+        bool: True if the ``COMPACT_MODE`` environment variable is "1".
+    """
+    return os.environ.get("COMPACT_MODE", "0") == "1"
+
+
+def compact_frame(data):
+    """
+    Converts a frame to the compact dtypes, in place.
+
+    Args:
+        data (pandas.DataFrame): Readings with the store schema (or a subset
+            of its columns).
+
+    Returns:
+        pandas.DataFrame: The same frame, with float32 sensor columns and int64
+        epoch nanosecond timestamps.
+    """
+    for column in data.columns:
+        if column == "timestamp":
+            data[column] = data[column].to_numpy(dtype="datetime64[ns]").view("int64")
+        elif column in COMPACT_DTYPES:
+            data[column] = data[column].astype(COMPACT_DTYPES[column])
+    return data
+
+
+def _projection(columns):
+    return None if columns is None else ["timestamp"] + [column for column in columns if column != "timestamp"]
+
+
+# Bytes held by every named dataset
+_entry_bytes = {}
+
+
+def _read_partition_frame(partition_dir, parts, columns=None):
+    tables = [pq.read_table(os.path.join(partition_dir, part), columns=columns, memory_map=True) for part in parts]
+    return pa.concat_tables(tables).to_pandas().sort_values("timestamp", ignore_index=True)
+
+
+def read_partition(key, manifest=None, columns=None, field=None):
+    """
+    Reads the readings of one monthly partition of a field, without caching
+    them.
+
+    For one pass over the whole history (building rollups, statistics and
+    anomaly flags), so only the partition being processed is held in memory.
+
+    Args:
+        key (str): The partition key, e.g. "2023-05".
+        manifest (dict): The store manifest (read if not given).
+        columns (list): Columns to load (all if not given); the timestamp is
+            always loaded.
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        pandas.DataFrame: The readings of the partition, sorted by timestamp.
+    """
+    manifest = manifest or ensure_store()
+    entry = get_partitions(manifest, field)[key]
+    return _read_partition_frame(get_partition_dir(key, field), entry["parts"], _projection(columns))
+
+
+def cache_entry_bytes():
+    """
+    Returns the memory held by the named datasets.
+
+    Returns:
+        dict: Bytes per cache entry, keyed by a readable description.
+    """
+    return dict(_entry_bytes)
+
+
+class Dataset:
+    """
+    Read-only readings shared by all sessions of the server process.
+
+    Every column is one contiguous NumPy array flagged as read-only. ``frame``
+    builds DataFrames whose columns are views into those arrays, so handing
+    data to a session copies nothing, and an attempt to modify it in place
+    raises ``ValueError`` instead of corrupting other sessions' data. A
+    ``node_id`` column is held as categorical codes.
+
+    Args:
+        table (pyarrow.Table): The readings, with the store schema.
+        compact (bool): Whether to hold compact dtypes.
+        name (str): If given, the dataset's size is listed under this name by
+            ``cache_entry_bytes``.
+    """
+
+    def __init__(self, table, compact=False, name=None):
+        self.compact = compact
+        self.columns = {}
+        table = table.sort_by([(column, "ascending") for column in ("timestamp", "node_id") if column in table.column_names])
+        self.node_dtype = None
+        for column in table.column_names:
+            values = table.column(column).to_numpy()
+            if column == "node_id":
+                nodes = pd.Categorical(values)
+                self.node_dtype = nodes.dtype
+                values = nodes.codes
+            elif column == "timestamp":
+                values = values.astype("datetime64[ns]", copy=False)
+                if compact:
+                    values = values.view("int64")
+            elif compact:
+                values = values.astype(COMPACT_DTYPES[column])
+            values.flags.writeable = False
+            self.columns[column] = values
+        self.index = TimeIndex(self.columns["timestamp"])
+        if name is not None:
+            _entry_bytes[name] = self.nbytes
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def nbytes(self):
+        """int: Memory held by the columns."""
+        return sum(values.nbytes for values in self.columns.values())
+
+    @property
+    def nodes(self):
+        """list: The node ids present in the dataset."""
+        return [] if self.node_dtype is None else list(self.node_dtype.categories)
+
+    def frame(self, start=None, end=None, closed="both", columns=None, compact=None, nodes=None):
+        """
+        Returns a read-only view of the readings inside a time range.
+
+        Args:
+            start: Start of the range, or None for an open start.
+            end: End of the range, or None for an open end.
+            closed (str): "both" to include ``end``, "left" to exclude it.
+            columns (list): Columns to include (all if not given).
+            compact (bool): The dtypes wanted. Views are only possible in the
+                dataset's own representation; otherwise the selected rows are
+                converted (copied).
+            nodes (list): Only include readings of these nodes (all if not
+                given). Selecting nodes copies the matching rows.
+
+        Returns:
+            pandas.DataFrame: The readings, sorted by timestamp.
+        """
+        rows = self.index.slice(start, end, closed)
+        if nodes is not None:
+            codes = self.columns["node_id"][rows]
+            wanted = [self.node_dtype.categories.get_loc(node) for node in nodes if node in self.node_dtype.categories]
+            rows = np.arange(rows.start, rows.stop)[np.isin(codes, wanted)]
+        compact = self.compact if compact is None else compact
+        frame = {}
+        for name in _projection(columns) or list(self.columns):
+            values = self.columns[name][rows]
+            if name == "node_id":
+                values = pd.Categorical.from_codes(values, dtype=self.node_dtype, validate=False)
+            elif compact != self.compact:
+                if name == "timestamp":
+                    values = values.view("int64" if compact else "datetime64[ns]")
+                else:
+                    values = values.astype(COMPACT_DTYPES[name] if compact else "float64")
+            frame[name] = values
+        return pd.DataFrame(frame, copy=False)
+
+
+class DatasetCache:
+    """
+    The current ``Dataset`` of every field, shared by all sessions.
+
+    Each field keeps only the dataset of its latest version: when a field
+    changes, its dataset is reloaded and the old one is released, while the
+    datasets of the other fields are kept.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    def get(self, field, version, compact, load):
+        """
+        Returns the dataset of a field, loading it if it is missing or stale.
+
+        Args:
+            field (str): The field id.
+            version (int): The field's data version.
+            compact (bool): Whether the dataset holds compact dtypes.
+            load (callable): Builds the dataset.
+
+        Returns:
+            Dataset: The dataset.
+        """
+        cache_request("dataset")
+        with self._lock:
+            cached = self._datasets.get((field, compact))
+            if cached is None or cached[0] != version:
+                cache_miss("dataset")
+                cached = (version, load())
+                self._datasets[(field, compact)] = cached
+            return cached[1]
+
+    def clear(self):
+        """
+        Releases every dataset.
+        """
+        with self._lock:
+            self._datasets.clear()
+
+
+# A plain module attribute rather than ``st.cache_resource``, which keeps
+# nothing outside a Streamlit server (e.g. in the query service)
+_dataset_cache = DatasetCache()
+
+
+def get_dataset_cache():
+    """
+    Returns the dataset cache shared by all sessions of this process.
+
+    Returns:
+        DatasetCache: The cache.
+    """
+    return _dataset_cache
+
+
+def _read_dataset(manifest, field, compact):
+    tables = [_read_parts(key, entry["parts"], field=field) for key, entry in sorted(get_partitions(manifest, field).items())]
+    table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+    return Dataset(table, compact, name=f"dataset {field}{' (compact)' if compact else ''}")
+
+
+def get_dataset(field=None):
+    """
+    Returns the shared read-only dataset of a field.
+
+    The dataset is loaded once per field version (and reloaded after appends
+    or rebuilds touching the field); its representation follows
+    ``get_compact_mode()``.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        Dataset: The dataset.
+    """
+    field = field or get_default_field()
+    manifest = ensure_store()
+    version = manifest["fields"].get(field, {}).get("updated", 0)
+    compact = get_compact_mode()
+    return get_dataset_cache().get(field, version, compact, lambda: _read_dataset(manifest, field, compact))
+
+
+def get_time_bounds(field=None):
+    """
+    Returns the time range covered by a field without loading any data.
+
+    Args:
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        tuple: The first and last timestamp (``pandas.Timestamp``).
+    """
+    partitions = get_partitions(ensure_store(), field)
+    if not partitions:
+        return None, None
+    return (
+        pd.Timestamp(min(entry["start"] for entry in partitions.values())),
+        pd.Timestamp(max(entry["end"] for entry in partitions.values())),
+    )
+
+
+def query_range(start=None, end=None, closed="both", columns=None, compact=None, field=None, nodes=None):
+    """
+    Returns the readings of a field inside a time range.
+
+    The rows are located by binary search on the sorted timestamps of the
+    field's shared dataset, and the returned DataFrame is a read-only view
+    into it.
+
+    Args:
+        start: Start of the range, or None for an open start.
+        end: End of the range, or None for an open end.
+        closed (str): "both" to include ``end``, "left" to exclude it.
+        columns (list): Columns to load (all if not given); the timestamp is
+            always loaded.
+        compact (bool): Whether to return compact dtypes
+            (``get_compact_mode()`` if not given).
+        field (str): The field id (``get_default_field()`` if not given).
+        nodes (list): Only return readings of these nodes (all if not given).
+
+    Returns:
+        pandas.DataFrame: The matching readings, sorted by timestamp.
+    """
+    dataset = get_dataset(field)
+    with phase("filter"):
+        return dataset.frame(start, end, closed, columns, compact, nodes)
+
+
+def load_readings(columns=None, compact=None, field=None):
+    """
+    Returns the complete sensor history of a field.
+
+    The field is read once per process and version and shared by all
+    sessions; later calls only check the manifest.
+
+    Args:
+        columns (list): Columns to load (all if not given).
+        compact (bool): Whether to return compact dtypes
+            (``get_compact_mode()`` if not given).
+        field (str): The field id (``get_default_field()`` if not given).
+
+    Returns:
+        pandas.DataFrame: The readings with a ``timestamp`` column.
+    """
+    return query_range(columns=columns, compact=compact, field=field)
+
+
+def select_field(fields=None):
+    """
+    Shows the field selector in the sidebar.
+
+    The choice is kept in the session state, so it carries over when the
+    user switches pages.
+
+    Args:
+        fields (list): The fields to choose from (``list_fields()`` if not
+            given).
+
+    Returns:
+        str: The selected field id.
+    """
+    fields = fields or list_fields()
+    current = st.session_state.get("field_id", get_default_field())
+    field = st.sidebar.selectbox("Field", fields, index=fields.index(current) if current in fields else 0)
+    st.session_state["field_id"] = field
+    return field
@@ -0,0 +1,377 @@
+"""
+Synthetic sensor histories for scale testing.
+
+Generates readings in the store schema (``timestamp``, ``field_id``,
+``node_id`` and the ``SENSORS`` columns) for any number of fields, nodes and
+years. The values follow the patterns of ``cleaned_data.csv``:
+
+* TC from about 4 °C in January to 26 °C in July, warmest in the early
+  afternoon, with HUM moving the opposite way (55-95 %),
+* PRES around 97 kPa (plus a per-field altitude offset) with a small
+  twice-daily tide,
+* SOIL1 as a raw 12-bit reading, wet (about 3500) in winter and dry (about
+  400) in late summer,
+* US as whole numbers around 28,
+
+plus multi-day weather shared by the nodes of a field, per-node offsets,
+sensor noise, timestamp jitter, empty readings (all sensors missing, about 2 %),
+outages during which a node sends nothing, and rare outliers.
+
+Everything is computed with NumPy on whole chunks of readings. The seasonal,
+daily and weather components are functions of the absolute time, so chunks
+join up seamlessly and output of any size is written chunk by chunk with
+bounded memory::
+
+    python synthetic_data.py --fields 20 --nodes 10 --years 3 --output readings.parquet
+    python synthetic_data.py --rows 100000000 --fields 50 --output readings.csv
+
+The output is deterministic for a given seed and chunk size.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from sensor_store import DEFAULT_FIELD, SCHEMA, SENSORS
+
+# Schema of the generated readings: the columns of the logger exports, then
+# the field and node
+OUTPUT_SCHEMA = pa.schema([SCHEMA.field(name) for name in ["timestamp"] + SENSORS] + [pa.field("field_id", pa.string()), SCHEMA.field("node_id")])
+
+HOUR = 3600 * 10**9
+DAY = 24 * HOUR
+YEAR_DAYS = 365.25
+
+# Coldest day of the year (day 0 is January 1st), and how many days the soil
+# moisture lags behind the temperature (the soil is driest in September)
+COLDEST_DAY = 20
+SOIL_LAG_DAYS = 45
+
+# Share of readings with every sensor missing and of readings with an outlier
+DROPOUT_RATE = 0.02
+OUTLIER_RATE = 0.0005
+
+# Average days between outages of a node, and their median length in hours
+OUTAGE_EVERY_DAYS = 20
+OUTAGE_MEDIAN_HOURS = 3
+
+# Weather components (multi-day cycles) per field
+WEATHER_PERIODS_DAYS = (2.5, 4.0, 7.0, 11.0)
+
+# Decimals kept per sensor, as in the logger exports
+DECIMALS = {"TC": 2, "HUM": 1, "PRES": 2, "US": 0, "SOIL1": 2}
+
+
+def field_ids(count):
+    """
+    Returns the ids of the generated fields.
+
+    Args:
+        count (int): Number of fields.
+
+    Returns:
+        list: ``DEFAULT_FIELD`` followed by "field-002", "field-003", ...
+    """
+    return [DEFAULT_FIELD] + [f"field-{i + 1:03d}" for i in range(1, count)]
+
+
+def nodes_for_rows(rows, fields, years, interval="5min"):
+    """
+    Returns how many nodes per field produce about the requested rows.
+
+    Args:
+        rows (int): Wanted number of readings.
+        fields (int): Number of fields.
+        years (float): Length of the history in years.
+        interval (str): Reading interval of every node.
+
+    Returns:
+        int: Nodes per field (at least one).
+    """
+    per_node = years * YEAR_DAYS * DAY / pd.Timedelta(interval).value
+    return max(1, int(np.ceil(rows / (fields * per_node))))
+
+
+class Site:
+    """
+    Fixed properties of every field and node: climate offsets, weather
+    phases and outage windows.
+
+    Args:
+        fields (list): The field ids.
+        nodes (int): Nodes per field.
+        start (int): First timestamp, in epoch nanoseconds.
+        end (int): End of the history, in epoch nanoseconds.
+        rng (numpy.random.Generator): Random source.
+    """
+
+    def __init__(self, fields, nodes, start, end, rng):
+        self.fields = list(fields)
+        self.nodes = nodes
+        count = len(self.fields)
+        # Per field: warmer or colder, higher or lower (pressure), wetter or drier
+        self.tc_offset = rng.normal(0, 1.5, count)
+        self.pres_offset = rng.normal(0, 800, count)
+        self.soil_offset = rng.normal(0, 250, count)
+        self.weather_phase = rng.uniform(0, 2 * np.pi, (count, len(WEATHER_PERIODS_DAYS)))
+        # Per node (fields × nodes, flattened field by field)
+        self.node_tc = rng.normal(0, 0.4, count * nodes)
+        self.node_soil = rng.normal(0, 120, count * nodes)
+        self.node_us = rng.normal(0, 1.0, count * nodes)
+        self.outages = [self._outages(start, end, rng) for _ in range(count * nodes)]
+
+    @staticmethod
+    def _outages(start, end, rng):
+        days = (end - start) / DAY
+        count = rng.poisson(days / OUTAGE_EVERY_DAYS)
+        starts = np.sort(rng.integers(start, max(end, start + 1), count))
+        hours = np.minimum(rng.lognormal(np.log(OUTAGE_MEDIAN_HOURS), 1.2, count), 14 * 24)
+        return starts, starts + (hours * HOUR).astype("int64")
+
+    def weather(self, epochs, field_index):
+        """
+        Returns the weather of a field: smooth multi-day swings around 0 with
+        a standard deviation of about 1.
+
+        Args:
+            epochs (numpy.ndarray): Times in epoch nanoseconds.
+            field_index (numpy.ndarray): Field of every time.
+
+        Returns:
+            numpy.ndarray: The weather values.
+        """
+        days = epochs / DAY
+        total = np.zeros(len(epochs))
+        for k, period in enumerate(WEATHER_PERIODS_DAYS):
+            total += np.sin(2 * np.pi * days / period + self.weather_phase[field_index, k])
+        return total / np.sqrt(len(WEATHER_PERIODS_DAYS) / 2)
+
+    def offline(self, epochs, node_index):
+        """
+        Tells which readings fall into an outage of their node.
+
+        Args:
+            epochs (numpy.ndarray): Times in epoch nanoseconds.
+            node_index (numpy.ndarray): Node (across all fields) of every time.
+
+        Returns:
+            numpy.ndarray: Boolean mask of the readings not sent.
+        """
+        mask = np.zeros(len(epochs), dtype=bool)
+        for node in np.unique(node_index):
+            starts, ends = self.outages[node]
+            if not len(starts):
+                continue
+            rows = np.flatnonzero(node_index == node)
+            window = np.searchsorted(starts, epochs[rows], side="right") - 1
+            inside = window >= 0
+            inside[inside] = epochs[rows][inside] < ends[window[inside]]
+            mask[rows] = inside
+        return mask
+
+
+def sensor_values(site, epochs, field_index, node_index, rng):
+    """
+    Computes the sensor values of a block of readings.
+
+    Args:
+        site (Site): The fields and nodes.
+        epochs (numpy.ndarray): Times in epoch nanoseconds (local time).
+        field_index (numpy.ndarray): Field of every reading.
+        node_index (numpy.ndarray): Node (across all fields) of every reading.
+        rng (numpy.random.Generator): Random source.
+
+    Returns:
+        dict: An array of values per sensor.
+    """
+    rows = len(epochs)
+    day_of_year = (epochs.astype("datetime64[ns]") - epochs.astype("datetime64[ns]").astype("datetime64[Y]")) / np.timedelta64(1, "D")
+    hour = (epochs % DAY) / HOUR
+    # 1 in midsummer, -1 in midwinter
+    season = -np.cos(2 * np.pi * (day_of_year - COLDEST_DAY) / YEAR_DAYS)
+    # 1 in the early afternoon, -1 before dawn
+    daily = np.cos(2 * np.pi * (hour - 13) / 24)
+    weather = site.weather(epochs, field_index)
+
+    tc = 15 + 10.5 * season + (5 + 1.5 * season) * daily + 2.0 * weather
+    tc += site.tc_offset[field_index] + site.node_tc[node_index] + rng.normal(0, 0.3, rows)
+    hum = 74 - 12 * daily - 4 * season - 5 * weather + rng.normal(0, 2.0, rows)
+    pres = 97000 + site.pres_offset[field_index] - 100 * season + 60 * np.cos(4 * np.pi * (hour - 10) / 24)
+    pres += -350 * weather + rng.normal(0, 5, rows)
+    soil_season = -np.cos(2 * np.pi * (day_of_year - COLDEST_DAY - SOIL_LAG_DAYS) / YEAR_DAYS)
+    soil = 1950 - 1550 * soil_season - 250 * weather - 40 * daily
+    soil += site.soil_offset[field_index] + site.node_soil[node_index] + rng.normal(0, 15, rows)
+    us = 28.5 + site.node_us[node_index] + 0.8 * weather + rng.normal(0, 1.2, rows)
+
+    values = {
+        "TC": tc,
+        "HUM": np.clip(hum, 15, 100),
+        "PRES": pres,
+        "US": np.clip(us, 0, 400),
+        "SOIL1": np.clip(soil, 0, 4095),
+    }
+
+    # Rare outliers: a sensor reports a value far off its normal range
+    for sensor, (low, high) in {"TC": (-40, 80), "HUM": (0, 100), "PRES": (80000, 110000), "US": (0, 400), "SOIL1": (0, 4095)}.items():
+        spikes = rng.random(rows) < OUTLIER_RATE
+        values[sensor][spikes] = rng.choice([low, high], spikes.sum())
+
+    # Empty readings: the node answered but every sensor is missing
+    dropouts = rng.random(rows) < DROPOUT_RATE
+    for sensor in SENSORS:
+        values[sensor] = np.round(values[sensor], DECIMALS[sensor])
+        values[sensor][dropouts] = np.nan
+    return values
+
+
+def generate_chunks(fields=1, nodes=1, start="2023-01-01", years=1.0, interval="5min", chunk_rows=1_000_000, seed=0):
+    """
+    Generates readings chunk by chunk.
+
+    Every chunk covers a block of time for all nodes of all fields, and is
+    sorted by timestamp within the chunk.
+
+    Args:
+        fields (int or list): Number of fields, or the field ids.
+        nodes (int): Nodes per field.
+        start: First timestamp (anything ``pandas.Timestamp`` accepts).
+        years (float): Length of the history in years.
+        interval (str): Reading interval of every node.
+        chunk_rows (int): Approximate number of readings per chunk.
+        seed (int): Random seed.
+
+    Yields:
+        pandas.DataFrame: Readings in ``OUTPUT_SCHEMA`` column order.
+    """
+    fields = field_ids(fields) if isinstance(fields, int) else list(fields)
+    start = pd.Timestamp(start).value
+    step = pd.Timedelta(interval).value
+    end = start + int(years * YEAR_DAYS * DAY)
+    site = Site(fields, nodes, start, end, np.random.default_rng(seed))
+    node_names = np.array([f"node-{i + 1}" for i in range(nodes)], dtype=object)
+    field_names = np.array(fields, dtype=object)
+
+    total_nodes = len(fields) * nodes
+    steps = -(-(end - start) // step)
+    steps_per_chunk = max(1, chunk_rows // total_nodes)
+    for number, first in enumerate(range(0, steps, steps_per_chunk)):
+        rng = np.random.default_rng([seed, number])
+        times = start + step * np.arange(first, min(first + steps_per_chunk, steps), dtype="int64")
+        # One reading per time and node, in time order
+        epochs = np.repeat(times, total_nodes)
+        node_index = np.tile(np.arange(total_nodes), len(times))
+        # Loggers do not sample exactly on the interval
+        epochs = epochs + rng.integers(-step // 10, step // 10 + 1, len(epochs)) // 10**9 * 10**9
+        epochs = np.maximum(epochs, start)
+
+        sent = ~site.offline(epochs, node_index)
+        epochs, node_index = epochs[sent], node_index[sent]
+        field_index = node_index // nodes
+        values = sensor_values(site, epochs, field_index, node_index, rng)
+
+        order = np.argsort(epochs, kind="stable")
+        chunk = pd.DataFrame({
+            "timestamp": epochs[order].astype("datetime64[ns]"),
+            **{sensor: values[sensor][order] for sensor in SENSORS},
+            "field_id": field_names[field_index[order]],
+            "node_id": node_names[node_index[order] % nodes],
+        })
+        yield chunk
+
+
+def readings_frame(**options):
+    """
+    Generates a whole synthetic history in memory.
+
+    Args:
+        **options: Arguments of ``generate_chunks``.
+
+    Returns:
+        pandas.DataFrame: The readings, sorted by timestamp and node.
+    """
+    data = pd.concat(generate_chunks(**options), ignore_index=True)
+    return data.sort_values(["timestamp", "node_id"], ignore_index=True)
+
+
+def to_arrow(chunk):
+    """
+    Converts a chunk to an Arrow table, with missing values as nulls.
+
+    Args:
+        chunk (pandas.DataFrame): Generated readings.
+
+    Returns:
+        pyarrow.Table: The readings in ``OUTPUT_SCHEMA``.
+    """
+    return pa.Table.from_pandas(chunk, schema=OUTPUT_SCHEMA, preserve_index=False)
+
+
+def write_chunks(chunks, output_path, fmt=None):
+    """
+    Streams generated chunks to a CSV or Parquet file.
+
+    CSV files use the columns and timestamp format of the logger exports
+    (followed by ``field_id`` and ``node_id``) and leave missing values
+    empty. Parquet files get one row group per chunk.
+
+    Args:
+        chunks (iterable): Generated readings, e.g. from ``generate_chunks``.
+        output_path (str): The destination file.
+        fmt (str): "csv" or "parquet" (from the file extension if not given).
+
+    Returns:
+        int: Number of readings written.
+    """
+    fmt = fmt or ("parquet" if output_path.endswith(".parquet") else "csv")
+    writer = sink = None
+    rows = 0
+    started = time.perf_counter()
+    try:
+        for chunk in chunks:
+            table = to_arrow(chunk)
+            if fmt == "csv":
+                # Whole seconds are written as "YYYY-MM-DD HH:MM:SS"
+                table = table.set_column(0, "timestamp", table.column("timestamp").cast(pa.timestamp("s")))
+                if writer is None:
+                    sink = open(output_path, "wb")
+                    sink.write((",".join(table.schema.names) + "\n").encode())
+                    options = pacsv.WriteOptions(include_header=False, quoting_style="none")
+                    writer = pacsv.CSVWriter(sink, table.schema, write_options=options)
+            elif writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+            rows += len(table)
+            print(f"{rows:>12,} readings  {time.perf_counter() - started:8.1f}s")
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic sensor history.")
+    parser.add_argument("--output", required=True, help="destination .csv or .parquet file")
+    parser.add_argument("--fields", type=int, default=1, help="number of fields")
+    parser.add_argument("--nodes", type=int, help="nodes per field (default: 1, or enough for --rows)")
+    parser.add_argument("--rows", type=int, help="approximate total number of readings")
+    parser.add_argument("--start", default="2023-01-01", help="first timestamp")
+    parser.add_argument("--years", type=float, default=1.0, help="length of the history in years")
+    parser.add_argument("--interval", default="5min", help="reading interval of every node")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000, help="readings generated at a time")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    nodes = args.nodes or (nodes_for_rows(args.rows, args.fields, args.years, args.interval) if args.rows else 1)
+    print(f"{args.fields} fields × {nodes} nodes, {args.years} years every {args.interval} -> {args.output}")
+    chunks = generate_chunks(args.fields, nodes, args.start, args.years, args.interval, args.chunk_rows, args.seed)
+    write_chunks(chunks, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Phase timings and cache counters of the dashboard, with a metrics endpoint.
+
+Pages wrap their hot paths in named phases::
+
+    with phase("load"):
+        data = load_readings(columns=["TC"])
+    with phase("render"):
+        st.line_chart(...)
+
+The phases used are "load" (reading data), "filter" (selecting rows),
+"aggregate" (computing what is shown), "resample" (bucketing and
+downsampling series), "corr" (correlation matrices), "fit" and "predict"
+(forecast models), "encode" (writing query results and exports) and "render"
+(drawing it). Phases may be nested; every phase
+is charged its own time only, without the time of the phases nested inside
+it, so the totals add up to the time spent in phases.
+
+Every page names itself with ``track_page`` before its first phase, and every
+phase is recorded in a histogram per page and phase. Threads that do not run
+a page (the forecast scheduler, command line tools) are labelled with their
+thread name. Caches count their requests and misses with ``cache_request``
+and ``cache_miss``.
+
+The histograms and counters are exported in the Prometheus text format:
+
+* ``METRICS_PORT``: serve them on ``http://127.0.0.1:<port>/metrics``
+  (``METRICS_HOST`` changes the address),
+* ``METRICS_FILE``: rewrite them to a file every ``METRICS_INTERVAL``
+  seconds (15 by default), e.g. for the node exporter's textfile collector.
+
+The exporter starts with the first page run of the server process.
+
+Per phase totals are also kept for the whole process. The page benchmarks
+(``benchmarks/page_benchmark.py``) reset them before a page run and read them
+afterwards.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Phase name -> [number of calls, total seconds]
+_totals = {}
+_lock = threading.Lock()
+
+# (page, phase) -> [count per bucket (the last one for slower calls), number of calls, total seconds]
+_histograms = {}
+
+# Cache name -> [requests, misses]
+_caches = {}
+
+# Stack of running phases and the page of the current thread (each page run
+# has its own thread)
+_local = threading.local()
+
+# The exporters of this process, set up by the first ``start_exporter`` call
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def track_page(name):
+    """
+    Labels the timings of the current page run and starts the metrics
+    exporter if it is configured and not running yet.
+
+    Args:
+        name (str): The page, e.g. "Temperature".
+    """
+    _local.page = name
+    start_exporter()
+
+
+def current_page():
+    """
+    Returns the label of the current thread's timings.
+
+    Returns:
+        str: The page set with ``track_page``, or the thread name.
+    """
+    return getattr(_local, "page", None) or threading.current_thread().name
+
+
+def observe(name, seconds, page=None):
+    """
+    Records the duration of a phase that was timed elsewhere (e.g. in a
+    worker process).
+
+    Args:
+        name (str): The phase.
+        seconds (float): Its duration.
+        page (str): The page (``current_page()`` if not given).
+    """
+    key = (page or current_page(), name)
+    with _lock:
+        totals = _totals.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0, 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+
+
+@contextmanager
+def phase(name):
+    """
+    Times a block of code as a named phase.
+
+    Args:
+        name (str): The phase, e.g. "load", "filter", "aggregate" or "render".
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    # Time spent in nested phases, subtracted from this one
+    stack.append(0.0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        observe(name, elapsed - nested)
+
+
+def cache_request(name):
+    """
+    Counts a lookup in a cache.
+
+    Args:
+        name (str): The cache, e.g. "figure" or "rollup".
+    """
+    with _lock:
+        _caches.setdefault(name, [0, 0])[0] += 1
+
+
+def cache_miss(name):
+    """
+    Counts a lookup that had to compute or load the value.
+
+    Args:
+        name (str): The cache.
+    """
+    with _lock:
+        _caches.setdefault(name, [0, 0])[1] += 1
+
+
+def phase_totals():
+    """
+    Returns the time spent in every phase since the last reset.
+
+    Returns:
+        dict: Total seconds per phase name.
+    """
+    with _lock:
+        return {name: seconds for name, (count, seconds) in _totals.items()}
+
+
+def reset_phases():
+    """
+    Clears the phase totals (the histograms keep counting).
+    """
+    with _lock:
+        _totals.clear()
+
+
+def slowest_phases(limit=None):
+    """
+    Ranks the page phases by the total time spent in them.
+
+    Args:
+        limit (int): Number of phases to return (all if not given).
+
+    Returns:
+        list: (page, phase, calls, total seconds) tuples, slowest first.
+    """
+    with _lock:
+        rows = [(page, name, count, total) for (page, name), (_, count, total) in _histograms.items()]
+    return sorted(rows, key=lambda row: row[3], reverse=True)[:limit]
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def metrics_text():
+    """
+    Returns the histograms and cache counters in the Prometheus text format.
+
+    Returns:
+        str: The metrics.
+    """
+    with _lock:
+        histograms = {key: (list(buckets), count, total) for key, (buckets, count, total) in _histograms.items()}
+        caches = {name: list(counts) for name, counts in _caches.items()}
+
+    lines = [
+        "# HELP dashboard_phase_seconds Time spent in a phase of a page, without nested phases.",
+        "# TYPE dashboard_phase_seconds histogram",
+    ]
+    for (page, name), (buckets, count, total) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f"dashboard_phase_seconds_bucket{_labels(page=page, phase=name, le=bound)} {cumulative}")
+        lines.append(f"dashboard_phase_seconds_bucket{_labels(page=page, phase=name, le='+Inf')} {count}")
+        lines.append(f"dashboard_phase_seconds_sum{_labels(page=page, phase=name)} {total}")
+        lines.append(f"dashboard_phase_seconds_count{_labels(page=page, phase=name)} {count}")
+    for metric, index, help_text in (
+        ("dashboard_cache_requests_total", 0, "Lookups in a cache."),
+        ("dashboard_cache_misses_total", 1, "Lookups in a cache that computed or loaded the value."),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, counts in sorted(caches.items()):
+            lines.append(f"{metric}{_labels(cache=name)} {counts[index]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path):
+    """
+    Writes the metrics to a file, replacing it atomically.
+
+    Args:
+        path (str): The destination file.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(metrics_text())
+    os.replace(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Request handler serving ``GET /metrics``.
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+
+def _write_loop(path, interval):
+    while True:
+        try:
+            write_metrics(path)
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+        time.sleep(interval)
+
+
+def start_exporter():
+    """
+    Starts the metrics endpoint (``METRICS_PORT``) and the metrics file writer
+    (``METRICS_FILE``) of this process, once.
+
+    Returns:
+        dict: The running exporters, "server" and/or "writer".
+    """
+    global _exporter
+    with _exporter_lock:
+        if _exporter is not None:
+            return _exporter
+        _exporter = {}
+        port = os.environ.get("METRICS_PORT")
+        if port:
+            server = ThreadingHTTPServer((os.environ.get("METRICS_HOST", "127.0.0.1"), int(port)), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+            _exporter["server"] = server
+        path = os.environ.get("METRICS_FILE")
+        if path:
+            interval = float(os.environ.get("METRICS_INTERVAL", 15))
+            writer = threading.Thread(target=_write_loop, args=(path, interval), name="metrics-writer", daemon=True)
+            writer.start()
+            _exporter["writer"] = writer
+        return _exporter
@@ -0,0 +1,89 @@
+"""
+Memory load test for many simultaneous dashboard sessions.
+
+Opens an increasing number of sessions (Streamlit's AppTest, in this process).
+Every session loads the sensor readings like a page does and keeps them in its
+session state, as a long-lived browser tab would. The Python heap retained by
+the sessions is measured with tracemalloc after each step.
+
+With the shared read-only dataset the sessions only hold views, so memory
+stays flat as sessions are added. ``--copy`` makes every session copy the
+readings instead (which is what a per-session cache copy costs) for
+comparison.
+
+AppTest runs are not thread-safe, so the sessions are opened one after
+another; they are all alive at the same time when memory is measured.
+
+Usage (from the "IoT Smart Agriculture" directory)::
+
+    python benchmarks/load_test.py --sessions 1,10,50,100
+    python benchmarks/load_test.py --sessions 1,10,50,100 --copy
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+DASHBOARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Dashboard")
+
+# A session that loads the readings and keeps them
+SESSION_SCRIPT = """
+import streamlit as st
+from sensor_store import load_readings
+
+readings = load_readings()
+st.session_state["readings"] = readings.copy() if {copy} else readings
+st.write(len(readings))
+"""
+
+
+def open_session(copy=False):
+    """
+    Opens one session and runs its script.
+
+    Args:
+        copy (bool): Whether the session copies the readings.
+
+    Returns:
+        AppTest: The session (kept alive by the caller).
+    """
+    from streamlit.testing.v1 import AppTest
+
+    session = AppTest.from_string(SESSION_SCRIPT.format(copy=copy), default_timeout=120)
+    session.run()
+    if session.exception:
+        raise RuntimeError(session.exception[0].value)
+    return session
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory as sessions are added.")
+    parser.add_argument("--sessions", default="1,10,50,100", help="comma separated session counts")
+    parser.add_argument("--copy", action="store_true", help="copy the readings into every session")
+    args = parser.parse_args()
+
+    os.chdir(DASHBOARD_DIR)
+    sys.path.insert(0, os.getcwd())
+
+    # Warm up: build the store and load the shared dataset once
+    open_session(args.copy)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    sessions = []
+    print(f"{'sessions':>8} {'retained MB':>12} {'per session KB':>15} {'open s':>8}")
+    for count in sorted(int(level) for level in args.sessions.split(",")):
+        started = time.perf_counter()
+        while len(sessions) < count:
+            sessions.append(open_session(args.copy))
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - baseline
+        print(f"{count:>8} {retained / 2**20:>12.1f} {retained / count / 2**10:>15.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
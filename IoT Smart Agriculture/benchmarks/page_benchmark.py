@@ -0,0 +1,350 @@
+"""
+Page benchmarks: every dashboard page driven headlessly through AppTest.
+
+For every dataset size a synthetic sensor history is written to a temporary
+store (``SENSOR_STORE_DIR``), its rollups, running statistics, correlation
+partials and anomaly flags are built, and then ``app.py`` and every script in
+``pages/`` are run with Streamlit's ``AppTest``:
+
+* once as the page opens (the default chart), and
+* once per button on the page (every chart type of the sensor pages, the
+  correlation buttons), clicked after the page has opened.
+
+Each scenario records:
+
+* ``first_s``: wall time of the first run. Page opens start from empty caches,
+  so this includes loading the data; button scenarios show a chart for the
+  first time (its figure is not cached yet).
+* ``repeat_s``: median wall time of ``--repeat`` further identical runs (the
+  warm hot path every rerun goes through).
+* ``peak_mb``: peak Python heap of the first run (tracemalloc, measured in a
+  separate pass so tracing does not slow down the timed runs).
+* ``phases`` / ``repeat_phases``: seconds spent in the "load", "filter",
+  "aggregate", "resample", "corr" and "render" phases of the page (see
+  ``timing``).
+
+At the end the page phases that took the most time over all runs are listed;
+``--metrics`` also writes their histograms and the cache counters in the
+Prometheus text format.
+
+``--save-baseline`` stores the results as the baseline; later runs are compared
+with it and the script exits with status 1 if any scenario got slower (or
+bigger) than the baseline by more than ``--tolerance``. Baselines depend on
+the machine, so save them on the machine that runs the check.
+
+Usage (from the "IoT Smart Agriculture" directory)::
+
+    python benchmarks/page_benchmark.py --rows 10000,100000,1000000,10000000 --save-baseline
+    python benchmarks/page_benchmark.py --rows 10000,100000,1000000,10000000
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DASHBOARD_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Dashboard"))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# Readings per node and year at the loggers' 5 minute interval
+READINGS_PER_NODE = 365 * 24 * 12
+
+# Differences below these are noise, whatever the tolerance
+MIN_SECONDS = 0.05
+MIN_MB = 5.0
+
+
+def synthetic_readings(rows, seed=0):
+    """
+    Generates a sensor history of one field (see ``synthetic_data``).
+
+    Up to one year of readings is generated at a 5 minute interval; larger
+    datasets add nodes to the field rather than years to the history.
+
+    Args:
+        rows (int): Number of readings (outages make it slightly fewer).
+        seed (int): Random seed.
+
+    Returns:
+        pandas.DataFrame: The readings with the store schema and a
+        ``field_id`` column.
+    """
+    from synthetic_data import readings_frame
+
+    nodes = -(-rows // READINGS_PER_NODE)
+    years = rows / (nodes * READINGS_PER_NODE)
+    return readings_frame(fields=1, nodes=nodes, years=years, seed=seed).head(rows)
+
+
+def prepare_store(rows, store_dir):
+    """
+    Builds a store with synthetic readings and everything derived from it.
+
+    Args:
+        rows (int): Number of readings.
+        store_dir (str): The store directory.
+
+    Returns:
+        dict: Seconds spent generating, storing and precomputing.
+    """
+    from anomalies import build_anomalies
+    from correlation_engine import build_engine
+    from rollups import build_rollups
+    from running_stats import build_stats
+    from sensor_store import build_store, store_lock
+
+    os.environ["SENSOR_STORE_DIR"] = store_dir
+    # No source CSV: the store is never rebuilt behind the benchmark's back
+    os.environ["DATA_PATH"] = os.path.join(store_dir, "missing.csv")
+    timings = {}
+    started = time.perf_counter()
+    data = synthetic_readings(rows)
+    timings["generate"] = time.perf_counter() - started
+    started = time.perf_counter()
+    with store_lock():
+        build_store(data)
+    timings["store"] = time.perf_counter() - started
+    del data
+    started = time.perf_counter()
+    build_rollups()
+    build_stats()
+    build_engine()
+    build_anomalies()
+    timings["precompute"] = time.perf_counter() - started
+    return timings
+
+
+def clear_caches():
+    """
+    Empties Streamlit's data and resource caches (figures) and the shared
+    datasets.
+    """
+    import streamlit as st
+    from sensor_store import get_dataset_cache
+
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    get_dataset_cache().clear()
+    gc.collect()
+
+
+def list_pages(selected=None):
+    """
+    Returns the page scripts to benchmark.
+
+    Args:
+        selected (list): Substrings of the pages to keep (all if not given).
+
+    Returns:
+        list: Paths relative to the dashboard directory.
+    """
+    pages = ["app.py"] + sorted(os.path.relpath(path, DASHBOARD_DIR) for path in glob.glob(os.path.join(DASHBOARD_DIR, "pages", "*.py")))
+    return [page for page in pages if not selected or any(name in page for name in selected)]
+
+
+def _run(session, label):
+    from timing import phase_totals, reset_phases
+
+    reset_phases()
+    started = time.perf_counter()
+    if label is None:
+        session.run()
+    else:
+        next(button for button in session.button if button.label == label).click().run()
+    elapsed = time.perf_counter() - started
+    if session.exception:
+        raise RuntimeError(f"{label or 'open'}: {session.exception[0].value}")
+    return elapsed, phase_totals()
+
+
+def _open(page):
+    from streamlit.testing.v1 import AppTest
+
+    return AppTest.from_file(os.path.join(DASHBOARD_DIR, page), default_timeout=600)
+
+
+def scenarios(page):
+    """
+    Lists the scenarios of a page: opening it and clicking each button.
+
+    Args:
+        page (str): The page script.
+
+    Returns:
+        list: None (open the page) followed by the button labels.
+    """
+    clear_caches()
+    session = _open(page)
+    session.run()
+    return [None] + [button.label for button in session.button]
+
+
+def measure(page, label, repeat):
+    """
+    Times one scenario.
+
+    Args:
+        page (str): The page script.
+        label (str): The button to click, or None to time opening the page.
+        repeat (int): Number of warm runs.
+
+    Returns:
+        dict: ``first_s``, ``repeat_s``, ``phases`` and ``repeat_phases``.
+    """
+    clear_caches()
+    session = _open(page)
+    if label is not None:
+        session.run()
+    first, phases = _run(session, label)
+    runs = [_run(session, label) for _ in range(repeat)]
+    repeat_phases = {}
+    for _, totals in runs:
+        for name, seconds in totals.items():
+            repeat_phases.setdefault(name, []).append(seconds)
+    return {
+        "first_s": first,
+        "repeat_s": statistics.median(elapsed for elapsed, _ in runs) if runs else None,
+        "phases": phases,
+        "repeat_phases": {name: statistics.median(values) for name, values in repeat_phases.items()},
+    }
+
+
+def measure_peak(page, label):
+    """
+    Measures the peak Python heap of a scenario's first run.
+
+    Args:
+        page (str): The page script.
+        label (str): The button to click, or None to measure opening the page.
+
+    Returns:
+        float: Peak heap growth in megabytes.
+    """
+    clear_caches()
+    session = _open(page)
+    tracemalloc.start()
+    try:
+        if label is not None:
+            session.run()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        _run(session, label)
+        return (tracemalloc.get_traced_memory()[1] - baseline) / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Finds the scenarios that got slower or bigger than the baseline.
+
+    Args:
+        results (dict): Results per scenario key.
+        baseline (dict): Baseline results per scenario key.
+        tolerance (float): Allowed relative increase, e.g. 0.25 for 25%.
+
+    Returns:
+        list: One message per regression.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric, floor in (("first_s", MIN_SECONDS), ("repeat_s", MIN_SECONDS), ("peak_mb", MIN_MB)):
+            new, old = result.get(metric), base.get(metric)
+            if new is None or old is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(f"{key}: {metric} {old:.3f} -> {new:.3f} (+{(new / old - 1) * 100 if old else float('inf'):.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every dashboard page with AppTest.")
+    parser.add_argument("--rows", default="10000,100000,1000000,10000000", help="comma separated dataset sizes")
+    parser.add_argument("--pages", default="", help="comma separated page name filters (all pages if empty)")
+    parser.add_argument("--repeat", type=int, default=3, help="warm runs per scenario")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory pass")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--metrics", help="write the phase histograms and cache counters to this file")
+    args = parser.parse_args()
+
+    os.chdir(DASHBOARD_DIR)
+    sys.path.insert(0, DASHBOARD_DIR)
+    # Prophet models are not trained during benchmarks; the forecast pages
+    # predict from harmonic models fitted on the synthetic store
+    os.environ["FORECAST_SCHEDULER"] = "off"
+    os.environ["FORECAST_ENGINE"] = "harmonic"
+    # Caches are used without a server; don't warn about it on every run
+    from streamlit.logger import get_logger
+
+    get_logger("streamlit.runtime.caching.cache_data_api").disabled = True
+
+    pages = list_pages([name for name in args.pages.split(",") if name])
+    results = {}
+    print(f"{'rows':>9} {'page / scenario':<56} {'first s':>8} {'repeat s':>9} {'peak MB':>8}  warm phases (s)")
+    for rows in sorted(int(level) for level in args.rows.split(",")):
+        store_dir = tempfile.mkdtemp(prefix="page-benchmark-")
+        try:
+            setup = prepare_store(rows, store_dir)
+            print(f"{rows:>9} setup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in setup.items()))
+            for page in pages:
+                for label in scenarios(page):
+                    key = f"{rows}|{page}|{label or 'open'}"
+                    result = measure(page, label, args.repeat)
+                    result["peak_mb"] = None if args.no_memory else measure_peak(page, label)
+                    results[key] = result
+                    phases = ", ".join(f"{name} {seconds:.3f}" for name, seconds in sorted(result["repeat_phases"].items()))
+                    repeat_s = "" if result["repeat_s"] is None else f"{result['repeat_s']:.3f}"
+                    peak = "" if result["peak_mb"] is None else f"{result['peak_mb']:.1f}"
+                    print(f"{rows:>9} {page + ' / ' + (label or 'open'):<56} {result['first_s']:>8.3f} {repeat_s:>9} {peak:>8}  {phases}")
+        finally:
+            clear_caches()
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    from timing import slowest_phases, write_metrics
+
+    print("Slowest page phases (all runs):")
+    for page, name, calls, seconds in slowest_phases(10):
+        print(f"  {page + ' / ' + name:<40} {seconds:>9.3f}s in {calls} calls")
+    if args.metrics:
+        write_metrics(args.metrics)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if not baseline:
+        print("No baseline to compare with (run with --save-baseline first).")
+    elif regressions:
+        print("Regressions against the baseline:")
+        for message in regressions:
+            print("  " + message)
+        sys.exit(1)
+    else:
+        print(f"No regressions against the baseline (tolerance {args.tolerance:.0%}).")
+
+
+if __name__ == "__main__":
+    main()